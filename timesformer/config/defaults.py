@@ -103,6 +103,18 @@ _C.TEST.NUM_SPATIAL_CROPS = 3
 _C.TEST.CHECKPOINT_TYPE = "pytorch"
 # Path to saving prediction results file.
 _C.TEST.SAVE_RESULTS_PATH = ""
+
+# If True, each temporal window of a test video is decoded once and all its
+# spatial crops are taken from that decode, instead of decoding the window
+# once per spatial crop. The loader batch then holds TEST.BATCH_SIZE clips of
+# TEST.BATCH_SIZE // NUM_SPATIAL_CROPS windows.
+_C.TEST.DECODE_ONCE = False
+
+# Numbers of frames selected from DATA.NUM_CANDIDATE_FRAMES candidates by
+# the motion energy frame selection. If not empty, the test is run once per
+# number of selected frames, and their throughput and accuracy are logged.
+_C.TEST.NUM_SELECTED_FRAMES = []
+
 # -----------------------------------------------------------------------------
 # ResNet options
 # -----------------------------------------------------------------------------
@@ -258,6 +270,34 @@ _C.TIMESFORMER = CfgNode()
 _C.TIMESFORMER.ATTENTION_TYPE = 'divided_space_time'
 _C.TIMESFORMER.PRETRAINED_MODEL = ''
 
+# Attention backend, options include `eager` (explicit attention matrix),
+# `sdpa` (scaled_dot_product_attention with the kernels PyTorch selects),
+# `math`, `efficient` and `flash` (a single scaled_dot_product_attention
+# kernel, the kernels PyTorch selects on CPU when there is no CPU one).
+_C.TIMESFORMER.ATTENTION_BACKEND = 'eager'
+
+# If True, the divided space-time attention blocks keep the cls token and the
+# spatial tokens apart, in a layout where the temporal attention runs on a
+# view of the tokens, see `vit.LayoutStableBlock`. The parameters are the
+# ones of the default blocks.
+_C.TIMESFORMER.LAYOUT_STABLE_BLOCK = False
+
+# If > 0, checkpoint the activations of the attention blocks in segments of
+# this many blocks. Only the input of every segment is kept for backward, and
+# the blocks are recomputed, which allows larger training batches.
+_C.TIMESFORMER.CHECKPOINT_BLOCKS = 0
+
+# Fraction of the patches kept by motion guided token pruning. The VMPs
+# attention map is pooled to the patch grid, and the patches with the least
+# motion are dropped before the attention blocks. 1.0 keeps every patch.
+# Pruning requires VMPs.
+_C.TIMESFORMER.TOKEN_KEEP_RATIO = 1.0
+
+# If > 0, keep the patches whose pooled motion is above this threshold
+# instead of a fixed fraction of them. The number of kept patches is the
+# largest one of the batch.
+_C.TIMESFORMER.TOKEN_KEEP_THRESHOLD = 0.0
+
 ## MixUp parameters
 _C.MIXUP = CfgNode()
 _C.MIXUP.ENABLED = False
@@ -271,6 +311,20 @@ _C.MIXUP.MODE = 'batch'
 _C.EMA = CfgNode()
 _C.EMA.ENABLED = False
 
+# ---------------------------------------------------------------------------- #
+# Mixed precision options
+# ---------------------------------------------------------------------------- #
+_C.AMP = CfgNode()
+
+# If True, run the forward passes of training, validation and testing under
+# autocast, and scale the training loss when computing in float16. Mixed
+# precision is only applied on GPUs, CPU runs stay in float32.
+_C.AMP.ENABLE = False
+
+# Data type of autocast, `float16` or `bfloat16`. If empty, float16. bfloat16
+# requires PyTorch 1.10.
+_C.AMP.DTYPE = ""
+
 # -----------------------------------------------------------------------------
 # Data options
 # -----------------------------------------------------------------------------
@@ -291,6 +345,11 @@ _C.DATA.CROP_SIZE = 224
 # The number of frames of the input clip.
 _C.DATA.NUM_FRAMES = 8
 
+# If > 0, decode this many candidate frames over the temporal window of
+# DATA.NUM_FRAMES frames, and feed the DATA.NUM_FRAMES candidates with the
+# most motion energy to the model, see `vit_base_patch16_224.select_frames`.
+_C.DATA.NUM_CANDIDATE_FRAMES = 0
+
 # The video sampling rate of the input clip.
 _C.DATA.SAMPLING_RATE = 8
 
@@ -303,6 +362,18 @@ _C.DATA.INPUT_CHANNEL_NUM = [3, 3]
 # The std value of the video raw pixels across the R G B channels.
 _C.DATA.STD = [0.225, 0.225, 0.225]
 
+# If True, the loader returns uint8 clips and the model normalizes them with
+# DATA.MEAN and DATA.STD on the training device, in the same step as the [0, 1]
+# clip used by the video motion prompts.
+_C.DATA.NORMALIZE_ON_DEVICE = False
+
+# If > 1, every training video is decoded once and this many independently
+# augmented clips are sampled from it, from different temporal windows if the
+# video is longer than a clip. A training batch then holds TRAIN.BATCH_SIZE
+# clips of TRAIN.BATCH_SIZE // NUM_REPEATED_CLIPS videos, and an epoch visits
+# every video once. Only supported by the `pyav` decoding backend.
+_C.DATA.NUM_REPEATED_CLIPS = 1
+
 # The spatial augmentation jitter scales for training.
 _C.DATA.TRAIN_JITTER_SCALES = [256, 320]
 
@@ -324,6 +395,11 @@ _C.DATA.DECODING_BACKEND = "pyav"
 # [min_scale, max_scale].
 _C.DATA.INV_UNIFORM_SAMPLE = False
 
+# If True, the spatial sampling picks the crop window in the decoded frames and
+# only interpolates that window to the crop size, instead of scaling the whole
+# frames before cropping them. The scales and crops are the same.
+_C.DATA.CROP_THEN_RESIZE = False
+
 # If True, perform random horizontal flip on the video frames during training.
 _C.DATA.RANDOM_FLIP = True
 
@@ -431,6 +507,23 @@ _C.DIST_BACKEND = "nccl"
 # Global batch size
 _C.GLOBAL_BATCH_SIZE = 64
 
+# ---------------------------------------------------------------------------- #
+# Non-finite watchdog options
+# ---------------------------------------------------------------------------- #
+_C.WATCHDOG = CfgNode()
+
+# If True, flag the training iterations with a non-finite loss on the device,
+# the flags are checked every LOG_PERIOD iterations. The states at the start
+# of every period and the LOG_PERIOD batches of the period are copied to the
+# host. When an iteration is flagged, they are saved to OUTPUT_DIR/nonfinite,
+# and the iterations of the period are replayed on the same batches up to the
+# flagged one, which runs under autograd anomaly detection.
+_C.WATCHDOG.ENABLE = False
+
+# If True, also flag the iterations with a non-finite gradient norm. Ignored
+# with loss scaling, which skips the steps with non-finite gradients.
+_C.WATCHDOG.GRAD_NORM = False
+
 # ---------------------------------------------------------------------------- #
 # Benchmark options
 # ---------------------------------------------------------------------------- #
@@ -445,6 +538,24 @@ _C.BENCHMARK.LOG_PERIOD = 100
 # If True, shuffle dataloader for epoch during benchmark.
 _C.BENCHMARK.SHUFFLE = True
 
+# Benchmark run by tools/benchmark.py, options include `data_loading`,
+# `decoding`, `spatial_sampling`, `vmps`, `token_pruning`, `attention`,
+# `block`, `checkpointing`, `amp`, `grad_accumulation`, `stats_sync`,
+# `prefetch` and `test_aggregation`.
+_C.BENCHMARK.TASK = "data_loading"
+
+# Number of training clips decoded by the decoding and spatial sampling
+# benchmarks, of validation clips evaluated by the token pruning and mixed
+# precision benchmarks, and of test videos of the test aggregation benchmark.
+_C.BENCHMARK.NUM_SAMPLES = 200
+
+# TIMESFORMER.TOKEN_KEEP_RATIO values compared by the token pruning benchmark.
+_C.BENCHMARK.TOKEN_KEEP_RATIOS = [1.0, 0.75, 0.5, 0.25]
+
+# TIMESFORMER.CHECKPOINT_BLOCKS values compared by the activation
+# checkpointing benchmark.
+_C.BENCHMARK.CHECKPOINT_BLOCKS = [0, 1, 2, 4]
+
 
 # ---------------------------------------------------------------------------- #
 # Common train/test data loader options
@@ -460,6 +571,45 @@ _C.DATA_LOADER.PIN_MEMORY = True
 # Enable multi thread decoding.
 _C.DATA_LOADER.ENABLE_MULTI_THREAD_DECODE = False
 
+# Read contiguous, uncompressed videos from the memory-mapped h5 file instead
+# of copying them whole, PyAV still copies the chunks it reads. Chunked or
+# compressed videos are always copied whole.
+_C.DATA_LOADER.ENABLE_H5_MMAP = True
+
+# Only convert to RGB the decoded frames kept by the temporal sampling, and
+# skip decoding the unused non-reference frames. Only used by the `pyav`
+# backend, the clips are the same as without it.
+_C.DATA_LOADER.ENABLE_SPARSE_DECODE = False
+
+# If larger than 0, the `pyav` backend resizes the decoded frames in libswscale
+# so that their shorter edge is the smaller of DECODE_SHORT_SIDE and the
+# largest scale of the spatial sampling (e.g. TRAIN_JITTER_SCALES[1] for
+# training). Frames with a smaller shorter edge are not resized.
+_C.DATA_LOADER.DECODE_SHORT_SIDE = 0
+
+# If True, stage the next batch while the current one is computed: its copy to
+# the GPU is issued on a side stream, or on CPU it is loaded on a background
+# thread.
+_C.DATA_LOADER.ENABLE_DEVICE_PREFETCH = False
+
+# If True, keep the data loader workers alive across epochs instead of forking
+# them again at every epoch. Only used if NUM_WORKERS > 0.
+_C.DATA_LOADER.PERSISTENT_WORKERS = False
+
+# Number of batches loaded in advance by every data loader worker. Only used if
+# NUM_WORKERS > 0.
+_C.DATA_LOADER.PREFETCH_FACTOR = 2
+
+# If larger than 0, number of intra-op threads of torch and OpenCV in every
+# data loader worker, and of the PyAV decoder. If 0, torch uses 1 thread in the
+# workers, and OpenCV and PyAV as many threads as there are cores.
+_C.DATA_LOADER.WORKER_NUM_THREADS = 0
+
+# If True, pin every data loader worker to its share of the CPUs available to
+# the training process, after splitting them between the training processes of
+# the machine.
+_C.DATA_LOADER.ENABLE_WORKER_AFFINITY = False
+
 
 # ---------------------------------------------------------------------------- #
 # Detection options.
@@ -793,6 +943,12 @@ _C.WANDB.ENABLE = False
 _C.VMPS = CfgNode()
 _C.VMPS.EXP_NAME = "baseline"
 _C.VMPS.PENALTY_WEIGHT = 0.0
+# If True, compute the motion prompt with a single autograd function which
+# recomputes its intermediates in backward instead of saving them.
+_C.VMPS.FUSED = False
+# If True, checkpoint the activations of the VMPs, see
+# TIMESFORMER.CHECKPOINT_BLOCKS.
+_C.VMPS.CHECKPOINT = False
 ### ---------------------------------------------- ###
 
 def _assert_and_infer_cfg(cfg):
@@ -802,6 +958,17 @@ def _assert_and_infer_cfg(cfg):
     # TRAIN assertions.
     assert cfg.TRAIN.CHECKPOINT_TYPE in ["pytorch", "caffe2"]
     assert cfg.TRAIN.BATCH_SIZE % cfg.NUM_GPUS == 0
+    assert (
+        cfg.TRAIN.BATCH_SIZE // max(1, cfg.NUM_GPUS)
+    ) % cfg.DATA.NUM_REPEATED_CLIPS == 0
+    assert not (cfg.DATA.NUM_REPEATED_CLIPS > 1 and cfg.MULTIGRID.SHORT_CYCLE)
+    assert (
+        cfg.DATA.NUM_REPEATED_CLIPS == 1
+        or cfg.DATA.DECODING_BACKEND == "pyav"
+    )
+
+    # AMP assertions.
+    assert cfg.AMP.DTYPE in ["", "float16", "bfloat16"]
 
     # TEST assertions.
     assert cfg.TEST.CHECKPOINT_TYPE in ["pytorch", "caffe2"]
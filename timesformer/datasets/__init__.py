@@ -2,3 +2,4 @@
 
 from .build import DATASET_REGISTRY, build_dataset  # noqa
 from .mpii import Mpii  # noqa
+from .mpii_frames import Mpiiframes  # noqa
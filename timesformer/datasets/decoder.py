@@ -1,12 +1,49 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
 
+import bisect
 import math
+import multiprocessing
 import numpy as np
 import random
 import torch
 import torchvision.io as io
 
 
+# Decoding counters shared with forked DataLoader workers: frames decoded by
+# the pyav backend, frames returned after temporal sampling, and videos that
+# had to be decoded entirely.
+_DECODE_STATS = {
+    "decoded_frames": multiprocessing.Value("q", 0),
+    "used_frames": multiprocessing.Value("q", 0),
+    "full_decodes": multiprocessing.Value("q", 0),
+}
+
+
+def _count(name, value=1):
+    counter = _DECODE_STATS[name]
+    with counter.get_lock():
+        counter.value += value
+
+
+def get_decode_stats():
+    """
+    Return the decoding counters of this process and the DataLoader workers
+    forked from it.
+    Returns:
+        stats (dict): `decoded_frames`, `used_frames` and `full_decodes`.
+    """
+    return {name: counter.value for name, counter in _DECODE_STATS.items()}
+
+
+def reset_decode_stats():
+    """
+    Reset the decoding counters to zero.
+    """
+    for counter in _DECODE_STATS.values():
+        with counter.get_lock():
+            counter.value = 0
+
+
 def temporal_sampling(frames, start_idx, end_idx, num_samples):
     """
     Given the start and end frame index, sample num_samples frames between
@@ -71,8 +108,145 @@ def get_start_end_idx(video_size, clip_size, clip_idx, num_clips):
     return start_idx, end_idx
 
 
+def get_temporal_sample_index(
+    num_decoded, clip_sz, num_frames, clip_idx, num_clips, decode_all_video
+):
+    """
+    Compute the indices of the decoded frames that `decode` keeps after
+    temporal sampling. Videos shorter than num_frames are looped.
+    Args:
+        num_decoded (int): number of decoded frames.
+        clip_sz (float): size of the clip in decoded frames.
+        num_frames (int): number of frames to sample.
+        clip_idx (int): if clip_idx is -1, perform random temporal
+            sampling. If clip_idx is larger than -1, uniformly split the
+            video to num_clips clips, and select the clip_idx-th video clip.
+        num_clips (int): overall number of clips to uniformly sample from the
+            given video.
+        decode_all_video (bool): if True, the entire video was decoded and the
+            clip is sampled from it, otherwise the decoded frames are the clip.
+    Returns:
+        index (tensor): indices into the decoded frames of the sampled frames.
+    """
+    start_idx, end_idx = get_start_end_idx(
+        num_decoded,
+        clip_sz,
+        clip_idx if decode_all_video else 0,
+        num_clips if decode_all_video else 1,
+    )
+    if num_decoded < num_frames:
+        repeat_time = math.ceil(num_frames / num_decoded)
+        start_idx = 0
+        end_idx = num_decoded * repeat_time - 1
+    elif num_decoded - 1 < clip_sz:
+        start_idx = 0
+        end_idx = num_decoded - 1
+    index = torch.linspace(start_idx, end_idx, num_frames).long()
+    return index % num_decoded
+
+
+def get_pyav_frame_indices(
+    pts,
+    fps,
+    frames_length,
+    duration,
+    sampling_rate,
+    num_frames,
+    clip_idx=-1,
+    num_clips=10,
+    target_fps=30,
+):
+    """
+    Compute the indices of the frames that `decode` returns with the `pyav`
+    backend, given the presentation timestamps of all frames of the video.
+    This reproduces the selective decoding of `pyav_decode` and the temporal
+    sampling of `decode` without decoding the video.
+    Args:
+        pts (list): sorted Presentation TimeStamps of all video frames.
+        fps (float): the average frame rate of the video stream.
+        frames_length (int): number of frames reported by the video stream.
+        duration (int): duration of the video stream in pts. If None, the
+            entire video is decoded.
+        sampling_rate (int): frame sampling rate (interval between two sampled
+            frames).
+        num_frames (int): number of frames to sample.
+        clip_idx (int): if clip_idx is -1, perform random temporal
+            sampling. If clip_idx is larger than -1, uniformly split the
+            video to num_clips clips, and select the clip_idx-th video clip.
+        num_clips (int): overall number of clips to uniformly sample from the
+            given video.
+        target_fps (int): the input video may have different fps, convert it to
+            the target video fps before frame sampling.
+    Returns:
+        indices (ndarray): indices into `pts` of the sampled frames. None if
+            no frame would be decoded.
+    """
+    pts = np.asarray(pts)
+    clip_sz = sampling_rate * num_frames / target_fps * fps
+    if duration is None:
+        decode_all_video = True
+        selected = np.arange(len(pts))
+    else:
+        decode_all_video = False
+        start_idx, end_idx = get_start_end_idx(
+            frames_length, clip_sz, clip_idx, num_clips
+        )
+        timebase = duration / frames_length
+        video_start_pts = int(start_idx * timebase)
+        video_end_pts = int(end_idx * timebase)
+        # `pyav_decode_stream` keeps the frames in [start_pts, end_pts] and
+        # the first frame after end_pts.
+        first = np.searchsorted(pts, video_start_pts, side="left")
+        last = np.searchsorted(pts, video_end_pts, side="right")
+        selected = np.arange(first, min(last + 1, len(pts)))
+
+    if len(selected) == 0:
+        return None
+
+    index = get_temporal_sample_index(
+        len(selected), clip_sz, num_frames, clip_idx, num_clips, decode_all_video
+    )
+    return selected[index.numpy()]
+
+
+def frame_to_ndarray(frame, short_side=0):
+    """
+    Convert a PyAV video frame to an RGB ndarray. If short_side is smaller
+    than the shorter edge of the frame, the frame is resized by libswscale
+    during the color conversion, keeping the aspect ratio.
+    Args:
+        frame (VideoFrame): PyAV video frame.
+        short_side (int): size of the shorter edge of the returned frame. If
+            0, keep the frame size.
+    Returns:
+        frame (ndarray): `height` x `width` x `channel` uint8 RGB frame.
+    """
+    width, height = frame.width, frame.height
+    if 0 < short_side < min(width, height):
+        # Same output size as `transform.random_short_side_scale_jitter`.
+        if width < height:
+            new_width = short_side
+            new_height = int(math.floor((float(height) / width) * short_side))
+        else:
+            new_height = short_side
+            new_width = int(math.floor((float(width) / height) * short_side))
+        return frame.reformat(
+            width=new_width,
+            height=new_height,
+            format="rgb24",
+            interpolation="BILINEAR",
+        ).to_ndarray()
+    return frame.to_rgb().to_ndarray()
+
+
 def pyav_decode_stream(
-    container, start_pts, end_pts, stream, stream_name, buffer_size=0
+    container,
+    start_pts,
+    end_pts,
+    stream,
+    stream_name,
+    buffer_size=0,
+    keyframe_pts=None,
 ):
     """
     Decode the video with PyAV decoder.
@@ -85,20 +259,30 @@ def pyav_decode_stream(
         stream_name (dict): a dictionary of streams. For example, {"video": 0}
             means video stream at stream index 0.
         buffer_size (int): number of additional frames to decode beyond end_pts.
+        keyframe_pts (list): sorted Presentation TimeStamps of the keyframes of
+            the stream. If given, seek to the closest keyframe before
+            start_pts instead of seeking with a margin.
     Returns:
         result (list): list of frames decoded.
         max_pts (int): max Presentation TimeStamp of the video sequence.
     """
-    # Seeking in the stream is imprecise. Thus, seek to an ealier PTS by a
-    # margin pts.
-    margin = 1024
-    seek_offset = max(start_pts - margin, 0)
+    if keyframe_pts is not None and len(keyframe_pts) > 0:
+        # Seek exactly to the keyframe the decoding has to start from.
+        i = bisect.bisect_right(keyframe_pts, start_pts) - 1
+        seek_offset = keyframe_pts[max(i, 0)]
+    else:
+        # Seeking in the stream is imprecise. Thus, seek to an ealier PTS by a
+        # margin pts.
+        margin = 1024
+        seek_offset = max(start_pts - margin, 0)
 
     container.seek(seek_offset, any_frame=False, backward=True, stream=stream)
     frames = {}
     buffer_count = 0
     max_pts = 0
+    num_decoded = 0
     for frame in container.decode(**stream_name):
+        num_decoded += 1
         max_pts = max(max_pts, frame.pts)
         if frame.pts < start_pts:
             continue
@@ -109,10 +293,110 @@ def pyav_decode_stream(
             frames[frame.pts] = frame
             if buffer_count >= buffer_size:
                 break
+    _count("decoded_frames", num_decoded)
     result = [frames[pts] for pts in sorted(frames)]
     return result, max_pts
 
 
+def pyav_decode_stream_sparse(
+    container,
+    start_pts,
+    end_pts,
+    stream,
+    stream_name,
+    get_index,
+    keyframe_pts=None,
+):
+    """
+    Decode the same frames as `pyav_decode_stream` and return only the ones
+    selected by get_index. The frames are selected from the timestamps of the
+    demuxed packets before decoding, so that the non-reference frames that are
+    not selected are skipped by the decoder instead of being decoded. If the
+    packets do not carry timestamps, every frame is decoded.
+    Args:
+        container (container): PyAV container.
+        start_pts (int): the starting Presentation TimeStamp to fetch the
+            video frames.
+        end_pts (int): the ending Presentation TimeStamp of the decoded frames.
+        stream (stream): PyAV stream.
+        stream_name (dict): a dictionary of streams. For example, {"video": 0}
+            means video stream at stream index 0.
+        get_index (callable): maps the number of frames `pyav_decode_stream`
+            would return to the indices of the frames to keep.
+        keyframe_pts (list): sorted Presentation TimeStamps of the keyframes of
+            the stream, see `pyav_decode_stream`.
+    Returns:
+        result (list): the selected frames, in the order of the indices.
+    """
+    if keyframe_pts is not None and len(keyframe_pts) > 0:
+        i = bisect.bisect_right(keyframe_pts, start_pts) - 1
+        seek_offset = keyframe_pts[max(i, 0)]
+    else:
+        margin = 1024
+        seek_offset = max(start_pts - margin, 0)
+    container.seek(seek_offset, any_frame=False, backward=True, stream=stream)
+
+    # `pyav_decode_stream` keeps the frames in [start_pts, end_pts] and the
+    # first one after end_pts. As a packet is never presented before it is
+    # decoded (pts >= dts), demuxing stops at the first packet decoded after
+    # that frame.
+    packets = []
+    next_pts = math.inf
+    for packet in container.demux(stream):
+        if packet.size == 0:
+            continue
+        if packet.pts is None or packet.dts is None:
+            packets = None
+            break
+        packets.append(packet)
+        if packet.pts > end_pts:
+            next_pts = min(next_pts, packet.pts)
+        if packet.dts >= next_pts:
+            break
+
+    if packets is not None:
+        pts = sorted({p.pts for p in packets if start_pts <= p.pts <= end_pts})
+        if next_pts != math.inf:
+            pts.append(next_pts)
+        if len(pts) == 0:
+            return []
+        selected = [pts[i] for i in get_index(len(pts)).tolist()]
+        targets = set(selected)
+        codec_context = stream.codec_context
+        frames = {}
+        num_decoded = 0
+        for packet in packets + [None]:
+            if packet is not None:
+                # Frames that other frames do not reference are only decoded
+                # if they are selected.
+                codec_context.skip_frame = (
+                    "DEFAULT" if packet.pts in targets else "NONREF"
+                )
+            for frame in codec_context.decode(packet):
+                num_decoded += 1
+                if frame.pts in targets:
+                    frames[frame.pts] = frame
+            if len(frames) == len(targets):
+                break
+        codec_context.skip_frame = "DEFAULT"
+        _count("decoded_frames", num_decoded)
+        if len(frames) == len(targets):
+            return [frames[frame_pts] for frame_pts in selected]
+        # The frames do not match their packets, decode the stream instead.
+
+    video_frames, _ = pyav_decode_stream(
+        container,
+        start_pts,
+        end_pts,
+        stream,
+        stream_name,
+        keyframe_pts=keyframe_pts,
+    )
+    if len(video_frames) == 0:
+        return []
+    return [video_frames[i] for i in get_index(len(video_frames)).tolist()]
+
+
 def torchvision_decode(
     video_handle,
     sampling_rate,
@@ -225,7 +509,8 @@ def torchvision_decode(
 
 def pyav_decode(
     container, sampling_rate, num_frames, clip_idx, num_clips=10, target_fps=30, start=None, end=None
-, duration=None, frames_length=None):
+, duration=None, frames_length=None, video_meta=None, sparse=False,
+    max_spatial_scale=0):
     """
     Convert the video from its original fps to the target_fps. If the video
     support selective decoding (contain decoding information in the video head),
@@ -245,28 +530,46 @@ def pyav_decode(
             given video.
         target_fps (int): the input video may has different fps, convert it to
             the target video fps before frame sampling.
+        video_meta (dict): the stream information recorded by
+            tools/scan_h5.py (`fps`, `frames_length`, `duration` and
+            `keyframe_pts`). If given, it is used instead of the information
+            from the video head, and decoding starts from the closest keyframe.
+        sparse (bool): if True, perform the temporal sampling of `decode` on
+            the decoded frames and only convert the sampled frames to RGB.
+        max_spatial_scale (int): if larger than 0 and smaller than the shorter
+            edge of the video, resize the frames so that the shorter edge is
+            max_spatial_scale while converting them to RGB.
     Returns:
-        frames (tensor): decoded frames from the video. Return None if the no
-            video stream was found.
+        frames (tensor): decoded frames from the video, temporally sampled if
+            sparse is True. Return None if the no video stream was found.
         fps (float): the number of frames per second of the video.
         decode_all_video (bool): If True, the entire video was decoded.
     """
     # Try to fetch the decoding information from the video head. Some of the
     # videos does not support fetching the decoding information, for that case
     # it will get None duration.
-    fps = float(container.streams.video[0].average_rate)
+    keyframe_pts = None
+    if video_meta is not None and "keyframe_pts" in video_meta:
+        # Use the stream information recorded by the scan of the dataset.
+        fps = video_meta["fps"]
+        frames_length = video_meta["frames_length"]
+        duration = video_meta["duration"]
+        keyframe_pts = video_meta["keyframe_pts"]
+    else:
+        fps = float(container.streams.video[0].average_rate)
 
-    orig_duration = duration
-    tb = float(container.streams.video[0].time_base)
-    frames_length = container.streams.video[0].frames
-    duration = container.streams.video[0].duration
-    if duration is None and orig_duration is not None:
-       duration = orig_duration / tb
+        orig_duration = duration
+        tb = float(container.streams.video[0].time_base)
+        frames_length = container.streams.video[0].frames
+        duration = container.streams.video[0].duration
+        if duration is None and orig_duration is not None:
+           duration = orig_duration / tb
 
     if duration is None:
         # If failed to fetch the decoding information, decode the entire video.
         decode_all_video = True
         video_start_pts, video_end_pts = 0, math.inf
+        _count("full_decodes")
     else:
         # Perform selective decoding.
         decode_all_video = False
@@ -286,6 +589,38 @@ def pyav_decode(
     frames = None
     # If video stream was found, fetch video frames from the video.
     if container.streams.video:
+        if sparse and start is None and end is None:
+            clip_sz = sampling_rate * num_frames / target_fps * fps
+            video_frames = pyav_decode_stream_sparse(
+                container,
+                video_start_pts,
+                video_end_pts,
+                container.streams.video[0],
+                {"video": 0},
+                lambda num_decoded: get_temporal_sample_index(
+                    num_decoded,
+                    clip_sz,
+                    num_frames,
+                    clip_idx,
+                    num_clips,
+                    decode_all_video,
+                ),
+                keyframe_pts=keyframe_pts,
+            )
+            container.close()
+            if len(video_frames) == 0:
+                return None, fps, decode_all_video
+            # Convert every sampled frame once, a frame may be sampled twice.
+            rgb = {}
+            for frame in video_frames:
+                if frame.pts not in rgb:
+                    rgb[frame.pts] = frame_to_ndarray(
+                        frame, max_spatial_scale
+                    )
+            frames = torch.as_tensor(
+                np.stack([rgb[frame.pts] for frame in video_frames])
+            )
+            return frames, fps, decode_all_video
         if start is None and end is None:
             video_frames, max_pts = pyav_decode_stream(
                 container,
@@ -293,6 +628,7 @@ def pyav_decode(
                 video_end_pts,
                 container.streams.video[0],
                 {"video": 0},
+                keyframe_pts=keyframe_pts,
             )
         else:
             timebase = duration / frames_length
@@ -307,7 +643,9 @@ def pyav_decode(
             )
         container.close()
 
-        frames = [frame.to_rgb().to_ndarray() for frame in video_frames]
+        frames = [
+            frame_to_ndarray(frame, max_spatial_scale) for frame in video_frames
+        ]
         frames = torch.as_tensor(np.stack(frames))
 
     return frames, fps, decode_all_video
@@ -327,6 +665,7 @@ def decode(
     end=None,
     duration=None,
     frames_length=None,
+    sparse=False,
 ):
     """
     Decode the video and perform temporal sampling.
@@ -342,19 +681,25 @@ def decode(
         num_clips (int): overall number of clips to uniformly
             sample from the given video.
         video_meta (dict): a dict contains VideoMetaData. Details can be find
-            at `pytorch/vision/torchvision/io/_video_opt.py`.
+            at `pytorch/vision/torchvision/io/_video_opt.py` for the
+            `torchvision` backend, and in `pyav_decode` for the `pyav` backend.
         target_fps (int): the input video may have different fps, convert it to
             the target video fps before frame sampling.
         backend (str): decoding backend includes `pyav` and `torchvision`. The
             default one is `pyav`.
         max_spatial_scale (int): keep the aspect ratio and resize the frame so
-            that shorter edge size is max_spatial_scale. Only used in
-            `torchvision` backend.
+            that shorter edge size is max_spatial_scale. The `pyav` backend
+            only resizes frames whose shorter edge is larger.
+        sparse (bool): if True, only convert to RGB the frames kept by the
+            temporal sampling. Only used in `pyav` backend, the frames are the
+            same as with the default decoding.
     Returns:
         frames (tensor): decoded frames from the video.
     """
     # Currently support two decoders: 1) PyAV, and 2) TorchVision.
     assert clip_idx >= -1, "Not valied clip_idx {}".format(clip_idx)
+    # The sparse pyav decoding returns the temporally sampled frames.
+    sampled = sparse and backend == "pyav" and start is None and end is None
     try:
         if backend == "pyav":
             frames, fps, decode_all_video = pyav_decode(
@@ -368,6 +713,9 @@ def decode(
                 end,
                 duration,
                 frames_length,
+                video_meta,
+                sparse,
+                max_spatial_scale,
             )
         elif backend == "torchvision":
             frames, fps, decode_all_video = torchvision_decode(
@@ -393,22 +741,123 @@ def decode(
     if frames is None or frames.size(0) == 0:
         return None
 
-    clip_sz = sampling_rate * num_frames / target_fps * fps
-    start_idx, end_idx = get_start_end_idx(
-        frames.shape[0],
-        clip_sz,
-        clip_idx if decode_all_video else 0,
-        num_clips if decode_all_video else 1,
-    )
-    # Perform temporal sampling from the decoded video.
-    if frames.size(0) < num_frames:
-        repeat_time = math.ceil(num_frames / frames.size(0))
-        frames = frames.repeat(repeat_time, 1, 1, 1)
-        start_idx = 0
-        end_idx = frames.size(0) - 1
-    elif frames.size(0) - 1 < clip_sz:
-        start_idx = 0
-        end_idx = frames.size(0) - 1
-    
-    frames = temporal_sampling(frames, start_idx, end_idx, num_frames)
+    if not sampled:
+        # Perform temporal sampling from the decoded video.
+        clip_sz = sampling_rate * num_frames / target_fps * fps
+        index = get_temporal_sample_index(
+            frames.size(0),
+            clip_sz,
+            num_frames,
+            clip_idx,
+            num_clips,
+            decode_all_video,
+        )
+        frames = torch.index_select(frames, 0, index)
+    _count("used_frames", num_frames)
     return frames
+
+
+def get_window_indices(num_decoded, clip_sz, num_frames, num_windows):
+    """
+    Compute the indices of the frames of num_windows clips sampled from the
+    entire decoded video. The video is split in num_windows segments of equal
+    size and the start of every clip is randomly sampled in its segment.
+    Args:
+        num_decoded (int): number of decoded frames.
+        clip_sz (float): size of a clip in decoded frames.
+        num_frames (int): number of frames to sample for every clip.
+        num_windows (int): number of clips to sample.
+    Returns:
+        indices (list): indices into the decoded frames of the frames of
+            every clip.
+    """
+    # A fractional clip index places the clip randomly in its segment.
+    return [
+        get_temporal_sample_index(
+            num_decoded,
+            clip_sz,
+            num_frames,
+            window + random.random(),
+            num_windows,
+            True,
+        )
+        for window in range(num_windows)
+    ]
+
+
+def decode_windows(
+    container,
+    sampling_rate,
+    num_frames,
+    num_windows,
+    video_meta=None,
+    target_fps=30,
+    backend="pyav",
+    max_spatial_scale=0,
+):
+    """
+    Decode the entire video once and sample num_windows clips from it. The
+    video is split in num_windows segments of equal size and the start of
+    every clip is randomly sampled in its segment, so the clips are different
+    temporal windows if the video is longer than a clip.
+    Args:
+        container (container): pyav container.
+        sampling_rate (int): frame sampling rate (interval between two sampled
+            frames).
+        num_frames (int): number of frames to sample for every clip.
+        num_windows (int): number of clips to sample.
+        video_meta (dict): the stream information recorded by
+            tools/scan_h5.py, see `pyav_decode`.
+        target_fps (int): the input video may have different fps, convert it to
+            the target video fps before frame sampling.
+        backend (str): decoding backend, only `pyav` is supported.
+        max_spatial_scale (int): if larger than 0 and smaller than the shorter
+            edge of the video, resize the frames so that the shorter edge is
+            max_spatial_scale.
+    Returns:
+        clips (list): the frames of every clip. None if the video was not
+            decoded successfully.
+    """
+    if backend != "pyav":
+        raise NotImplementedError(
+            "Decoding several windows is not supported by the {} "
+            "backend".format(backend)
+        )
+    try:
+        if video_meta is not None and "keyframe_pts" in video_meta:
+            fps = video_meta["fps"]
+            keyframe_pts = video_meta["keyframe_pts"]
+        else:
+            fps = float(container.streams.video[0].average_rate)
+            keyframe_pts = None
+        video_frames, _ = pyav_decode_stream(
+            container,
+            0,
+            math.inf,
+            container.streams.video[0],
+            {"video": 0},
+            keyframe_pts=keyframe_pts,
+        )
+        container.close()
+        _count("full_decodes")
+    except Exception as e:
+        print("Failed to decode by {} with exception: {}".format(backend, e))
+        return None
+
+    if len(video_frames) == 0:
+        return None
+    frames = torch.as_tensor(
+        np.stack(
+            [frame_to_ndarray(frame, max_spatial_scale) for frame in video_frames]
+        )
+    )
+
+    clip_sz = sampling_rate * num_frames / target_fps * fps
+    clips = [
+        torch.index_select(frames, 0, index)
+        for index in get_window_indices(
+            frames.size(0), clip_sz, num_frames, num_windows
+        )
+    ]
+    _count("used_frames", num_frames * num_windows)
+    return clips
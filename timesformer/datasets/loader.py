@@ -4,10 +4,12 @@
 
 import itertools
 import numpy as np
+import queue
+import threading
 import torch
 from torch.utils.data._utils.collate import default_collate
 from torch.utils.data.distributed import DistributedSampler
-from torch.utils.data.sampler import RandomSampler
+from torch.utils.data.sampler import BatchSampler, RandomSampler
 
 from timesformer.datasets.multigrid_helper import ShortCycleBatchSampler
 
@@ -52,6 +54,78 @@ def detection_collate(batch):
     return inputs, labels, video_idx, collated_extra_data
 
 
+def multi_view_collate(batch):
+    """
+    Collate function for the decode once test mode, where every sample holds
+    the spatial crops of one temporal window. The crops are flattened in the
+    batch dimension, each with its label and clip index, so that the batch is
+    the same as in the default test mode.
+    Args:
+        batch (tuple or list): data batch to collate.
+    Returns:
+        (tuple): collated multi-view data batch.
+    """
+    inputs, labels, clip_ids, extra_data = zip(*batch)
+    inputs = default_collate([clip for clips in inputs for clip in clips])
+    labels = default_collate(
+        [label for label, ids in zip(labels, clip_ids) for _ in ids]
+    )
+    clip_ids = default_collate([idx for ids in clip_ids for idx in ids])
+    extra_data = default_collate(extra_data)
+    return inputs, labels, clip_ids, extra_data
+
+
+def repeated_clips_collate(batch):
+    """
+    Collate function for the repeated augmentation, where every sample holds
+    the clips of one training video. The clips are flattened in the batch
+    dimension, each with the label and index of its video.
+    Args:
+        batch (tuple or list): data batch to collate.
+    Returns:
+        (tuple): collated repeated clips data batch.
+    """
+    inputs, labels, video_idx, extra_data = zip(*batch)
+    num_clips = [len(clips) for clips in inputs]
+    inputs = default_collate([clip for clips in inputs for clip in clips])
+    labels = default_collate(
+        [label for label, num in zip(labels, num_clips) for _ in range(num)]
+    )
+    video_idx = default_collate(
+        [idx for idx, num in zip(video_idx, num_clips) for _ in range(num)]
+    )
+    extra_data = default_collate(extra_data)
+    return inputs, labels, video_idx, extra_data
+
+
+class RepeatedClipsBatchSampler(BatchSampler):
+    """
+    Batch sampler for the repeated augmentation, where every sample holds
+    num_clips clips of a video. A batch of batch_size clips holds
+    batch_size // num_clips videos, so the batch size in clips is unchanged,
+    and an epoch still visits every video of the sampler once, i.e. the shard
+    of the process with a DistributedSampler.
+    """
+
+    def __init__(self, sampler, batch_size, num_clips, drop_last):
+        """
+        Args:
+            sampler (Sampler): sampler of the videos.
+            batch_size (int): number of clips in a batch.
+            num_clips (int): number of clips of every video.
+            drop_last (bool): if True, drop the last incomplete batch.
+        """
+        if batch_size % num_clips != 0:
+            raise ValueError(
+                "batch_size should be a multiple of num_clips, but got "
+                "batch_size={} and num_clips={}".format(batch_size, num_clips)
+            )
+        super(RepeatedClipsBatchSampler, self).__init__(
+            sampler, batch_size // num_clips, drop_last
+        )
+        self.num_clips = num_clips
+
+
 def construct_loader(cfg, split, is_precise_bn=False):
     """
     Constructs the data loader for the given dataset.
@@ -78,10 +152,21 @@ def construct_loader(cfg, split, is_precise_bn=False):
         batch_size = int(cfg.TEST.BATCH_SIZE / max(1, cfg.NUM_GPUS))
         shuffle = False
         drop_last = False
+        if cfg.TEST.DECODE_ONCE:
+            # Every sample holds NUM_SPATIAL_CROPS clips.
+            batch_size = max(1, batch_size // cfg.TEST.NUM_SPATIAL_CROPS)
 
     # Construct the dataset
     dataset = build_dataset(dataset_name, cfg, split)
 
+    # Keep the workers alive across epochs, with their prefetch depth.
+    worker_kwargs = {}
+    if cfg.DATA_LOADER.NUM_WORKERS > 0:
+        worker_kwargs = {
+            "persistent_workers": cfg.DATA_LOADER.PERSISTENT_WORKERS,
+            "prefetch_factor": cfg.DATA_LOADER.PREFETCH_FACTOR,
+        }
+
     if cfg.MULTIGRID.SHORT_CYCLE and split in ["train"] and not is_precise_bn:
         # Create a sampler for multi-process training
         sampler = utils.create_sampler(dataset, shuffle, cfg)
@@ -94,11 +179,39 @@ def construct_loader(cfg, split, is_precise_bn=False):
             batch_sampler=batch_sampler,
             num_workers=cfg.DATA_LOADER.NUM_WORKERS,
             pin_memory=cfg.DATA_LOADER.PIN_MEMORY,
-            worker_init_fn=utils.loader_worker_init_fn(dataset),
+            worker_init_fn=utils.loader_worker_init_fn(dataset, cfg),
+            **worker_kwargs,
+        )
+    elif split in ["train"] and cfg.DATA.NUM_REPEATED_CLIPS > 1:
+        # Every video is decoded once for DATA.NUM_REPEATED_CLIPS clips.
+        sampler = utils.create_sampler(dataset, shuffle, cfg)
+        if sampler is None:
+            sampler = RandomSampler(dataset)
+        batch_sampler = RepeatedClipsBatchSampler(
+            sampler,
+            batch_size=batch_size,
+            num_clips=cfg.DATA.NUM_REPEATED_CLIPS,
+            drop_last=drop_last,
+        )
+        # Create a loader
+        loader = torch.utils.data.DataLoader(
+            dataset,
+            batch_sampler=batch_sampler,
+            num_workers=cfg.DATA_LOADER.NUM_WORKERS,
+            pin_memory=cfg.DATA_LOADER.PIN_MEMORY,
+            collate_fn=repeated_clips_collate,
+            worker_init_fn=utils.loader_worker_init_fn(dataset, cfg),
+            **worker_kwargs,
         )
     else:
         # Create a sampler for multi-process training
         sampler = utils.create_sampler(dataset, shuffle, cfg)
+        if cfg.DETECTION.ENABLE:
+            collate_fn = detection_collate
+        elif split.startswith("test") and cfg.TEST.DECODE_ONCE:
+            collate_fn = multi_view_collate
+        else:
+            collate_fn = None
         # Create a loader
         loader = torch.utils.data.DataLoader(
             dataset,
@@ -108,12 +221,144 @@ def construct_loader(cfg, split, is_precise_bn=False):
             num_workers=cfg.DATA_LOADER.NUM_WORKERS,
             pin_memory=cfg.DATA_LOADER.PIN_MEMORY,
             drop_last=drop_last,
-            collate_fn=detection_collate if cfg.DETECTION.ENABLE else None,
-            worker_init_fn=utils.loader_worker_init_fn(dataset),
+            collate_fn=collate_fn,
+            worker_init_fn=utils.loader_worker_init_fn(dataset, cfg),
+            **worker_kwargs,
         )
     return loader
 
 
+def to_device(data):
+    """
+    Transfer a data batch to the current GPU device. Tensors are copied
+    asynchronously from pinned memory, and are found in nested lists, tuples
+    and dicts, such as the list inputs of multi-pathway models and the meta
+    dict.
+    Args:
+        data (tensor, list, tuple or dict): data batch to transfer.
+    Returns:
+        data (tensor, list, tuple or dict): the data batch on the device.
+    """
+    if torch.is_tensor(data):
+        return data.cuda(non_blocking=True)
+    if isinstance(data, dict):
+        return {key: to_device(val) for key, val in data.items()}
+    if isinstance(data, (list, tuple)):
+        return type(data)(to_device(val) for val in data)
+    return data
+
+
+def _record_stream(data, stream):
+    """
+    Mark the tensors of a data batch as used by a stream, so that the caching
+    allocator does not reuse their memory before the stream is done with them.
+    Args:
+        data (tensor, list, tuple or dict): data batch.
+        stream (torch.cuda.Stream): the stream using the batch.
+    """
+    if torch.is_tensor(data):
+        data.record_stream(stream)
+    elif isinstance(data, dict):
+        for val in data.values():
+            _record_stream(val, stream)
+    elif isinstance(data, (list, tuple)):
+        for val in data:
+            _record_stream(val, stream)
+
+
+class DevicePrefetcher(object):
+    """
+    Iterate over a data loader with the batches transferred to the current
+    GPU device. If DATA_LOADER.ENABLE_DEVICE_PREFETCH is set, the batch N+1 is
+    staged while the batch N is computed: on GPU it is fetched and its copy is
+    issued on a side stream before the batch N is returned, and on CPU it is
+    fetched from the loader on a background thread. Otherwise the batches are
+    transferred synchronously when they are dequeued.
+    """
+
+    def __init__(self, loader, cfg):
+        """
+        Args:
+            loader (loader): the data loader to iterate over.
+            cfg (CfgNode): configs. Details can be found in
+                slowfast/config/defaults.py
+        """
+        self.loader = loader
+        self._use_gpu = cfg.NUM_GPUS > 0
+        self._prefetch = cfg.DATA_LOADER.ENABLE_DEVICE_PREFETCH
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        if not self._prefetch:
+            return (
+                to_device(batch) if self._use_gpu else batch
+                for batch in self.loader
+            )
+        if self._use_gpu:
+            return self._iter_stream()
+        return self._iter_thread()
+
+    def _iter_stream(self):
+        stream = torch.cuda.Stream()
+        loader_iter = iter(self.loader)
+
+        def preload():
+            batch = next(loader_iter, None)
+            if batch is not None:
+                with torch.cuda.stream(stream):
+                    batch = to_device(batch)
+            return batch
+
+        next_batch = preload()
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream()
+            current_stream.wait_stream(stream)
+            batch = next_batch
+            _record_stream(batch, current_stream)
+            next_batch = preload()
+            yield batch
+
+    def _iter_thread(self):
+        batches = queue.Queue(maxsize=1)
+        stop = threading.Event()
+        end = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def fetch():
+            try:
+                for batch in self.loader:
+                    if not put(batch):
+                        return
+            except Exception as e:
+                put(e)
+                return
+            put(end)
+
+        thread = threading.Thread(target=fetch, daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch = batches.get()
+                if batch is end:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
+
+
 def shuffle_dataset(loader, cur_epoch):
     """ "
     Shuffles the data.
@@ -123,7 +368,10 @@ def shuffle_dataset(loader, cur_epoch):
     """
     sampler = (
         loader.batch_sampler.sampler
-        if isinstance(loader.batch_sampler, ShortCycleBatchSampler)
+        if isinstance(
+            loader.batch_sampler,
+            (ShortCycleBatchSampler, RepeatedClipsBatchSampler),
+        )
         else loader.sampler
     )
     assert isinstance(
@@ -1,3 +1,4 @@
+import numpy as np
 import os
 import random
 import torch
@@ -10,7 +11,7 @@ from . import decoder as decoder
 from . import utils as utils
 from . import video_container as container
 from .build import DATASET_REGISTRY
-from tools.load_h5 import load_h5_file
+import tools.load_h5 as load_h5
 logger = logging.get_logger(__name__)
 
 
@@ -24,6 +25,7 @@ class Mpii(torch.utils.data.Dataset):
         self.mode = mode
         self.cfg = cfg
 
+        # Per-video decoding meta, keyed by path id and filled in lazily.
         self._video_meta = {}
         self._num_retries = num_retries
 
@@ -33,30 +35,243 @@ class Mpii(torch.utils.data.Dataset):
             self._num_clips = (
                 cfg.TEST.NUM_ENSEMBLE_VIEWS * cfg.TEST.NUM_SPATIAL_CROPS
             )
+        # In decode once mode, an item is a temporal window of a test video
+        # and holds all its spatial crops.
+        self._decode_once = self.mode.startswith("test") and cfg.TEST.DECODE_ONCE
+        if self._decode_once:
+            self._num_clips = cfg.TEST.NUM_ENSEMBLE_VIEWS
+        # With repeated augmentation, an item is a training video decoded
+        # once and holds DATA.NUM_REPEATED_CLIPS clips sampled from it.
+        self._num_repeated_clips = (
+            cfg.DATA.NUM_REPEATED_CLIPS if self.mode == "train" else 1
+        )
+        # With motion energy frame selection, the candidate frames are
+        # decoded and the model selects DATA.NUM_FRAMES of them.
+        self._num_frames = cfg.DATA.NUM_CANDIDATE_FRAMES or cfg.DATA.NUM_FRAMES
         logger.info(f"Constructing MPII, mode: {mode}")
         self._construct_loader()
 
     def _construct_loader(self):
-        csv = load_h5_file(self.cfg.DATA.PATH_TO_DATA_DIR, f"{self.mode}.csv")
+        csv = load_h5.load_h5_file(self.cfg.DATA.PATH_TO_DATA_DIR, f"{self.mode}.csv")
 
-        self._path_to_videos = []
-        self._labels = []
-        self._spatial_temporal_idx = []
-        for clip_idx, path_label in enumerate(csv.split("\n")):
+        # The index is kept in numpy arrays instead of python lists so that
+        # reading it from forked loader workers does not touch refcounts and
+        # copy the pages on write. Each video path is stored once in
+        # `_path_table`, items refer to it through `_path_ids`.
+        paths = []
+        labels = []
+        for path_label in csv.split("\n"):
             if path_label == "": continue
             path = " ".join(path_label.split(" ")[:-1])
             label = path_label.split(" ")[-1]
-            for idx in range(self._num_clips):
-                self._path_to_videos.append(os.path.join(self.cfg.DATA.PATH_PREFIX, path))
-                self._labels.append(int(label))
-                self._spatial_temporal_idx.append(idx)
-                self._video_meta[clip_idx * self._num_clips + idx] = {}
+            paths.append(
+                os.path.join(self.cfg.DATA.PATH_PREFIX, path).encode("utf-8")
+            )
+            labels.append(int(label))
+        self._path_table = np.array(paths, dtype=np.bytes_)
+        self._path_ids = np.repeat(
+            np.arange(len(paths), dtype=np.int32), self._num_clips
+        )
+        self._labels = np.repeat(
+            np.array(labels, dtype=np.int32), self._num_clips
+        )
+        self._spatial_temporal_idx = np.tile(
+            np.arange(self._num_clips, dtype=np.int32), len(paths)
+        )
+        # Do not keep the h5 file open in the parent of the loader workers.
+        load_h5.close_h5_handles()
         logger.info(
             "Constructing MPII dataloader (size: {}) from h5 file".format(
-                len(self._path_to_videos)
+                len(self._path_ids)
             )
         )
 
+    def _get_path(self, index):
+        """
+        Return the path to the video of the given item.
+        """
+        return self._path_table[self._path_ids[index]].decode("utf-8")
+
+    def _get_video_meta(self, index):
+        """
+        Return the decoding meta of the video of the given item. For the
+        `pyav` backend, it is the stream information and keyframe index
+        recorded by tools/scan_h5.py, empty if the dataset was not scanned.
+        For the `torchvision` backend, it is filled in by the decoder.
+        """
+        path_id = int(self._path_ids[index])
+        if path_id not in self._video_meta:
+            video_meta = {}
+            if self.cfg.DATA.DECODING_BACKEND == "pyav":
+                video_meta = load_h5.load_h5_video_meta(
+                    self.cfg.DATA.PATH_TO_DATA_DIR, self._get_path(index)
+                )
+            self._video_meta[path_id] = video_meta
+        return self._video_meta[path_id]
+
+    def _get_clip_sampling(self, sampling_rate):
+        """
+        Get the number of frames of a clip and their sampling rate. The
+        candidate frames of the motion energy frame selection span the same
+        temporal window as DATA.NUM_FRAMES frames.
+        Args:
+            sampling_rate (int): frame sampling rate of DATA.NUM_FRAMES frames.
+        Returns:
+            sampling_rate (int or float): frame sampling rate of the clip.
+            num_frames (int): number of frames of the clip.
+        """
+        if self._num_frames != self.cfg.DATA.NUM_FRAMES:
+            sampling_rate = (
+                sampling_rate * self.cfg.DATA.NUM_FRAMES / self._num_frames
+            )
+        return sampling_rate, self._num_frames
+
+    def _load_frames(
+        self,
+        index,
+        sampling_rate,
+        temporal_sample_index,
+        min_scale,
+        max_scale,
+        i_try,
+    ):
+        """
+        Load the video of the given item and temporally sample a clip from it,
+        or with repeated augmentation DATA.NUM_REPEATED_CLIPS clips.
+        Args:
+            index (int): the item index.
+            sampling_rate (int): frame sampling rate.
+            temporal_sample_index (int): -1 for random temporal sampling,
+                otherwise the index of the uniformly sampled clip.
+            min_scale (int): the minimal size of spatial scaling.
+            max_scale (int): the maximal size of spatial scaling.
+            i_try (int): index of the current trial, used for logging.
+        Returns:
+            frames (tensor or list): the sampled frames, `num frames` x
+                `height` x `width` x `channel` uint8, or the list of the
+                frames of every clip with repeated augmentation. None if the
+                video can not be accessed or decoded.
+        """
+        video_container = None
+        try:
+            # try to fetch the video from h5 file
+            video_container = container.get_video_container(
+                self._get_path(index),
+                self.cfg.DATA.PATH_TO_DATA_DIR,
+                self.cfg.DATA_LOADER.ENABLE_MULTI_THREAD_DECODE,
+                self.cfg.DATA.DECODING_BACKEND,
+                self.cfg.DATA_LOADER.ENABLE_H5_MMAP,
+                self.cfg.DATA_LOADER.WORKER_NUM_THREADS,
+            )
+        except Exception as e:
+            logger.info(
+                "Failed to load video from {} with error {}".format(
+                    self._get_path(index), e
+                )
+            )
+        if video_container is None:
+            logger.warning(
+                "Failed to meta load video idx {} from {}; trial {}".format(
+                    index, self._get_path(index), i_try
+                )
+            )
+            return None
+
+        if self.cfg.DATA.DECODING_BACKEND == "pyav":
+            # The frames are never resized below the largest scale of the
+            # spatial sampling.
+            max_spatial_scale = (
+                min(self.cfg.DATA_LOADER.DECODE_SHORT_SIDE, max_scale)
+                if self.cfg.DATA_LOADER.DECODE_SHORT_SIDE > 0
+                else 0
+            )
+        else:
+            max_spatial_scale = min_scale
+
+        # Decode video. Meta info is used to perform selective decoding.
+        sampling_rate, num_frames = self._get_clip_sampling(sampling_rate)
+        if self._num_repeated_clips > 1:
+            frames = decoder.decode_windows(
+                video_container,
+                sampling_rate,
+                num_frames,
+                self._num_repeated_clips,
+                video_meta=self._get_video_meta(index),
+                target_fps=self.cfg.DATA.TARGET_FPS,
+                backend=self.cfg.DATA.DECODING_BACKEND,
+                max_spatial_scale=max_spatial_scale,
+            )
+        else:
+            frames = decoder.decode(
+                video_container,
+                sampling_rate,
+                num_frames,
+                temporal_sample_index,
+                self.cfg.TEST.NUM_ENSEMBLE_VIEWS,
+                video_meta=self._get_video_meta(index),
+                target_fps=self.cfg.DATA.TARGET_FPS,
+                backend=self.cfg.DATA.DECODING_BACKEND,
+                max_spatial_scale=max_spatial_scale,
+                sparse=self.cfg.DATA_LOADER.ENABLE_SPARSE_DECODE,
+            )
+        if frames is None:
+            logger.warning(
+                "Failed to decode video idx {} from {}; trial {}".format(
+                    index, self._get_path(index), i_try
+                )
+            )
+        return frames
+
+    def _spatial_sample(
+        self, frames, spatial_sample_index, min_scale, max_scale, crop_size
+    ):
+        """
+        Perform the spatial sampling of a clip and build the model input.
+        Args:
+            frames (tensor): normalized frames, or uint8 frames if
+                DATA.NORMALIZE_ON_DEVICE, `channel` x `num frames` x
+                `height` x `width`.
+            spatial_sample_index (int): -1 for random spatial sampling,
+                otherwise the index of the uniform crop.
+            min_scale (int): the minimal size of spatial scaling.
+            max_scale (int): the maximal size of spatial scaling.
+            crop_size (int): the size of the crop.
+        Returns:
+            frames (tensor or list): the model input of the clip.
+        """
+        uint8_input = frames.dtype == torch.uint8
+        if uint8_input and not self.cfg.DATA.CROP_THEN_RESIZE:
+            # Scaling interpolates in float, the clip goes back to uint8 once
+            # cropped.
+            frames = frames.float()
+        # Perform data augmentation.
+        frames = utils.spatial_sampling(
+            frames,
+            spatial_idx=spatial_sample_index,
+            min_scale=min_scale,
+            max_scale=max_scale,
+            crop_size=crop_size,
+            random_horizontal_flip=self.cfg.DATA.RANDOM_FLIP,
+            inverse_uniform_sampling=self.cfg.DATA.INV_UNIFORM_SAMPLE,
+            crop_then_resize=self.cfg.DATA.CROP_THEN_RESIZE,
+        )
+        if uint8_input and frames.dtype != torch.uint8:
+            frames = frames.round_().clamp_(0, 255).to(torch.uint8)
+
+
+        if not self.cfg.MODEL.ARCH in ['vit']:
+            frames = utils.pack_pathway_output(self.cfg, frames)
+        else:
+            # Perform temporal sampling from the fast pathway.
+            frames = torch.index_select(
+                 frames,
+                 1,
+                 torch.linspace(
+                     0, frames.shape[1] - 1, self._num_frames
+
+                 ).long(),
+            )
+        return frames
 
     def __getitem__(self, index):
         short_cycle_idx = None
@@ -85,8 +300,21 @@ class Mpii(torch.utils.data.Dataset):
                         / self.cfg.MULTIGRID.DEFAULT_S
                     )
                 )
+        elif self._decode_once:
+            temporal_sample_index = int(self._spatial_temporal_idx[index])
+            spatial_sample_index = (
+                list(range(self.cfg.TEST.NUM_SPATIAL_CROPS))
+                if self.cfg.TEST.NUM_SPATIAL_CROPS > 1
+                else [1]
+            )
+            min_scale, max_scale, crop_size = (
+                [self.cfg.DATA.TEST_CROP_SIZE] * 3
+                if self.cfg.TEST.NUM_SPATIAL_CROPS > 1
+                else [self.cfg.DATA.TRAIN_JITTER_SCALES[0]] * 2
+                + [self.cfg.DATA.TEST_CROP_SIZE]
+            )
         elif self.mode.startswith("test"):
-            temporal_sample_index = (
+            temporal_sample_index = int(
                 self._spatial_temporal_idx[index]
                 // self.cfg.TEST.NUM_SPATIAL_CROPS
             )
@@ -94,7 +322,7 @@ class Mpii(torch.utils.data.Dataset):
             # center, or right if width is larger than height, and top, middle,
             # or bottom if height is larger than width.
             spatial_sample_index = (
-                (
+                int(
                     self._spatial_temporal_idx[index]
                     % self.cfg.TEST.NUM_SPATIAL_CROPS
                 )
@@ -121,94 +349,71 @@ class Mpii(torch.utils.data.Dataset):
         # Try to decode and sample a clip from a video. If the video can not be
         # decoded, repeatly find a random video replacement that can be decoded.
         for i_try in range(self._num_retries):
-            video_container = None
-            try:
-                # try to fetch the video from h5 file
-                video_container = container.get_video_container(
-                    self._path_to_videos[index],
-                    self.cfg.DATA.PATH_TO_DATA_DIR,
-                    self.cfg.DATA_LOADER.ENABLE_MULTI_THREAD_DECODE,
-                    self.cfg.DATA.DECODING_BACKEND,
-                )
-            except Exception as e:
-                logger.info(
-                    "Failed to load video from {} with error {}".format(
-                        self._path_to_videos[index], e
-                    )
-                )
-            # Select a random video if the current video was not able to access.
-            if video_container is None:
-                logger.warning(
-                    "Failed to meta load video idx {} from {}; trial {}".format(
-                        index, self._path_to_videos[index], i_try
-                    )
-                )
-                if self.mode not in ["test"] and i_try > self._num_retries // 2:
-                    # let's try another one
-                    index = random.randint(0, len(self._path_to_videos) - 1)
-                continue
-
-            # Decode video. Meta info is used to perform selective decoding.
-            frames = decoder.decode(
-                video_container,
+            frames = self._load_frames(
+                index,
                 sampling_rate,
-                self.cfg.DATA.NUM_FRAMES,
                 temporal_sample_index,
-                self.cfg.TEST.NUM_ENSEMBLE_VIEWS,
-                video_meta=self._video_meta[index],
-                target_fps=self.cfg.DATA.TARGET_FPS,
-                backend=self.cfg.DATA.DECODING_BACKEND,
-                max_spatial_scale=min_scale,
+                min_scale,
+                max_scale,
+                i_try,
             )
 
-            # If decoding failed (wrong format, video is too short, and etc),
-            # select another video.
+            # If the video can not be accessed or decoded (wrong format, video
+            # is too short, and etc), select another video.
             if frames is None:
-                logger.warning(
-                    "Failed to decode video idx {} from {}; trial {}".format(
-                        index, self._path_to_videos[index], i_try
-                    )
-                )
                 if self.mode not in ["test"] and i_try > self._num_retries // 2:
                     # let's try another one
-                    index = random.randint(0, len(self._path_to_videos) - 1)
+                    index = random.randint(0, len(self._path_ids) - 1)
                 continue
 
+            label = int(self._labels[index])
 
-            label = self._labels[index]
+            if self._num_repeated_clips > 1:
+                # Augment every clip independently, the clips are flattened in
+                # the batch by `loader.repeated_clips_collate`.
+                clips = []
+                for clip in frames:
+                    if not self.cfg.DATA.NORMALIZE_ON_DEVICE:
+                        clip = utils.tensor_normalize(
+                            clip, self.cfg.DATA.MEAN, self.cfg.DATA.STD
+                        )
+                    clips.append(
+                        self._spatial_sample(
+                            clip.permute(3, 0, 1, 2),
+                            spatial_sample_index,
+                            min_scale,
+                            max_scale,
+                            crop_size,
+                        )
+                    )
+                return clips, label, index, {}
 
-            # Perform color normalization.
-            frames = utils.tensor_normalize(
-                frames, self.cfg.DATA.MEAN, self.cfg.DATA.STD
-            )
+            if not self.cfg.DATA.NORMALIZE_ON_DEVICE:
+                # Perform color normalization.
+                frames = utils.tensor_normalize(
+                    frames, self.cfg.DATA.MEAN, self.cfg.DATA.STD
+                )
 
             # T H W C -> C T H W.
             frames = frames.permute(3, 0, 1, 2)
-            # Perform data augmentation.
-            frames = utils.spatial_sampling(
-                frames,
-                spatial_idx=spatial_sample_index,
-                min_scale=min_scale,
-                max_scale=max_scale,
-                crop_size=crop_size,
-                random_horizontal_flip=self.cfg.DATA.RANDOM_FLIP,
-                inverse_uniform_sampling=self.cfg.DATA.INV_UNIFORM_SAMPLE,
-            )
-
-
-            if not self.cfg.MODEL.ARCH in ['vit']:
-                frames = utils.pack_pathway_output(self.cfg, frames)
-            else:
-                # Perform temporal sampling from the fast pathway.
-                frames = torch.index_select(
-                     frames,
-                     1,
-                     torch.linspace(
-                         0, frames.shape[1] - 1, self.cfg.DATA.NUM_FRAMES
-
-                     ).long(),
-                )
+            if self._decode_once:
+                # Take every spatial crop from the same decoded window. The
+                # clip indices are the ones of the items of the default test
+                # mode, see `loader.multi_view_collate`.
+                clips = [
+                    self._spatial_sample(
+                        frames, spatial_idx, min_scale, max_scale, crop_size
+                    )
+                    for spatial_idx in spatial_sample_index
+                ]
+                clip_ids = [
+                    index * len(clips) + i for i in range(len(clips))
+                ]
+                return clips, label, clip_ids, {}
 
+            frames = self._spatial_sample(
+                frames, spatial_sample_index, min_scale, max_scale, crop_size
+            )
             return frames, label, index, {}
         else:
             raise RuntimeError(
@@ -218,4 +423,4 @@ class Mpii(torch.utils.data.Dataset):
             )
 
     def __len__(self):
-        return len(self._path_to_videos)
\ No newline at end of file
+        return len(self._path_ids)
\ No newline at end of file
@@ -0,0 +1,90 @@
+import torch
+
+import timesformer.utils.logging as logging
+import tools.load_h5 as load_h5
+
+from . import decoder as decoder
+from .build import DATASET_REGISTRY
+from .mpii import Mpii
+logger = logging.get_logger(__name__)
+
+
+@DATASET_REGISTRY.register()
+class Mpiiframes(Mpii):
+    """
+    MPII action recognition dataset read from a pre-decoded frame store
+    written by tools/convert_frames.py (`DATA.PATH_TO_DATA_DIR` points to the
+    frame store). The sampled frame indices are computed as the `pyav` decoder
+    would, and only those frames are read, so no video is decoded during
+    training. With a frame store written at the source resolution, the items
+    are identical to the ones of `Mpii`. With repeated clips, the frames of
+    every clip are sampled as `decoder.decode_windows` would, and read at once.
+    """
+
+    def _load_frames(
+        self,
+        index,
+        sampling_rate,
+        temporal_sample_index,
+        min_scale,
+        max_scale,
+        i_try,
+    ):
+        path = self._get_path(index)
+        sampling_rate, num_frames = self._get_clip_sampling(sampling_rate)
+        frames = None
+        try:
+            attrs = load_h5.get_h5_handle(self.cfg.DATA.PATH_TO_DATA_DIR)[
+                path
+            ].attrs
+            duration = int(attrs["duration"])
+            pts = load_h5.load_h5_frame_pts(self.cfg.DATA.PATH_TO_DATA_DIR, path)
+            if self._num_repeated_clips > 1:
+                clip_sz = (
+                    sampling_rate
+                    * num_frames
+                    / self.cfg.DATA.TARGET_FPS
+                    * float(attrs["fps"])
+                )
+                windows = decoder.get_window_indices(
+                    len(pts),
+                    clip_sz,
+                    num_frames,
+                    self._num_repeated_clips,
+                )
+                frames = torch.as_tensor(
+                    load_h5.load_h5_frames(
+                        self.cfg.DATA.PATH_TO_DATA_DIR,
+                        path,
+                        torch.cat(windows).numpy(),
+                    )
+                )
+                return list(frames.split(num_frames))
+            indices = decoder.get_pyav_frame_indices(
+                pts,
+                float(attrs["fps"]),
+                int(attrs["frames_length"]),
+                None if duration < 0 else duration,
+                sampling_rate,
+                num_frames,
+                temporal_sample_index,
+                self.cfg.TEST.NUM_ENSEMBLE_VIEWS,
+                target_fps=self.cfg.DATA.TARGET_FPS,
+            )
+            if indices is not None:
+                frames = torch.as_tensor(
+                    load_h5.load_h5_frames(
+                        self.cfg.DATA.PATH_TO_DATA_DIR, path, indices
+                    )
+                )
+        except Exception as e:
+            logger.info(
+                "Failed to load frames from {} with error {}".format(path, e)
+            )
+        if frames is None:
+            logger.warning(
+                "Failed to load frames of video idx {} from {}; trial {}".format(
+                    index, path, i_try
+                )
+            )
+        return frames
@@ -5,6 +5,31 @@ import numpy as np
 import torch
 
 
+def _sample_short_side(min_size, max_size, inverse_uniform_sampling=False):
+    """
+    Sample the short side size of the scale jittering.
+    """
+    if inverse_uniform_sampling:
+        return int(
+            round(1.0 / np.random.uniform(1.0 / max_size, 1.0 / min_size))
+        )
+    return int(round(np.random.uniform(min_size, max_size)))
+
+
+def _get_short_side_scale_size(height, width, size):
+    """
+    Return the height and width of frames scaled so that their short side is
+    size, keeping the aspect ratio.
+    """
+    if (width <= height and width == size) or (
+        height <= width and height == size
+    ):
+        return height, width
+    if width < height:
+        return int(math.floor((float(height) / width) * size)), size
+    return size, int(math.floor((float(width) / height) * size))
+
+
 def random_short_side_scale_jitter(
     images, min_size, max_size, boxes=None, inverse_uniform_sampling=False
 ):
@@ -27,12 +52,7 @@ def random_short_side_scale_jitter(
         (ndarray or None): the scaled boxes with dimension of
             `num boxes` x 4.
     """
-    if inverse_uniform_sampling:
-        size = int(
-            round(1.0 / np.random.uniform(1.0 / max_size, 1.0 / min_size))
-        )
-    else:
-        size = int(round(np.random.uniform(min_size, max_size)))
+    size = _sample_short_side(min_size, max_size, inverse_uniform_sampling)
 
     height = images.shape[2]
     width = images.shape[3]
@@ -40,15 +60,11 @@ def random_short_side_scale_jitter(
         height <= width and height == size
     ):
         return images, boxes
-    new_width = size
-    new_height = size
-    if width < height:
-        new_height = int(math.floor((float(height) / width) * size))
-        if boxes is not None:
+    new_height, new_width = _get_short_side_scale_size(height, width, size)
+    if boxes is not None:
+        if width < height:
             boxes = boxes * float(new_height) / height
-    else:
-        new_width = int(math.floor((float(width) / height) * size))
-        if boxes is not None:
+        else:
             boxes = boxes * float(new_width) / width
 
     return (
@@ -62,6 +78,142 @@ def random_short_side_scale_jitter(
     )
 
 
+def _source_coordinates(offset, out_size, in_size, scaled_size):
+    """
+    Return the source coordinates of the pixels offset to offset + out_size of
+    an axis of in_size pixels bilinearly resized to scaled_size pixels, as
+    `interpolate` with align_corners=False computes them.
+    """
+    scale = in_size / scaled_size
+    return (np.arange(offset, offset + out_size) + 0.5) * scale - 0.5
+
+
+def resized_crop(images, scaled_height, scaled_width, y_offset, x_offset, size):
+    """
+    Crop a size x size window at the given offsets of the images bilinearly
+    resized to scaled_height x scaled_width, interpolating only the pixels of
+    the window (as `roi_align` does). The result is the one of
+    `interpolate` (align_corners=False) followed by the crop, up to float
+    rounding.
+    Args:
+        images (tensor): images to perform the resized crop. The dimension is
+            `num frames` x `channel` x `height` x `width`.
+        scaled_height (int): height of the resized images.
+        scaled_width (int): width of the resized images.
+        y_offset (int): cropping offset in the y axis of the resized images.
+        x_offset (int): cropping offset in the x axis of the resized images.
+        size (int): the size of height and width of the crop.
+    Returns:
+        cropped (tensor): cropped images with dimension of
+            `num frames` x `channel` x `size` x `size`. Float unless no
+            resizing is needed.
+    """
+    height = images.shape[2]
+    width = images.shape[3]
+    if height == scaled_height and width == scaled_width:
+        return images[
+            :, :, y_offset : y_offset + size, x_offset : x_offset + size
+        ]
+    y = _source_coordinates(y_offset, size, height, scaled_height)
+    x = _source_coordinates(x_offset, size, width, scaled_width)
+    # Only read the source pixels the crop is interpolated from.
+    y_start = max(int(math.floor(y[0])), 0)
+    y_end = min(int(math.floor(y[-1])) + 2, height)
+    x_start = max(int(math.floor(x[0])), 0)
+    x_end = min(int(math.floor(x[-1])) + 2, width)
+    window = images[:, :, y_start:y_end, x_start:x_end]
+    if not window.is_floating_point():
+        window = window.float()
+
+    # Sampling grid in the normalized coordinates of the window. Coordinates
+    # out of the images are clamped to their border, as `interpolate` does.
+    grid = torch.empty(size, size, 2, dtype=window.dtype)
+    grid[..., 0] = torch.from_numpy(
+        (2 * (x - x_start) + 1) / (x_end - x_start) - 1
+    ).view(1, -1)
+    grid[..., 1] = torch.from_numpy(
+        (2 * (y - y_start) + 1) / (y_end - y_start) - 1
+    ).view(-1, 1)
+    return torch.nn.functional.grid_sample(
+        window,
+        grid.expand(window.shape[0], -1, -1, -1),
+        mode="bilinear",
+        padding_mode="border",
+        align_corners=False,
+    )
+
+
+def random_resized_crop(
+    images, min_size, max_size, crop_size, inverse_uniform_sampling=False
+):
+    """
+    Same as `random_short_side_scale_jitter` followed by `random_crop`, with
+    the same scale and crop distribution, but only the cropped window is
+    interpolated.
+    Args:
+        images (tensor): images to perform the scale jitter and crop. The
+            dimension is `num frames` x `channel` x `height` x `width`.
+        min_size (int): the minimal size to scale the frames.
+        max_size (int): the maximal size to scale the frames.
+        crop_size (int): the size of height and width of the crop.
+        inverse_uniform_sampling (bool): if True, sample uniformly in
+            [1 / max_scale, 1 / min_scale] and take a reciprocal to get the
+            scale. If False, take a uniform sample from [min_scale, max_scale].
+    Returns:
+        cropped (tensor): cropped images with dimension of
+            `num frames` x `channel` x `crop_size` x `crop_size`.
+    """
+    size = _sample_short_side(min_size, max_size, inverse_uniform_sampling)
+    height, width = _get_short_side_scale_size(
+        images.shape[2], images.shape[3], size
+    )
+    y_offset = 0
+    x_offset = 0
+    if height != crop_size or width != crop_size:
+        if height > crop_size:
+            y_offset = int(np.random.randint(0, height - crop_size))
+        if width > crop_size:
+            x_offset = int(np.random.randint(0, width - crop_size))
+    return resized_crop(images, height, width, y_offset, x_offset, crop_size)
+
+
+def uniform_resized_crop(images, min_size, max_size, crop_size, spatial_idx):
+    """
+    Same as `random_short_side_scale_jitter` followed by `uniform_crop`, but
+    only the cropped window is interpolated.
+    Args:
+        images (tensor): images to perform the scale and crop. The dimension
+            is `num frames` x `channel` x `height` x `width`.
+        min_size (int): the minimal size to scale the frames.
+        max_size (int): the maximal size to scale the frames.
+        crop_size (int): the size of height and width of the crop.
+        spatial_idx (int): 0, 1, or 2 for left, center, and right crop if width
+            is larger than height. Or 0, 1, or 2 for top, center, and bottom
+            crop if height is larger than width.
+    Returns:
+        cropped (tensor): cropped images with dimension of
+            `num frames` x `channel` x `crop_size` x `crop_size`.
+    """
+    assert spatial_idx in [0, 1, 2]
+    size = _sample_short_side(min_size, max_size)
+    height, width = _get_short_side_scale_size(
+        images.shape[2], images.shape[3], size
+    )
+    y_offset = int(math.ceil((height - crop_size) / 2))
+    x_offset = int(math.ceil((width - crop_size) / 2))
+    if height > width:
+        if spatial_idx == 0:
+            y_offset = 0
+        elif spatial_idx == 2:
+            y_offset = height - crop_size
+    else:
+        if spatial_idx == 0:
+            x_offset = 0
+        elif spatial_idx == 2:
+            x_offset = width - crop_size
+    return resized_crop(images, height, width, y_offset, x_offset, crop_size)
+
+
 def crop_boxes(boxes, x_offset, y_offset):
     """
     Peform crop on the bounding boxes given the offsets.
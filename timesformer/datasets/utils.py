@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import functools
 import logging
 import numpy as np
 import os
@@ -11,6 +12,9 @@ import torch
 from fvcore.common.file_io import PathManager
 from torch.utils.data.distributed import DistributedSampler
 
+import timesformer.utils.distributed as du
+import tools.load_h5 as load_h5
+
 from . import transform as transform
 
 logger = logging.getLogger(__name__)
@@ -114,6 +118,7 @@ def spatial_sampling(
     crop_size=224,
     random_horizontal_flip=True,
     inverse_uniform_sampling=False,
+    crop_then_resize=False,
 ):
     """
     Perform spatial sampling on the given video frames. If spatial_idx is
@@ -135,10 +140,29 @@ def spatial_sampling(
             [1 / max_scale, 1 / min_scale] and take a reciprocal to get the
             scale. If False, take a uniform sample from [min_scale,
             max_scale].
+        crop_then_resize (bool): if True, pick the crop window in the frames
+            and only interpolate it to crop_size, instead of scaling the whole
+            frames before cropping them. The scales and crops are the same.
     Returns:
         frames (tensor): spatially sampled frames.
     """
     assert spatial_idx in [-1, 0, 1, 2]
+    if crop_then_resize:
+        if spatial_idx == -1:
+            frames = transform.random_resized_crop(
+                frames,
+                min_scale,
+                max_scale,
+                crop_size,
+                inverse_uniform_sampling=inverse_uniform_sampling,
+            )
+            if random_horizontal_flip:
+                frames, _ = transform.horizontal_flip(0.5, frames)
+        else:
+            frames = transform.uniform_resized_crop(
+                frames, min_scale, max_scale, crop_size, spatial_idx
+            )
+        return frames
     if spatial_idx == -1:
         frames, _ = transform.random_short_side_scale_jitter(
             images=frames,
@@ -371,10 +395,67 @@ def create_sampler(dataset, shuffle, cfg):
     return sampler
 
 
-def loader_worker_init_fn(dataset):
+def _worker_init_fn(worker_id, num_threads=0, worker_cpus=None):
+    """
+    Initialize a data loader worker after fork.
+    Args:
+        worker_id (int): index of the worker.
+        num_threads (int): if larger than 0, number of intra-op threads of
+            torch and OpenCV.
+        worker_cpus (list): if not None, the CPUs of every worker.
+    """
+    # h5 handles must not be shared with the parent process, each worker
+    # lazily opens its own.
+    load_h5.reset_h5_handles()
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+        cv2.setNumThreads(num_threads)
+    if worker_cpus is not None:
+        os.sched_setaffinity(0, worker_cpus[worker_id])
+
+
+def _split_worker_cpus(num_workers, cfg):
+    """
+    Split the CPUs available to the current process between the training
+    processes of the machine, and the share of the current process between its
+    data loader workers. The workers share CPUs if there are fewer CPUs than
+    workers.
+    Args:
+        num_workers (int): number of data loader workers.
+        cfg (CfgNode): configs. Details can be found in
+            slowfast/config/defaults.py
+    Returns:
+        worker_cpus (list): the CPUs of every worker.
+    """
+    cpus = sorted(os.sched_getaffinity(0))
+    num_procs = max(1, cfg.NUM_GPUS)
+    if len(cpus) >= num_procs:
+        cpus = np.array_split(cpus, num_procs)[du.get_rank() % num_procs]
+    if len(cpus) >= num_workers:
+        return [
+            [int(cpu) for cpu in worker_cpus]
+            for worker_cpus in np.array_split(cpus, num_workers)
+        ]
+    return [[int(cpus[i % len(cpus)])] for i in range(num_workers)]
+
+
+def loader_worker_init_fn(dataset, cfg):
     """
     Create init function passed to pytorch data loader.
     Args:
         dataset (torch.utils.data.Dataset): the given dataset.
+        cfg (CfgNode): configs. Details can be found in
+            slowfast/config/defaults.py
     """
-    return None
+    worker_cpus = None
+    if (
+        cfg.DATA_LOADER.ENABLE_WORKER_AFFINITY
+        and cfg.DATA_LOADER.NUM_WORKERS > 0
+        and hasattr(os, "sched_setaffinity")
+    ):
+        worker_cpus = _split_worker_cpus(cfg.DATA_LOADER.NUM_WORKERS, cfg)
+    return functools.partial(
+        _worker_init_fn,
+        num_threads=cfg.DATA_LOADER.WORKER_NUM_THREADS,
+        worker_cpus=worker_cpus,
+    )
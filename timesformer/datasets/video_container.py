@@ -5,7 +5,65 @@ import io
 import tools.load_h5 as load_h5
 
 
-def get_video_container(path_to_vid, dataset_path, multi_thread_decode=False, backend="pyav"):
+class MemoryViewFile(io.RawIOBase):
+    """
+    Read-only, seekable file object over a memoryview. Unlike `io.BytesIO`, it
+    does not copy the whole buffer up front. PyAV reads through `read`, which
+    must return bytes, so every chunk it reads is still copied once.
+    """
+
+    def __init__(self, buffer):
+        self._buffer = memoryview(buffer).cast("B")
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = len(self._buffer) + offset
+        else:
+            raise ValueError("Invalid whence {}".format(whence))
+        if pos < 0:
+            raise ValueError("Negative seek position {}".format(pos))
+        self._pos = pos
+        return self._pos
+
+    def readinto(self, b):
+        data = self._buffer[self._pos : self._pos + len(b)]
+        n = len(data)
+        memoryview(b).cast("B")[:n] = data
+        self._pos += n
+        return n
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self._buffer) - self._pos
+        data = self._buffer[self._pos : self._pos + size]
+        self._pos += len(data)
+        # PyAV requires bytes, which it copies into its AVIO buffer, so the
+        # chunk is copied twice.
+        return data.tobytes()
+
+
+def get_video_container(
+    path_to_vid,
+    dataset_path,
+    multi_thread_decode=False,
+    backend="pyav",
+    use_mmap=False,
+    num_threads=0,
+):
     """
     Given the path to the video, return the pyav video container.
     Args:
@@ -13,6 +71,10 @@ def get_video_container(path_to_vid, dataset_path, multi_thread_decode=False, ba
         multi_thread_decode (bool): if True, perform multi-thread decoding.
         backend (str): decoder backend, options include `pyav` and
             `torchvision`, default is `pyav`.
+        use_mmap (bool): if True, read contiguous videos from the memory-mapped
+            h5 file instead of copying them whole, see `MemoryViewFile`.
+        num_threads (int): if larger than 0, number of decoding threads,
+            otherwise FFmpeg uses as many threads as there are cores.
     Returns:
         container (container): video container.
     """
@@ -21,8 +83,16 @@ def get_video_container(path_to_vid, dataset_path, multi_thread_decode=False, ba
             container = fp.read()
         return container
     elif backend == "pyav":
-        video_data = load_h5.load_h5_file(dataset_path, path_to_vid)
-        container = av.open(io.BytesIO(video_data), metadata_errors="ignore")
+        video_data, read_path = load_h5.load_h5_video(
+            dataset_path, path_to_vid, use_mmap
+        )
+        if read_path == "mmap":
+            video_file = MemoryViewFile(video_data)
+        else:
+            video_file = io.BytesIO(video_data)
+        container = av.open(video_file, metadata_errors="ignore")
         if multi_thread_decode:
             container.streams.video[0].thread_type = 'AUTO'
+        if num_threads > 0:
+            container.streams.video[0].thread_count = num_threads
         return container
@@ -34,7 +34,6 @@ def build_model(cfg, gpu_id=None):
     # Construct the model
     name = cfg.MODEL.MODEL_NAME
     model = MODEL_REGISTRY.get(name)(cfg)
-    torch.autograd.set_detect_anomaly(True)
 
     if cfg.NUM_GPUS:
         if gpu_id is None:
@@ -5,15 +5,18 @@
 import torch
 import torch.nn as nn
 from functools import partial
+import contextlib
+import inspect
 import math
 import warnings
 import torch.nn.functional as F
+import torch.utils.checkpoint
 import numpy as np
 
 from timesformer.models.vit_utils import IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD
 from timesformer.models.helpers import load_pretrained
 from timesformer.models.vit_utils import DropPath, to_2tuple, trunc_normal_
-from timesformer.models.vmps import VideoMotionPrompt
+from timesformer.models.vmps import VideoMotionPrompt, frame_motion_energy
 
 from .build import MODEL_REGISTRY
 from torch import einsum
@@ -55,9 +58,51 @@ class Mlp(nn.Module):
         x = self.drop(x)
         return x
 
+# Attention backends, see TIMESFORMER.ATTENTION_BACKEND. `eager` computes the
+# attention matrix explicitly, the others use scaled_dot_product_attention
+# with the kernels PyTorch selects (`sdpa`) or with a single kernel.
+ATTENTION_BACKENDS = ['eager', 'sdpa', 'math', 'efficient', 'flash']
+_SDPA_KERNELS = {'math': 'MATH', 'efficient': 'EFFICIENT_ATTENTION', 'flash': 'FLASH_ATTENTION'}
+# Kernels which have a CPU implementation, CPU tensors fall back to the
+# kernels PyTorch selects for the others.
+_SDPA_CPU_KERNELS = ['math', 'flash']
+
+def _sdpa_kernel(backend, device):
+    """ Context restricting scaled_dot_product_attention to the kernel of the backend
+    """
+    if backend == 'sdpa' or (device.type == 'cpu' and backend not in _SDPA_CPU_KERNELS):
+        return contextlib.nullcontext()
+    try:
+        from torch.nn.attention import SDPBackend, sdpa_kernel
+        return sdpa_kernel(getattr(SDPBackend, _SDPA_KERNELS[backend]))
+    except ImportError:
+        return torch.backends.cuda.sdp_kernel(
+            enable_math=backend == 'math', enable_mem_efficient=backend == 'efficient',
+            enable_flash=backend == 'flash')
+
+# The non-reentrant activation checkpointing requires PyTorch 1.11.
+_NON_REENTRANT_CHECKPOINT = 'use_reentrant' in inspect.signature(torch.utils.checkpoint.checkpoint).parameters
+
+def _checkpoint(function, *args):
+    """ Activation checkpointing of function(*args), non-reentrant when PyTorch supports it.
+    The reentrant checkpoint only backpropagates through the tensor arguments, not through
+    tuples, and only to the parameters if one of the arguments requires grad, so a dummy
+    tensor which requires grad is passed along.
+    """
+    if _NON_REENTRANT_CHECKPOINT:
+        return torch.utils.checkpoint.checkpoint(function, *args, use_reentrant=False)
+    dummy = torch.ones(1, requires_grad=True)
+    return torch.utils.checkpoint.checkpoint(lambda _, *args: function(*args), dummy, *args)
+
 class Attention(nn.Module):
-    def __init__(self, dim, num_heads=8, qkv_bias=False, qk_scale=None, attn_drop=0., proj_drop=0., with_qkv=True):
+    def __init__(self, dim, num_heads=8, qkv_bias=False, qk_scale=None, attn_drop=0., proj_drop=0., with_qkv=True,
+                 backend='eager'):
         super().__init__()
+        assert backend in ATTENTION_BACKENDS, "Unknown attention backend {}".format(backend)
+        if backend != 'eager' and not hasattr(F, 'scaled_dot_product_attention'):
+            warnings.warn("scaled_dot_product_attention requires PyTorch 2.0, using the eager attention.")
+            backend = 'eager'
+        self.backend = backend
         self.num_heads = num_heads
         head_dim = dim // num_heads
         self.scale = qk_scale or head_dim ** -0.5
@@ -77,11 +122,20 @@ class Attention(nn.Module):
            qkv = x.reshape(B, N, self.num_heads, C // self.num_heads).permute(0, 2, 1, 3)
            q, k, v  = qkv, qkv, qkv
 
-        attn = (q @ k.transpose(-2, -1)) * self.scale
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
-
-        x = (attn @ v).transpose(1, 2).reshape(B, N, C)
+        if self.backend == 'eager':
+            attn = (q @ k.transpose(-2, -1)) * self.scale
+            attn = attn.softmax(dim=-1)
+            attn = self.attn_drop(attn)
+            x = attn @ v
+        else:
+            if self.scale != q.size(-1) ** -0.5:
+                # The scale argument requires PyTorch 2.1, rescale the queries instead.
+                q = q * (self.scale * q.size(-1) ** 0.5)
+            with _sdpa_kernel(self.backend, x.device):
+                x = F.scaled_dot_product_attention(
+                    q, k, v, dropout_p=self.attn_drop.p if self.training else 0.)
+
+        x = x.transpose(1, 2).reshape(B, N, C)
         if self.with_qkv:
            x = self.proj(x)
            x = self.proj_drop(x)
@@ -90,20 +144,23 @@ class Attention(nn.Module):
 class Block(nn.Module):
 
     def __init__(self, dim, num_heads, mlp_ratio=4., qkv_bias=False, qk_scale=None, drop=0., attn_drop=0.,
-                 drop_path=0.1, act_layer=nn.GELU, norm_layer=nn.LayerNorm, attention_type='divided_space_time'):
+                 drop_path=0.1, act_layer=nn.GELU, norm_layer=nn.LayerNorm, attention_type='divided_space_time',
+                 attention_backend='eager'):
         super().__init__()
         self.attention_type = attention_type
         assert(attention_type in ['divided_space_time', 'space_only','joint_space_time'])
 
         self.norm1 = norm_layer(dim)
         self.attn = Attention(
-           dim, num_heads=num_heads, qkv_bias=qkv_bias, qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=drop)
+           dim, num_heads=num_heads, qkv_bias=qkv_bias, qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=drop,
+           backend=attention_backend)
 
         ## Temporal Attention Parameters
         if self.attention_type == 'divided_space_time':
             self.temporal_norm1 = norm_layer(dim)
             self.temporal_attn = Attention(
-              dim, num_heads=num_heads, qkv_bias=qkv_bias, qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=drop)
+              dim, num_heads=num_heads, qkv_bias=qkv_bias, qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=drop,
+              backend=attention_backend)
             self.temporal_fc = nn.Linear(dim, dim)
 
         ## drop path
@@ -153,6 +210,56 @@ class Block(nn.Module):
             x = x + self.drop_path(self.mlp(self.norm2(x)))
             return x
 
+class LayoutStableBlock(Block):
+    """ Divided space-time Block on the cls token and the spatial tokens kept apart, with the
+    parameters of Block. The spatial tokens stay in the 'b (h w t) m' layout, the temporal attention
+    runs on a view of them and the spatial attention on a single copy of them, which also holds the
+    cls token of every frame.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        assert self.attention_type == 'divided_space_time'
+
+    def _drop_path_tokens(self, cls_token, x):
+        """ Drop path of the cls and the spatial tokens of the samples with the same mask, as Block
+        does on the concatenated tokens.
+        """
+        if not isinstance(self.drop_path, DropPath) or self.drop_path.drop_prob == 0. or not self.training:
+            return cls_token, x
+        keep_prob = 1 - self.drop_path.drop_prob
+        random_tensor = keep_prob + torch.rand((x.shape[0], 1, 1), dtype=x.dtype, device=x.device)
+        random_tensor.floor_()  # binarize
+        return cls_token.div(keep_prob) * random_tensor, x.div(keep_prob) * random_tensor
+
+    def forward(self, cls_token, x, B, T, W):
+        """
+        Args:
+            cls_token: cls token (B1M)
+            x: contiguous spatial tokens, 'b (h w t) m'
+        Returns:
+            the cls token and the contiguous spatial tokens
+        """
+        M = x.size(-1)
+        N = x.size(1) // T
+
+        ## Temporal, '(b h w) t m' is a view of the tokens
+        res_temporal = self.temporal_attn(self.temporal_norm1(x).view(B * N, T, M))
+        res_temporal = self.drop_path(res_temporal).view(B, N * T, M)
+        xt = x + self.temporal_fc(res_temporal)
+
+        ## Spatial, the frames with the cls token in front, '(b t) (1 h w) m'
+        xs = torch.cat((cls_token.unsqueeze(1).expand(B, T, 1, M), xt.view(B, N, T, M).transpose(1, 2)), 2)
+        res_spatial = self.drop_path(self.attn(self.norm1(xs.view(B * T, 1 + N, M))))
+        res_spatial = res_spatial.view(B, T, 1 + N, M)
+
+        ### Taking care of CLS token
+        cls_token = cls_token + torch.mean(res_spatial[:, :, 0], 1, True) ## averaging for every frame
+        x = (xt.view(B, N, T, M) + res_spatial[:, :, 1:].transpose(1, 2)).view(B, N * T, M)
+
+        ## Mlp
+        res_cls, res = self._drop_path_tokens(self.mlp(self.norm2(cls_token)), self.mlp(self.norm2(x)))
+        return cls_token + res_cls, x + res
+
 class PatchEmbed(nn.Module):
     """ Image to Patch Embedding
     """
@@ -181,9 +288,19 @@ class VisionTransformer(nn.Module):
     """
     def __init__(self, img_size=224, patch_size=16, in_chans=3, num_classes=1000, embed_dim=768, depth=12,
                  num_heads=12, mlp_ratio=4., qkv_bias=False, qk_scale=None, drop_rate=0., attn_drop_rate=0.,
-                 drop_path_rate=0.1, hybrid_backbone=None, norm_layer=nn.LayerNorm, num_frames=8, attention_type='divided_space_time', dropout=0.):
+                 drop_path_rate=0.1, hybrid_backbone=None, norm_layer=nn.LayerNorm, num_frames=8, attention_type='divided_space_time', dropout=0.,
+                 keep_ratio=1.0, keep_threshold=0., attention_backend='eager', layout_stable=False,
+                 checkpoint_blocks=0):
         super().__init__()
         self.attention_type = attention_type
+        ## Activation checkpointing of the blocks, in segments of checkpoint_blocks blocks
+        self.checkpoint_blocks = checkpoint_blocks
+        ## Layout stable blocks, for the divided space-time attention
+        self.layout_stable = layout_stable and attention_type == 'divided_space_time'
+        block = LayoutStableBlock if self.layout_stable else Block
+        ## Motion guided token pruning
+        self.keep_ratio = keep_ratio
+        self.keep_threshold = keep_threshold
         self.depth = depth
         self.dropout = nn.Dropout(dropout)
         self.num_classes = num_classes
@@ -203,9 +320,10 @@ class VisionTransformer(nn.Module):
         ## Attention Blocks
         dpr = [x.item() for x in torch.linspace(0, drop_path_rate, self.depth)]  # stochastic depth decay rule
         self.blocks = nn.ModuleList([
-            Block(
+            block(
                 dim=embed_dim, num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
-                drop=drop_rate, attn_drop=attn_drop_rate, drop_path=dpr[i], norm_layer=norm_layer, attention_type=self.attention_type)
+                drop=drop_rate, attn_drop=attn_drop_rate, drop_path=dpr[i], norm_layer=norm_layer, attention_type=self.attention_type,
+                attention_backend=attention_backend)
             for i in range(self.depth)])
         self.norm = norm_layer(embed_dim)
 
@@ -247,7 +365,85 @@ class VisionTransformer(nn.Module):
         self.num_classes = num_classes
         self.head = nn.Linear(self.embed_dim, num_classes) if num_classes > 0 else nn.Identity()
 
-    def forward_features(self, x):
+    def prune_tokens(self, x, motion_map, T, W):
+        """
+        Keep the patches with the most motion, and the cls tokens. The
+        divided and joint space-time attention keep the same patches in
+        every frame of a clip, so that the temporal attention still sees
+        every frame of a kept patch. The space only attention selects the
+        patches of every frame.
+        Args:
+            x: tokens after the positional and time embeddings
+            motion_map: motion attention map of the frames (BTHW)
+            T: number of frames
+            W: width of the patch grid
+        Returns:
+            the kept tokens in their spatial order, and the number of kept
+            patches, which is the width of the grid of kept patches
+        """
+        if self.keep_ratio >= 1.0 and self.keep_threshold <= 0:
+            return x, W
+        patch_size = self.patch_embed.patch_size
+        scores = F.avg_pool2d(motion_map.detach().float(), patch_size)
+        if self.attention_type == 'space_only':
+            scores = rearrange(scores, 'b t h w -> (b t) (h w)')
+        else:
+            scores = rearrange(scores.mean(1), 'b h w -> b (h w)')
+        N = scores.size(1)
+        if self.keep_threshold > 0:
+            num_keep = int((scores >= self.keep_threshold).sum(1).max())
+        else:
+            num_keep = int(math.ceil(self.keep_ratio * N))
+        num_keep = min(max(num_keep, 1), N)
+        if num_keep == N:
+            return x, W
+        index = scores.topk(num_keep, dim=1).indices.sort(dim=1).values
+
+        cls_tokens, x = x[:, :1], x[:, 1:]
+        if self.attention_type == 'space_only':
+            index = index.unsqueeze(-1).expand(-1, -1, x.size(-1))
+            x = torch.gather(x, 1, index)
+        else:
+            x = rearrange(x, 'b (n t) m -> b n t m', t=T)
+            index = index[:, :, None, None].expand(-1, -1, T, x.size(-1))
+            x = torch.gather(x, 1, index)
+            x = rearrange(x, 'b n t m -> b (n t) m')
+        return torch.cat((cls_tokens, x), dim=1), num_keep
+
+    def interpolate_time_embed(self, frame_positions):
+        """
+        Linearly interpolate the time embeddings at fractional frame positions.
+        Args:
+            frame_positions: position of every frame of the clips (BT), on the
+                scale of the time embedding indices
+        Returns:
+            time embeddings of the frames (BTM)
+        """
+        num_embeds = self.time_embed.size(1)
+        positions = frame_positions.to(self.time_embed.dtype).clamp(0, num_embeds - 1)
+        low = positions.floor().long()
+        high = (low + 1).clamp(max=num_embeds - 1)
+        weight = (positions - low).unsqueeze(-1)
+        time_embed = self.time_embed[0]
+        return time_embed[low] * (1 - weight) + time_embed[high] * weight
+
+    def forward_blocks(self, start, end, B, T, W, *x):
+        """
+        Run the attention blocks from start to end.
+        Args:
+            start, end: indices of the first and past the last block
+            B, T, W: batch size, number of frames and width of the patch grid
+            x: tokens, or cls token and spatial tokens of the layout stable blocks
+        Returns:
+            tuple of the tokens, or cls token and spatial tokens, after the blocks
+        """
+        for blk in self.blocks[start:end]:
+            x = blk(*x, B, T, W)
+            if not isinstance(x, tuple):
+                x = (x,)
+        return x
+
+    def forward_features(self, x, motion_map=None, frame_positions=None):
         B = x.shape[0]
         x, T, W = self.patch_embed(x)
         cls_tokens = self.cls_token.expand(x.size(0), -1, -1)
@@ -276,8 +472,14 @@ class VisionTransformer(nn.Module):
             cls_tokens = x[:B, 0, :].unsqueeze(1)
             x = x[:,1:]
             x = rearrange(x, '(b t) n m -> (b n) t m',b=B,t=T)
+            ## Time embeddings of the selected frames
+            if frame_positions is not None:
+                time_embed = self.interpolate_time_embed(frame_positions)
+                x = rearrange(x, '(b n) t m -> b n t m',b=B,t=T)
+                x = x + time_embed.unsqueeze(1)
+                x = rearrange(x, 'b n t m -> (b n) t m',b=B,t=T)
             ## Resizing time embeddings in case they don't match
-            if T != self.time_embed.size(1):
+            elif T != self.time_embed.size(1):
                 time_embed = self.time_embed.transpose(1, 2)
                 new_time_embed = F.interpolate(time_embed, size=(T), mode='nearest')
                 new_time_embed = new_time_embed.transpose(1, 2)
@@ -288,9 +490,23 @@ class VisionTransformer(nn.Module):
             x = rearrange(x, '(b n) t m -> b (n t) m',b=B,t=T)
             x = torch.cat((cls_tokens, x), dim=1)
 
+        ## Motion guided token pruning
+        if motion_map is not None:
+            x, W = self.prune_tokens(x, motion_map, T, W)
+
         ## Attention blocks
-        for blk in self.blocks:
-            x = blk(x, B, T, W)
+        x = (x[:, :1], x[:, 1:].contiguous()) if self.layout_stable else (x,)
+        checkpoint = self.checkpoint_blocks > 0 and torch.is_grad_enabled()
+        segment = self.checkpoint_blocks if checkpoint else self.depth
+        for start in range(0, self.depth, segment):
+            end = min(start + segment, self.depth)
+            if checkpoint:
+                ## Only the input of the segment is kept for backward
+                x = _checkpoint(self.forward_blocks, start, end, B, T, W, *x)
+            else:
+                x = self.forward_blocks(start, end, B, T, W, *x)
+        # The tokens, or only the cls token of the layout stable blocks, are classified
+        x = x[0]
 
         ### Predictions for space-only baseline
         if self.attention_type == 'space_only':
@@ -300,8 +516,8 @@ class VisionTransformer(nn.Module):
         x = self.norm(x)
         return x[:, 0]
 
-    def forward(self, x):
-        x = self.forward_features(x)
+    def forward(self, x, motion_map=None, frame_positions=None):
+        x = self.forward_features(x, motion_map, frame_positions)
         x = self.head(x)
         return x
 
@@ -327,9 +543,32 @@ class vit_base_patch16_224(nn.Module):
         # VMPs configuration
         num_frames = cfg.DATA.NUM_FRAMES
         if cfg.VMPS.EXP_NAME != "baseline":
-            self.vmps = VideoMotionPrompt(penalty_weight=cfg.VMPS.PENALTY_WEIGHT, wandb=cfg.WANDB.ENABLE)
+            self.vmps = VideoMotionPrompt(penalty_weight=cfg.VMPS.PENALTY_WEIGHT, wandb=cfg.WANDB.ENABLE, fused=cfg.VMPS.FUSED, log_period=cfg.LOG_PERIOD)
             num_frames -= 1
-        self.model = VisionTransformer(img_size=cfg.DATA.TRAIN_CROP_SIZE, num_classes=cfg.MODEL.NUM_CLASSES, patch_size=patch_size, embed_dim=768, depth=12, num_heads=12, mlp_ratio=4, qkv_bias=True, norm_layer=partial(nn.LayerNorm, eps=1e-6), drop_rate=0., attn_drop_rate=0., drop_path_rate=0.1, num_frames=num_frames, attention_type=cfg.TIMESFORMER.ATTENTION_TYPE, **kwargs)
+        # Motion guided token pruning
+        keep_ratio = cfg.TIMESFORMER.TOKEN_KEEP_RATIO
+        keep_threshold = cfg.TIMESFORMER.TOKEN_KEEP_THRESHOLD
+        assert self.vmps is not None or (keep_ratio >= 1.0 and keep_threshold <= 0), \
+            "Token pruning requires VMPs"
+        self.model = VisionTransformer(img_size=cfg.DATA.TRAIN_CROP_SIZE, num_classes=cfg.MODEL.NUM_CLASSES, patch_size=patch_size, embed_dim=768, depth=12, num_heads=12, mlp_ratio=4, qkv_bias=True, norm_layer=partial(nn.LayerNorm, eps=1e-6), drop_rate=0., attn_drop_rate=0., drop_path_rate=0.1, num_frames=num_frames, attention_type=cfg.TIMESFORMER.ATTENTION_TYPE, keep_ratio=keep_ratio, keep_threshold=keep_threshold, attention_backend=cfg.TIMESFORMER.ATTENTION_BACKEND, layout_stable=cfg.TIMESFORMER.LAYOUT_STABLE_BLOCK, checkpoint_blocks=cfg.TIMESFORMER.CHECKPOINT_BLOCKS, **kwargs)
+
+        # Normalize the uint8 input clips on the device, see
+        # DATA.NORMALIZE_ON_DEVICE. x * input_scale + input_shift is
+        # (x / 255 - mean) / std.
+        self.normalize_on_device = cfg.DATA.NORMALIZE_ON_DEVICE
+        if self.normalize_on_device:
+            mean = torch.tensor(cfg.DATA.MEAN).view(1, -1, 1, 1, 1)
+            std = torch.tensor(cfg.DATA.STD).view(1, -1, 1, 1, 1)
+            self.register_buffer("input_scale", 1.0 / (255.0 * std), persistent=False)
+            self.register_buffer("input_shift", -mean / std, persistent=False)
+
+        # Activation checkpointing of the VMPs, see VMPS.CHECKPOINT.
+        self.checkpoint_vmps = cfg.VMPS.CHECKPOINT
+
+        # Motion energy frame selection, see DATA.NUM_CANDIDATE_FRAMES.
+        self.num_frames = cfg.DATA.NUM_FRAMES
+        self.num_candidate_frames = cfg.DATA.NUM_CANDIDATE_FRAMES
+        self.num_selected_frames = cfg.DATA.NUM_FRAMES
 
         self.attention_type = cfg.TIMESFORMER.ATTENTION_TYPE
         self.model.default_cfg = default_cfgs['vit_base_patch16_224']
@@ -338,11 +577,55 @@ class vit_base_patch16_224(nn.Module):
         if self.pretrained:
             load_pretrained(self.model, num_classes=self.model.num_classes, in_chans=kwargs.get('in_chans', 3), filter_fn=_conv_filter, img_size=cfg.DATA.TRAIN_CROP_SIZE, num_patches=self.num_patches, attention_type=self.attention_type, pretrained_model=pretrained_model)
 
+    def select_frames(self, x, norm_x=None):
+        """
+        Keep the num_selected_frames frames of the clips with the most motion
+        energy, in their temporal order.
+        Args:
+            x: normalized candidate frames (BCTHW)
+            norm_x: the same frames in [0, 1] (BCTHW), or None
+        Returns:
+            the selected frames of x and norm_x, and the positions of the
+            frames fed to the transformer on the scale of its time
+            embeddings (BT)
+        """
+        B, _, num_candidates = x.shape[:3]
+        num_keep = min(self.num_selected_frames, num_candidates)
+        energy = frame_motion_energy(x, norm_x)
+        index = energy.topk(num_keep, dim=1).indices.sort(dim=1).values
+        batch = torch.arange(B, device=x.device).unsqueeze(1)
+        x = x[batch, :, index].transpose(1, 2)
+        if norm_x is not None:
+            norm_x = norm_x[batch, :, index].transpose(1, 2)
+
+        # The time embeddings are trained on DATA.NUM_FRAMES frames spanning
+        # the same temporal window as the candidates.
+        positions = index.float() * (self.num_frames - 1) / max(num_candidates - 1, 1)
+        if self.vmps is not None:
+            # The prompt of a frame is its difference to the previous frame.
+            positions = positions[:, 1:] - 1
+        return x, norm_x, positions
+
     def forward(self, x):
         loss = 0
-        if self.vmps is not None:
-            x, loss = self.vmps(x)
-        x = self.model(x)
+        norm_x = None
+        if self.normalize_on_device:
+            # The input is in [0, 255], uint8 or float after mixup.
+            x = x.float()
+            if self.vmps is not None:
+                norm_x = x * (1.0 / 255.0)
+            x = torch.addcmul(self.input_shift, x, self.input_scale)
+        frame_positions = None
+        if self.num_candidate_frames > 0:
+            x, norm_x, frame_positions = self.select_frames(x, norm_x)
+        motion_map = None
+        if self.vmps is not None and self.checkpoint_vmps and torch.is_grad_enabled():
+            # The recomputation in backward does not log.
+            x, loss, motion_map = _checkpoint(self.vmps, x, norm_x, True, False)
+            self.vmps.log(loss)
+        elif self.vmps is not None:
+            x, loss, motion_map = self.vmps(x, norm_x, return_attention=True)
+        x = self.model(x, motion_map, frame_positions)
         return x, loss
 
 @MODEL_REGISTRY.register()
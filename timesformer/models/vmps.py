@@ -35,13 +35,18 @@ def reverse_rearrange_tensor(input_tensor, order):
     return input_tensor.permute(["BTCHW".index(dim) for dim in order])
 
 class VideoMotionPrompt(torch.nn.Module):
-    def __init__(self, penalty_weight=0.0, wandb = False):
+    def __init__(self, penalty_weight=0.0, wandb = False, fused = False, log_period = 1):
         super(VideoMotionPrompt, self).__init__()
         # default configs
         self.input_permutation = "BCTHW"   # Input permutation from video reader
         self.input_color_order = "BGR"     # Input color channel order from video reader
         self.gray_scale = {"B": 0.114, "G": 0.587, "R": 0.299}
         self.wandb = wandb
+        # log to wandb every log_period forward passes
+        self.log_period = log_period
+        self._log_buffer = []
+        # compute the prompt with MotionPromptFunction
+        self.fused = fused
 
         # power normalization parameters
         self.pn = m_sigmoid
@@ -51,25 +56,52 @@ class VideoMotionPrompt(torch.nn.Module):
         # temporal attention variation regularization parameter
         self.lambda1 = penalty_weight
         
-    def forward(self, video_seq):
+    def forward(self, video_seq, norm_seq=None, return_attention=False, log=True):
+        """
+        Args:
+            video_seq: normalized input clip
+            norm_seq: the same clip in [0, 1], computed from video_seq if None
+            return_attention: if True, also return the attention map
+            log: if False, do not log to wandb, e.g. when the forward pass is
+                recomputed by activation checkpointing
+        Returns:
+            motion prompt of the clip and temporal regularization loss, and
+            the attention map (BT-1HW) if return_attention
+        """
         # rearrange the input tensor to BTCHW
         video_seq = rearrange_tensor(video_seq, self.input_permutation)
         
-        # normalize the input tensor back to [0, 1]
-        norm_seq = video_seq * 0.225 + 0.45
-        
-        # transfor the input tensor to grayscale 
-        weights = torch.tensor([self.gray_scale[idx] for idx in self.input_color_order], 
-                               dtype=video_seq.dtype, device=video_seq.device)
-        grayscale_video_seq = torch.einsum("btchw, c -> bthw", norm_seq, weights)
+        if norm_seq is not None:
+            norm_seq = rearrange_tensor(norm_seq, self.input_permutation)
+
+        if self.fused:
+            ### grayscale, frame difference, power normalization and ###
+            ### element-wise multiplication in one pass ###
+            B, T, _, H, W = video_seq.shape
+            prompt, attention_map = MotionPromptFunction.apply(
+                video_seq,
+                norm_seq,
+                self.m,
+                self.n,
+                tuple(self.gray_scale[idx] for idx in self.input_color_order),
+            )
+        else:
+            if norm_seq is None:
+                # normalize the input tensor back to [0, 1]
+                norm_seq = video_seq * 0.225 + 0.45
+
+            # transfor the input tensor to grayscale 
+            weights = torch.tensor([self.gray_scale[idx] for idx in self.input_color_order], 
+                                   dtype=video_seq.dtype, device=video_seq.device)
+            grayscale_video_seq = torch.einsum("btchw, c -> bthw", norm_seq, weights)
 
-        ### frame difference ###
-        B, T, H, W = grayscale_video_seq.shape
-        frame_diff = grayscale_video_seq[:,1:] - grayscale_video_seq[:,:-1]
+            ### frame difference ###
+            B, T, H, W = grayscale_video_seq.shape
+            frame_diff = grayscale_video_seq[:,1:] - grayscale_video_seq[:,:-1]
 
-        ### power normalization ###
-        attention_map = self.pn(frame_diff, self.m, self.n)
-        repeat_attention_map = attention_map.unsqueeze(2).repeat(1, 1, 3, 1, 1)
+            ### power normalization ###
+            attention_map = self.pn(frame_diff, self.m, self.n)
+            repeat_attention_map = attention_map.unsqueeze(2).repeat(1, 1, 3, 1, 1)
 
         ### temporal attention variation regularization ###
         loss = 0
@@ -78,22 +110,210 @@ class VideoMotionPrompt(torch.nn.Module):
             temporal_loss = torch.sum(temp_diff.pow(2)) / (H*W*(T-2)*B)
             loss = self.lambda1 * temporal_loss
 
-        ### log the loss and parameters ###
-        if self.wandb:
-            wandb.log({
-                "m": self.m.data[0],
-                "n": self.n.data[0],
-                "temporal_loss": loss,
-            })
+        if log:
+            self.log(loss)
         
-        ### element-wise multiplication ###
-        prompt = repeat_attention_map * video_seq[:,1:]
+        if not self.fused:
+            ### element-wise multiplication ###
+            prompt = repeat_attention_map * video_seq[:,1:]
         motion_prompt = reverse_rearrange_tensor(prompt, self.input_permutation)
 
+        if return_attention:
+            return motion_prompt, loss, attention_map
         return motion_prompt, loss
 
+    def log(self, loss):
+        """
+        Log the loss and parameters to wandb if enabled. They are kept on the
+        device and copied to the host every log_period calls.
+        Args:
+            loss: temporal regularization loss
+        """
+        if not self.wandb:
+            return
+        loss = torch.as_tensor(loss, device=self.m.device).detach()
+        values = (self.m.detach(), self.n.detach(), loss.to(self.m.dtype).view(1))
+        self._log_buffer.append(torch.cat(values))
+        if len(self._log_buffer) >= self.log_period:
+            self.flush_log()
+
+    def flush_log(self):
+        """
+        Copy the logged values to the host in one synchronization and log them
+        to wandb.
+        """
+        if not self._log_buffer:
+            return
+        values = torch.stack(self._log_buffer).tolist()
+        self._log_buffer = []
+        for m, n, temporal_loss in values:
+            wandb.log({
+                "m": m,
+                "n": n,
+                "temporal_loss": temporal_loss,
+            })
+
 
 def m_sigmoid(input, m, n):
-    return 1 / (1 + torch.exp(
-        - (5 / (0.45 * torch.abs(torch.tanh(m)) + 1e-1)) * (input - 0.6 * torch.tanh(n))
-        ))
+    # 1 / (1 + exp(-x)), without the overflow of exp in fp16/bf16
+    return torch.sigmoid(
+        (5 / (0.45 * torch.abs(torch.tanh(m)) + 1e-1)) * (input - 0.6 * torch.tanh(n))
+        )
+
+
+def _grayscale(video_seq, norm_seq, weights):
+    """
+    Compute the grayscale of a clip in [0, 1] in at least float32, channel by
+    channel to only keep BTHW intermediates.
+    Args:
+        video_seq: normalized input clip (BTCHW)
+        norm_seq: the same clip in [0, 1] (BTCHW), or None
+        weights: grayscale weight of each channel
+    Returns:
+        grayscale clip (BTHW)
+    """
+    source = video_seq if norm_seq is None else norm_seq
+    dtype = torch.promote_types(source.dtype, torch.float32)
+    grayscale = sum(
+        weight * source[:, :, c].to(dtype) for c, weight in enumerate(weights)
+    )
+    if norm_seq is None:
+        # the grayscale of the clip normalized back to [0, 1]
+        grayscale = grayscale * 0.225 + 0.45 * sum(weights)
+    return grayscale
+
+
+def frame_motion_energy(video_seq, norm_seq=None, weights=(0.114, 0.587, 0.299)):
+    """
+    Compute the motion energy of every frame of a clip, the mean absolute
+    grayscale difference to its previous and next frames.
+    Args:
+        video_seq: normalized input clip (BCTHW)
+        norm_seq: the same clip in [0, 1] (BCTHW), or None
+        weights: grayscale weight of each channel, in the BGR order of the
+            video reader
+    Returns:
+        motion energy of the frames (BT)
+    """
+    video_seq = rearrange_tensor(video_seq, "BCTHW")
+    if norm_seq is not None:
+        norm_seq = rearrange_tensor(norm_seq, "BCTHW")
+    grayscale = _grayscale(video_seq, norm_seq, weights)
+    diff = (grayscale[:, 1:] - grayscale[:, :-1]).abs().mean((2, 3))
+    return torch.cat(
+        (diff[:, :1], (diff[:, :-1] + diff[:, 1:]) / 2, diff[:, -1:]), dim=1
+    )
+
+
+def _motion_attention(video_seq, norm_seq, m, n, weights):
+    """
+    Compute the attention map of the motion prompt in at least float32.
+    Args:
+        video_seq: normalized input clip (BTCHW)
+        norm_seq: the same clip in [0, 1] (BTCHW), or None
+        m, n: power normalization parameters
+        weights: grayscale weight of each channel
+    Returns:
+        frame difference, attention map, slope and offset of m_sigmoid
+    """
+    grayscale = _grayscale(video_seq, norm_seq, weights)
+    dtype = grayscale.dtype
+    frame_diff = grayscale[:, 1:] - grayscale[:, :-1]
+
+    tanh_m = torch.tanh(m.to(dtype))
+    slope = 5 / (0.45 * torch.abs(tanh_m) + 1e-1)
+    offset = 0.6 * torch.tanh(n.to(dtype))
+    attention_map = torch.sigmoid(slope * (frame_diff - offset))
+    return frame_diff, attention_map, slope, offset
+
+
+class MotionPromptFunction(torch.autograd.Function):
+    """
+    Motion prompt of VideoMotionPrompt computed in one pass: grayscale, frame
+    difference, power normalization and multiplication of the frames by the
+    attention map, broadcast over the channels. Only the inputs are kept for
+    backward, the intermediates are recomputed. The attention map is computed
+    in float32 for half precision inputs.
+    """
+
+    @staticmethod
+    def forward(ctx, video_seq, norm_seq, m, n, weights):
+        """
+        Args:
+            video_seq: normalized input clip (BTCHW)
+            norm_seq: the same clip in [0, 1] (BTCHW), computed from video_seq
+                if None
+            m, n: power normalization parameters
+            weights: grayscale weight of each channel
+        Returns:
+            prompt (BT-1CHW) and attention map (BT-1HW, at least float32)
+        """
+        _, attention_map, _, _ = _motion_attention(
+            video_seq, norm_seq, m, n, weights
+        )
+        prompt = video_seq[:, 1:] * attention_map.unsqueeze(2).to(video_seq.dtype)
+        ctx.weights = weights
+        ctx.has_norm_seq = norm_seq is not None
+        ctx.save_for_backward(video_seq, norm_seq, m, n)
+        return prompt, attention_map
+
+    @staticmethod
+    def backward(ctx, grad_prompt, grad_attention_map):
+        video_seq, norm_seq, m, n = ctx.saved_tensors
+        if not ctx.has_norm_seq:
+            norm_seq = None
+        weights = ctx.weights
+        frame_diff, attention_map, slope, offset = _motion_attention(
+            video_seq, norm_seq, m, n, weights
+        )
+
+        # multiplication
+        grad_video_seq = torch.zeros_like(video_seq)
+        grad_attention = torch.zeros_like(attention_map)
+        if grad_prompt is not None:
+            grad_video_seq[:, 1:] = grad_prompt * attention_map.unsqueeze(2).to(
+                grad_prompt.dtype
+            )
+            grad_attention += (
+                grad_prompt.to(grad_attention.dtype)
+                * video_seq[:, 1:].to(grad_attention.dtype)
+            ).sum(2)
+        if grad_attention_map is not None:
+            grad_attention += grad_attention_map.to(grad_attention.dtype)
+
+        # power normalization
+        grad_logit = grad_attention * attention_map * (1 - attention_map)
+        grad_slope = (grad_logit * (frame_diff - offset)).sum()
+        grad_offset = -(grad_logit.sum() * slope)
+        grad_diff = grad_logit * slope
+        tanh_m = torch.tanh(m.to(slope.dtype))
+        grad_m = (
+            grad_slope * -slope * slope / 5 * 0.45 * torch.sign(tanh_m)
+            * (1 - tanh_m ** 2)
+        )
+        grad_n = grad_offset * 0.6 * (1 - torch.tanh(n.to(offset.dtype)) ** 2)
+
+        # frame difference
+        B, T, H, W = attention_map.shape
+        grad_grayscale = grad_diff.new_zeros(B, T + 1, H, W)
+        grad_grayscale[:, 1:] += grad_diff
+        grad_grayscale[:, :-1] -= grad_diff
+
+        # grayscale
+        grad_norm_seq = None
+        if norm_seq is None:
+            grad_grayscale = grad_grayscale * 0.225
+            grad_source = grad_video_seq
+        else:
+            grad_norm_seq = torch.zeros_like(norm_seq)
+            grad_source = grad_norm_seq
+        for c, weight in enumerate(weights):
+            grad_source[:, :, c] += (weight * grad_grayscale).to(grad_source.dtype)
+
+        return (
+            grad_video_seq,
+            grad_norm_seq if ctx.needs_input_grad[1] else None,
+            grad_m.view_as(m).to(m.dtype),
+            grad_n.view_as(n).to(n.dtype),
+            None,
+        )
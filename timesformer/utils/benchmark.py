@@ -3,16 +3,36 @@
 Functions for benchmarks.
 """
 
+import contextlib
+import copy
 import numpy as np
+import os
 import pprint
+import random
 import torch
 import tqdm
 from fvcore.common.timer import Timer
+from torch.distributed.algorithms.ddp_comm_hooks import default_hooks
 
+import timesformer.models.optimizer as optim
+import timesformer.utils.checkpoint as cu
+import timesformer.utils.distributed as du
 import timesformer.utils.logging as logging
+import timesformer.utils.metrics as metrics
 import timesformer.utils.misc as misc
-from timesformer.datasets import loader
+import tools.load_h5 as load_h5
+from timesformer.datasets import build_dataset, decoder, loader
+from timesformer.datasets import utils as data_utils
+from timesformer.models import build_model
+from timesformer.models.vit import (
+    ATTENTION_BACKENDS,
+    Attention,
+    Block,
+    LayoutStableBlock,
+)
+from timesformer.models.vmps import VideoMotionPrompt
 from timesformer.utils.env import setup_environment
+from timesformer.utils.meters import StatsBuffer, TestMeter
 
 logger = logging.get_logger(__name__)
 
@@ -46,7 +66,10 @@ def benchmark_data_loading(cfg):
     # Total batch size across different machines.
     batch_size = cfg.TRAIN.BATCH_SIZE * cfg.NUM_SHARDS
     log_period = cfg.BENCHMARK.LOG_PERIOD
+    num_cpus = len(os.sched_getaffinity(0))
     epoch_times = []
+    stall_times = []
+    prev_switches = {}
     # Test for a few epochs.
     for cur_epoch in range(cfg.BENCHMARK.NUM_EPOCHS):
         timer = Timer()
@@ -54,7 +77,18 @@ def benchmark_data_loading(cfg):
         iter_times = []
         if cfg.BENCHMARK.SHUFFLE:
             loader.shuffle_dataset(dataloader, cur_epoch)
+        load_h5.reset_h5_stats()
+        decoder.reset_decode_stats()
         for cur_iter, _ in enumerate(tqdm.tqdm(dataloader)):
+            if cur_iter == 0:
+                # The workers are started, or resumed if persistent, at the
+                # epoch boundary.
+                stall_times.append(timer_epoch.seconds())
+                logger.info(
+                    "Epoch {}: first batch after {:.2f} seconds.".format(
+                        cur_epoch, stall_times[-1]
+                    )
+                )
             if cur_iter > 0 and cur_iter % log_period == 0:
                 iter_times.append(timer.seconds())
                 ram_usage, ram_total = misc.cpu_mem_usage()
@@ -70,6 +104,39 @@ def benchmark_data_loading(cfg):
                     )
                 )
                 timer.reset()
+                worker_rss, worker_uss = misc.loader_worker_mem_usage()
+                if len(worker_rss) > 0:
+                    logger.info(
+                        "Epoch {}: {} loader workers, RSS per worker "
+                        "{:.3f}/{:.3f} GB (avg/max), USS per worker "
+                        "{:.3f}/{:.3f} GB (avg/max).".format(
+                            cur_epoch,
+                            len(worker_rss),
+                            np.mean(worker_rss),
+                            np.max(worker_rss),
+                            np.mean(worker_uss),
+                            np.max(worker_uss),
+                        )
+                    )
+                threads, switches = misc.loader_worker_cpu_usage()
+                if len(threads) > 0:
+                    num_switches = sum(
+                        switches[pid] - prev_switches.get(pid, 0)
+                        for pid in switches
+                    )
+                    prev_switches = switches
+                    logger.info(
+                        "Epoch {}: {} threads in {} loader workers on {} CPUs "
+                        "({:.2f} threads per CPU), {:.1f} involuntary context "
+                        "switches per iter.".format(
+                            cur_epoch,
+                            sum(threads.values()),
+                            len(threads),
+                            num_cpus,
+                            sum(threads.values()) / num_cpus,
+                            num_switches / log_period,
+                        )
+                    )
         epoch_times.append(timer_epoch.seconds())
         ram_usage, ram_total = misc.cpu_mem_usage()
         logger.info(
@@ -83,6 +150,47 @@ def benchmark_data_loading(cfg):
                 ram_total,
             )
         )
+        # The samples are clips, DATA.NUM_REPEATED_CLIPS of them are decoded
+        # from every video.
+        samples_per_second = (
+            len(dataloader)
+            * cfg.TRAIN.BATCH_SIZE
+            / epoch_times[-1]
+            / max(1, cfg.NUM_GPUS)
+            / max(1, cfg.DATA_LOADER.NUM_WORKERS)
+        )
+        logger.info(
+            "Epoch {}: {:.2f} samples ({:.2f} decoded videos) per second per "
+            "loader worker.".format(
+                cur_epoch,
+                samples_per_second,
+                samples_per_second / cfg.DATA.NUM_REPEATED_CLIPS,
+            )
+        )
+        h5_stats = load_h5.get_h5_stats()
+        logger.info(
+            "Epoch {}: {} h5 file opens, {} h5 reads ({} memory-mapped video "
+            "reads, copied by PyAV chunk by chunk, {} videos copied "
+            "whole).".format(
+                cur_epoch,
+                h5_stats["opens"],
+                h5_stats["reads"],
+                h5_stats["mmap_reads"],
+                h5_stats["copy_reads"],
+            )
+        )
+        decode_stats = decoder.get_decode_stats()
+        logger.info(
+            "Epoch {}: {} frames decoded for {} frames used ({:.2f} decoded "
+            "per used frame), {} videos decoded entirely.".format(
+                cur_epoch,
+                decode_stats["decoded_frames"],
+                decode_stats["used_frames"],
+                decode_stats["decoded_frames"]
+                / max(decode_stats["used_frames"], 1),
+                decode_stats["full_decodes"],
+            )
+        )
         logger.info(
             "Epoch {}: on average every {} iters ({} videos) take {:.2f}/{:.2f} "
             "(avg/std) seconds.".format(
@@ -101,3 +209,1157 @@ def benchmark_data_loading(cfg):
             np.std(epoch_times),
         )
     )
+    logger.info(
+        "On average the first batch of every epoch takes {:.2f}/{:.2f} "
+        "(avg/std) seconds, {:.2f} seconds after the first epoch.".format(
+            np.mean(stall_times),
+            np.std(stall_times),
+            np.mean(stall_times[1:]) if len(stall_times) > 1 else float("nan"),
+        )
+    )
+
+
+def _seed(index):
+    random.seed(index)
+    np.random.seed(index)
+    torch.manual_seed(index)
+
+
+def _decode_samples(cfg, num_samples):
+    """
+    Decode training clips of the first videos of the training set, then build
+    the training samples of the same videos, with the random state reset
+    before each clip so that the runs can be compared.
+    """
+    dataset = build_dataset(cfg.TRAIN.DATASET, cfg, "train")
+    num_samples = min(num_samples, len(dataset))
+    decoder.reset_decode_stats()
+    clips = []
+    timer = Timer()
+    for index in tqdm.tqdm(range(num_samples)):
+        _seed(index)
+        clips.append(
+            dataset._load_frames(
+                index,
+                cfg.DATA.SAMPLING_RATE,
+                -1,
+                cfg.DATA.TRAIN_JITTER_SCALES[0],
+                cfg.DATA.TRAIN_JITTER_SCALES[1],
+                0,
+            )
+        )
+    decode_seconds = timer.seconds()
+    stats = decoder.get_decode_stats()
+    timer.reset()
+    for index in tqdm.tqdm(range(num_samples)):
+        _seed(index)
+        dataset[index]
+    return clips, decode_seconds, timer.seconds(), stats
+
+
+def benchmark_decoding(cfg):
+    """
+    Benchmark the `pyav` decoding of training clips: the default decoding,
+    the sparse decoding, which is checked to return the same frames, and the
+    sparse decoding with frames resized at decode time. The decoding time and
+    size of the clips, and the time to build the training samples, are logged.
+    Args:
+        cfg (CfgNode): configs. Details can be found in
+            lib/config/defaults.py
+    """
+    setup_environment()
+    logging.setup_logging(cfg.OUTPUT_DIR)
+    logger.info("Benchmark decoding with config:")
+    logger.info(pprint.pformat(cfg))
+
+    short_side = cfg.DATA_LOADER.DECODE_SHORT_SIDE
+    if short_side <= 0:
+        short_side = cfg.DATA.TRAIN_JITTER_SCALES[1]
+    settings = [
+        ("Dense", False, 0),
+        ("Sparse", True, 0),
+        ("Sparse resized to {}".format(short_side), True, short_side),
+    ]
+    results = {}
+    for name, sparse, decode_short_side in settings:
+        cfg.DATA_LOADER.ENABLE_SPARSE_DECODE = sparse
+        cfg.DATA_LOADER.DECODE_SHORT_SIDE = decode_short_side
+        clips, decode_seconds, sample_seconds, stats = _decode_samples(
+            cfg, cfg.BENCHMARK.NUM_SAMPLES
+        )
+        results[name] = clips
+        num_clips = max(len(clips), 1)
+        clip_bytes = np.mean(
+            [clip.numel() for clip in clips if clip is not None] or [0]
+        )
+        logger.info(
+            "{} decoding: {:.2f} ms per clip, {} frames decoded for {} "
+            "frames used, {:.2f} MB per uint8 clip ({:.2f} MB once "
+            "normalized), {:.2f} ms per training sample.".format(
+                name,
+                decode_seconds / num_clips * 1000,
+                stats["decoded_frames"],
+                stats["used_frames"],
+                clip_bytes / 1024 ** 2,
+                clip_bytes * 4 / 1024 ** 2,
+                sample_seconds / num_clips * 1000,
+            )
+        )
+    num_equal = sum(
+        dense is not None and sparse is not None and torch.equal(dense, sparse)
+        for dense, sparse in zip(results["Dense"], results["Sparse"])
+    )
+    logger.info(
+        "{}/{} clips are identical with and without sparse decoding.".format(
+            num_equal, len(results["Dense"])
+        )
+    )
+
+
+def benchmark_spatial_sampling(cfg):
+    """
+    Benchmark the spatial sampling of decoded training clips, scaling the
+    whole frames before cropping them and only interpolating the crop window,
+    with the training and the testing geometry. Both are run with the same
+    random state, and their largest difference is logged.
+    Args:
+        cfg (CfgNode): configs. Details can be found in
+            lib/config/defaults.py
+    """
+    setup_environment()
+    logging.setup_logging(cfg.OUTPUT_DIR)
+    logger.info("Benchmark spatial sampling with config:")
+    logger.info(pprint.pformat(cfg))
+
+    clips, _, _, _ = _decode_samples(cfg, cfg.BENCHMARK.NUM_SAMPLES)
+    clips = [
+        data_utils.tensor_normalize(
+            clip, cfg.DATA.MEAN, cfg.DATA.STD
+        ).permute(3, 0, 1, 2)
+        for clip in clips
+        if clip is not None
+    ]
+    geometries = [
+        (
+            "Train",
+            [-1],
+            cfg.DATA.TRAIN_JITTER_SCALES[0],
+            cfg.DATA.TRAIN_JITTER_SCALES[1],
+            cfg.DATA.TRAIN_CROP_SIZE,
+        ),
+        (
+            "Test",
+            [0, 1, 2],
+            cfg.DATA.TEST_CROP_SIZE,
+            cfg.DATA.TEST_CROP_SIZE,
+            cfg.DATA.TEST_CROP_SIZE,
+        ),
+    ]
+    for name, spatial_indices, min_scale, max_scale, crop_size in geometries:
+        seconds = {False: 0.0, True: 0.0}
+        max_diff = 0.0
+        for index, clip in enumerate(clips):
+            for spatial_idx in spatial_indices:
+                crops = {}
+                for crop_then_resize in [False, True]:
+                    _seed(index)
+                    timer = Timer()
+                    crops[crop_then_resize] = data_utils.spatial_sampling(
+                        clip,
+                        spatial_idx=spatial_idx,
+                        min_scale=min_scale,
+                        max_scale=max_scale,
+                        crop_size=crop_size,
+                        random_horizontal_flip=cfg.DATA.RANDOM_FLIP,
+                        inverse_uniform_sampling=cfg.DATA.INV_UNIFORM_SAMPLE,
+                        crop_then_resize=crop_then_resize,
+                    )
+                    seconds[crop_then_resize] += timer.seconds()
+                max_diff = max(
+                    max_diff,
+                    (crops[False] - crops[True]).abs().max().item(),
+                )
+        num_samples = max(len(clips) * len(spatial_indices), 1)
+        logger.info(
+            "{} spatial sampling of {} crops: {:.2f} ms per crop scaling the "
+            "frames, {:.2f} ms per crop interpolating the crop window, "
+            "largest difference {:.2e}.".format(
+                name,
+                num_samples,
+                seconds[False] / num_samples * 1000,
+                seconds[True] / num_samples * 1000,
+                max_diff,
+            )
+        )
+
+
+def _saved_bytes(fn):
+    """
+    Run fn, counting the bytes of the tensors saved for backward.
+    Args:
+        fn (callable): function to run.
+    Returns:
+        output (any): output of fn.
+        num_bytes (float): bytes of the tensors saved for backward, tensors
+            sharing their storage are counted once. NaN if the saved tensor
+            hooks are not available, they require PyTorch 1.10.
+    """
+    try:
+        from torch.autograd.graph import saved_tensors_hooks
+    except ImportError:
+        return fn(), float("nan")
+    storages = {}
+
+    def pack(tensor):
+        if hasattr(tensor, "untyped_storage"):
+            storage = tensor.untyped_storage()
+            num_bytes = storage.nbytes()
+        else:
+            storage = tensor.storage()
+            num_bytes = storage.size() * storage.element_size()
+        storages[storage.data_ptr()] = num_bytes
+        return tensor
+
+    with saved_tensors_hooks(pack, lambda x: x):
+        output = fn()
+    return output, sum(storages.values())
+
+
+def benchmark_vmps(cfg):
+    """
+    Benchmark the forward and backward of the video motion prompt on a
+    training batch, with the reference and the fused implementation, in
+    float32 and half precision. The bytes saved for backward, the peak memory
+    on CUDA, and the largest differences of the prompts and of the input
+    gradients are logged.
+    Args:
+        cfg (CfgNode): configs. Details can be found in
+            lib/config/defaults.py
+    """
+    setup_environment()
+    logging.setup_logging(cfg.OUTPUT_DIR)
+    logger.info("Benchmark video motion prompt with config:")
+    logger.info(pprint.pformat(cfg))
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    half = torch.float16 if device.type == "cuda" else torch.bfloat16
+    batch_size = int(cfg.TRAIN.BATCH_SIZE / max(1, cfg.NUM_GPUS))
+    shape = (
+        batch_size,
+        3,
+        cfg.DATA.NUM_FRAMES,
+        cfg.DATA.TRAIN_CROP_SIZE,
+        cfg.DATA.TRAIN_CROP_SIZE,
+    )
+    num_iters = cfg.BENCHMARK.LOG_PERIOD
+    torch.manual_seed(0)
+    inputs = torch.randn(shape, device=device)
+    reference = VideoMotionPrompt(penalty_weight=cfg.VMPS.PENALTY_WEIGHT)
+
+    for dtype in [torch.float32, half]:
+        results = {}
+        for fused in [False, True]:
+            vmps = VideoMotionPrompt(
+                penalty_weight=cfg.VMPS.PENALTY_WEIGHT, fused=fused
+            ).to(device)
+            vmps.load_state_dict(reference.state_dict())
+            x = inputs.to(dtype).detach().requires_grad_(True)
+
+            def step():
+                x.grad = None
+                (prompt, loss), num_bytes = _saved_bytes(lambda: vmps(x))
+                (prompt.float().mean() + loss).backward()
+                return prompt, num_bytes
+
+            # Warm up.
+            step()
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+                torch.cuda.reset_peak_memory_stats()
+            timer = Timer()
+            for _ in range(num_iters):
+                prompt, num_bytes = step()
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            peak = (
+                torch.cuda.max_memory_allocated() / 1024 ** 2
+                if device.type == "cuda"
+                else float("nan")
+            )
+            results[fused] = (prompt.detach().float(), x.grad.float())
+            logger.info(
+                "{} {}: {:.2f} ms per forward and backward, {:.1f} MB saved "
+                "for backward, {:.1f} MB peak memory.".format(
+                    "Fused" if fused else "Reference",
+                    dtype,
+                    timer.seconds() / num_iters * 1000,
+                    num_bytes / 1024 ** 2,
+                    peak,
+                )
+            )
+        logger.info(
+            "{}: largest difference of the prompts {:.2e}, of the input "
+            "gradients {:.2e}.".format(
+                dtype,
+                (results[False][0] - results[True][0]).abs().max().item(),
+                (results[False][1] - results[True][1]).abs().max().item(),
+            )
+        )
+
+
+@torch.no_grad()
+def benchmark_token_pruning(cfg):
+    """
+    Benchmark motion guided token pruning at the keep ratios of
+    BENCHMARK.TOKEN_KEEP_RATIOS, with the weights of the test checkpoint. For
+    every ratio, the gflops of a testing clip, its latency and the top-1 and
+    top-5 accuracies on BENCHMARK.NUM_SAMPLES validation clips are logged.
+    Args:
+        cfg (CfgNode): configs. Details can be found in
+            lib/config/defaults.py
+    """
+    setup_environment()
+    np.random.seed(cfg.RNG_SEED)
+    torch.manual_seed(cfg.RNG_SEED)
+    logging.setup_logging(cfg.OUTPUT_DIR)
+    logger.info("Benchmark token pruning with config:")
+    logger.info(pprint.pformat(cfg))
+
+    model = build_model(cfg)
+    cu.load_test_checkpoint(cfg, model)
+    model.eval()
+    vit = model.module.model if cfg.NUM_GPUS > 1 else model.model
+    val_loader = loader.construct_loader(cfg, "val")
+
+    clip = torch.rand(
+        1,
+        3,
+        cfg.DATA.NUM_FRAMES,
+        cfg.DATA.TEST_CROP_SIZE,
+        cfg.DATA.TEST_CROP_SIZE,
+    )
+    if cfg.NUM_GPUS:
+        clip = clip.cuda()
+    if cfg.DATA.NORMALIZE_ON_DEVICE:
+        clip = clip * 255.0
+    num_iters = cfg.BENCHMARK.LOG_PERIOD
+
+    for keep_ratio in cfg.BENCHMARK.TOKEN_KEEP_RATIOS:
+        vit.keep_ratio = keep_ratio
+        vit.keep_threshold = 0.0
+        gflops = misc.get_model_stats(model, cfg, "flop", False)
+
+        model(clip)
+        if cfg.NUM_GPUS:
+            torch.cuda.synchronize()
+        timer = Timer()
+        for _ in range(num_iters):
+            model(clip)
+        if cfg.NUM_GPUS:
+            torch.cuda.synchronize()
+        latency = timer.seconds() / num_iters
+
+        num_clips = 0
+        num_correct = [0.0, 0.0]
+        for inputs, labels, _, _ in val_loader:
+            if isinstance(inputs, (list,)):
+                inputs = inputs[0]
+            if cfg.NUM_GPUS:
+                inputs = inputs.cuda(non_blocking=True)
+                labels = labels.cuda()
+            preds, _ = model(inputs)
+            num_topks_correct = metrics.topks_correct(preds, labels, (1, 5))
+            num_correct = [
+                n + x.item() for n, x in zip(num_correct, num_topks_correct)
+            ]
+            num_clips += labels.size(0)
+            if num_clips >= cfg.BENCHMARK.NUM_SAMPLES:
+                break
+        num_clips = max(num_clips, 1)
+        logger.info(
+            "Keep ratio {:.2f}: {:.2f} gflops, {:.2f} ms per clip, top-1 "
+            "accuracy {:.2f}, top-5 accuracy {:.2f} on {} clips.".format(
+                keep_ratio,
+                gflops,
+                latency * 1000,
+                num_correct[0] / num_clips * 100.0,
+                num_correct[1] / num_clips * 100.0,
+                num_clips,
+            )
+        )
+
+
+def benchmark_attention(cfg):
+    """
+    Benchmark the forward and backward of the attention backends on the
+    temporal and spatial sequences of the divided space-time attention of a
+    training batch. The latency, the bytes saved for backward, the peak memory
+    on CUDA and the largest difference to the eager backend are logged.
+    Args:
+        cfg (CfgNode): configs. Details can be found in
+            lib/config/defaults.py
+    """
+    setup_environment()
+    logging.setup_logging(cfg.OUTPUT_DIR)
+    logger.info("Benchmark attention backends with config:")
+    logger.info(pprint.pformat(cfg))
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    batch_size = int(cfg.TRAIN.BATCH_SIZE / max(1, cfg.NUM_GPUS))
+    num_patches = (cfg.DATA.TRAIN_CROP_SIZE // 16) ** 2
+    sequences = [
+        ("Temporal", batch_size * num_patches, cfg.DATA.NUM_FRAMES),
+        ("Spatial", batch_size * cfg.DATA.NUM_FRAMES, num_patches + 1),
+    ]
+    num_iters = cfg.BENCHMARK.LOG_PERIOD
+    torch.manual_seed(0)
+    reference = Attention(768, num_heads=12, qkv_bias=True).to(device)
+
+    for name, num_sequences, length in sequences:
+        x = torch.randn(num_sequences, length, 768, device=device)
+        results = {}
+        for backend in ATTENTION_BACKENDS:
+            if backend != "eager" and not hasattr(
+                torch.nn.functional, "scaled_dot_product_attention"
+            ):
+                logger.info(
+                    "{} attention, {} backend: not available (requires "
+                    "PyTorch 2.0).".format(name, backend)
+                )
+                continue
+            attn = copy.deepcopy(reference)
+            attn.backend = backend
+            inputs = x.detach().requires_grad_(True)
+
+            def step():
+                inputs.grad = None
+                output, num_bytes = _saved_bytes(lambda: attn(inputs))
+                output.sum().backward()
+                return output, num_bytes
+
+            try:
+                # Warm up.
+                step()
+            except RuntimeError as e:
+                logger.info(
+                    "{} attention, {} backend: not available ({}).".format(
+                        name, backend, str(e).splitlines()[0]
+                    )
+                )
+                continue
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+                torch.cuda.reset_peak_memory_stats()
+            timer = Timer()
+            for _ in range(num_iters):
+                output, num_bytes = step()
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            peak = (
+                torch.cuda.max_memory_allocated() / 1024 ** 2
+                if device.type == "cuda"
+                else float("nan")
+            )
+            results[backend] = output.detach()
+            logger.info(
+                "{} attention of {} sequences of {} tokens, {} backend: "
+                "{:.2f} ms per forward and backward, {:.1f} MB saved for "
+                "backward, {:.1f} MB peak memory, largest difference to "
+                "eager {:.2e}.".format(
+                    name,
+                    num_sequences,
+                    length,
+                    backend,
+                    timer.seconds() / num_iters * 1000,
+                    num_bytes / 1024 ** 2,
+                    peak,
+                    (output.detach() - results["eager"]).abs().max().item(),
+                )
+            )
+
+
+def _build_copy_counter():
+    """
+    Build a dispatch mode which counts the calls and the bytes written by the
+    ops which only copy tensors.
+    Returns:
+        counter (TorchDispatchMode): the copy counter, or None if dispatch
+            modes are not available in this version of PyTorch.
+    """
+    try:
+        from torch.utils._python_dispatch import TorchDispatchMode
+    except ImportError:
+        return None
+
+    class CopyCounter(TorchDispatchMode):
+        COPY_OPS = ["copy_", "cat", "clone", "repeat", "stack"]
+
+        def __init__(self):
+            super().__init__()
+            self.calls = 0
+            self.num_bytes = 0
+
+        def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+            output = func(*args, **(kwargs or {}))
+            if func.overloadpacket.__name__ in self.COPY_OPS:
+                self.calls += 1
+                self.num_bytes += output.numel() * output.element_size()
+            return output
+
+    return CopyCounter()
+
+
+def benchmark_block(cfg):
+    """
+    Benchmark the forward and backward of a divided space-time block and of
+    its layout stable version on a training batch. The latency and the calls
+    and bytes of the copies are logged, the ones of the output concatenation
+    of the layout stable block included.
+    Args:
+        cfg (CfgNode): configs. Details can be found in
+            lib/config/defaults.py
+    """
+    setup_environment()
+    logging.setup_logging(cfg.OUTPUT_DIR)
+    logger.info("Benchmark layout stable block with config:")
+    logger.info(pprint.pformat(cfg))
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    B = int(cfg.TRAIN.BATCH_SIZE / max(1, cfg.NUM_GPUS))
+    T = cfg.DATA.NUM_FRAMES
+    W = cfg.DATA.TRAIN_CROP_SIZE // 16
+    num_iters = cfg.BENCHMARK.LOG_PERIOD
+    torch.manual_seed(0)
+    block = Block(768, 12, qkv_bias=True, drop_path=0.0).to(device)
+    stable_block = LayoutStableBlock(768, 12, qkv_bias=True, drop_path=0.0)
+    stable_block = stable_block.to(device)
+    stable_block.load_state_dict(block.state_dict())
+    x = torch.randn(B, 1 + W * W * T, 768, device=device)
+    # The layout stable blocks are fed the cls token and the contiguous
+    # spatial tokens.
+    x = x.requires_grad_(True)
+    cls_token = x[:, :1].detach().requires_grad_(True)
+    tokens = x[:, 1:].detach().contiguous().requires_grad_(True)
+
+    def step_block():
+        return block(x, B, T, W)
+
+    def step_stable_block():
+        return stable_block(cls_token, tokens, B, T, W)
+
+    outputs = {}
+    for name, step in [
+        ("Block", step_block),
+        ("Layout stable block", step_stable_block),
+    ]:
+        # Warm up, and count the copies.
+        counter = _build_copy_counter()
+        with counter if counter is not None else contextlib.nullcontext():
+            output = step()
+            if isinstance(output, tuple):
+                output = torch.cat(output, 1)
+            output.sum().backward()
+        outputs[name] = output.detach()
+
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        timer = Timer()
+        for _ in range(num_iters):
+            output = step()
+            if isinstance(output, tuple):
+                output = output[0].sum() + output[1].sum()
+            output.sum().backward()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        logger.info(
+            "{} of {} clips of {} frames: {:.2f} ms per forward and backward, "
+            "{}.".format(
+                name,
+                B,
+                T,
+                timer.seconds() / num_iters * 1000,
+                "{} copies of {:.1f} MB".format(
+                    counter.calls, counter.num_bytes / 1024 ** 2
+                )
+                if counter is not None
+                else "copies not counted",
+            )
+        )
+    logger.info(
+        "Largest difference of the outputs {:.2e}.".format(
+            (outputs["Block"] - outputs["Layout stable block"])
+            .abs()
+            .max()
+            .item()
+        )
+    )
+
+
+def benchmark_checkpointing(cfg):
+    """
+    Benchmark a training step of the model with the activation checkpointing
+    settings of BENCHMARK.CHECKPOINT_BLOCKS, with and without checkpointing
+    the VMPs. The step time, the bytes saved for backward and the peak
+    memory on CUDA are logged.
+    Args:
+        cfg (CfgNode): configs. Details can be found in
+            lib/config/defaults.py
+    """
+    setup_environment()
+    np.random.seed(cfg.RNG_SEED)
+    torch.manual_seed(cfg.RNG_SEED)
+    logging.setup_logging(cfg.OUTPUT_DIR)
+    logger.info("Benchmark activation checkpointing with config:")
+    logger.info(pprint.pformat(cfg))
+
+    model = build_model(cfg)
+    model.train()
+    wrapper = model.module if cfg.NUM_GPUS > 1 else model
+    device = next(model.parameters()).device
+    batch_size = int(cfg.TRAIN.BATCH_SIZE / max(1, cfg.NUM_GPUS))
+    inputs = torch.rand(
+        batch_size,
+        3,
+        cfg.DATA.NUM_CANDIDATE_FRAMES or cfg.DATA.NUM_FRAMES,
+        cfg.DATA.TRAIN_CROP_SIZE,
+        cfg.DATA.TRAIN_CROP_SIZE,
+        device=device,
+    )
+    if cfg.DATA.NORMALIZE_ON_DEVICE:
+        inputs = inputs * 255.0
+    labels = torch.randint(
+        cfg.MODEL.NUM_CLASSES, (batch_size,), device=device
+    )
+    loss_fun = torch.nn.CrossEntropyLoss()
+    num_iters = cfg.BENCHMARK.LOG_PERIOD
+
+    def step():
+        model.zero_grad(set_to_none=True)
+        (preds, vmps_loss), num_bytes = _saved_bytes(lambda: model(inputs))
+        (loss_fun(preds, labels) + vmps_loss).backward()
+        return num_bytes
+
+    vmps_settings = [False, True] if wrapper.vmps is not None else [False]
+    for checkpoint_blocks in cfg.BENCHMARK.CHECKPOINT_BLOCKS:
+        for checkpoint_vmps in vmps_settings:
+            wrapper.model.checkpoint_blocks = checkpoint_blocks
+            wrapper.checkpoint_vmps = checkpoint_vmps
+            # Warm up.
+            step()
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+                torch.cuda.reset_peak_memory_stats()
+            timer = Timer()
+            for _ in range(num_iters):
+                num_bytes = step()
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            peak = (
+                torch.cuda.max_memory_allocated() / 1024 ** 2
+                if device.type == "cuda"
+                else float("nan")
+            )
+            logger.info(
+                "Checkpointing segments of {} blocks{}: {:.2f} ms per "
+                "training step of {} clips, {:.1f} MB saved for backward, "
+                "{:.1f} MB peak memory.".format(
+                    checkpoint_blocks,
+                    ", and the VMPs" if checkpoint_vmps else "",
+                    timer.seconds() / num_iters * 1000,
+                    batch_size,
+                    num_bytes / 1024 ** 2,
+                    peak,
+                )
+            )
+
+
+def benchmark_amp(cfg):
+    """
+    Benchmark automatic mixed precision against float32, with the weights of
+    the test checkpoint. For both, the time of a training step, the testing
+    throughput and the top-1 and top-5 accuracies on BENCHMARK.NUM_SAMPLES
+    validation clips are logged, with the fraction of top-1 predictions of
+    mixed precision which agree with float32.
+    Args:
+        cfg (CfgNode): configs. Details can be found in
+            lib/config/defaults.py
+    """
+    setup_environment()
+    np.random.seed(cfg.RNG_SEED)
+    torch.manual_seed(cfg.RNG_SEED)
+    logging.setup_logging(cfg.OUTPUT_DIR)
+    logger.info("Benchmark mixed precision with config:")
+    logger.info(pprint.pformat(cfg))
+    if not cfg.NUM_GPUS:
+        logger.warning(
+            "Mixed precision is only applied on GPUs, both runs use float32."
+        )
+
+    model = build_model(cfg)
+    cu.load_test_checkpoint(cfg, model)
+    device = next(model.parameters()).device
+    val_loader = loader.construct_loader(cfg, "val")
+    batch_size = int(cfg.TRAIN.BATCH_SIZE / max(1, cfg.NUM_GPUS))
+    inputs = torch.rand(
+        batch_size,
+        3,
+        cfg.DATA.NUM_CANDIDATE_FRAMES or cfg.DATA.NUM_FRAMES,
+        cfg.DATA.TRAIN_CROP_SIZE,
+        cfg.DATA.TRAIN_CROP_SIZE,
+        device=device,
+    )
+    if cfg.DATA.NORMALIZE_ON_DEVICE:
+        inputs = inputs * 255.0
+    labels = torch.randint(
+        cfg.MODEL.NUM_CLASSES, (batch_size,), device=device
+    )
+    loss_fun = torch.nn.CrossEntropyLoss()
+    num_iters = cfg.BENCHMARK.LOG_PERIOD
+
+    fp32_preds = None
+    for amp in [False, True]:
+        cfg.AMP.ENABLE = amp
+        scaler = misc.build_grad_scaler(cfg)
+
+        def step():
+            model.zero_grad(set_to_none=True)
+            with misc.autocast(cfg):
+                preds, vmps_loss = model(inputs)
+                loss = loss_fun(preds, labels) + vmps_loss
+            scaler.scale(loss).backward()
+
+        model.train()
+        # Warm up.
+        step()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        timer = Timer()
+        for _ in range(num_iters):
+            step()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        step_time = timer.seconds() / num_iters
+
+        model.eval()
+        num_clips = 0
+        num_correct = [0.0, 0.0]
+        top1_preds = []
+        timer = Timer()
+        timer.pause()
+        with torch.no_grad():
+            for val_inputs, val_labels, _, _ in val_loader:
+                if isinstance(val_inputs, (list,)):
+                    val_inputs = val_inputs[0]
+                val_inputs = val_inputs.to(device, non_blocking=True)
+                val_labels = val_labels.to(device)
+                timer.resume()
+                with misc.autocast(cfg):
+                    preds, _ = model(val_inputs)
+                preds = preds.float()
+                if device.type == "cuda":
+                    torch.cuda.synchronize()
+                timer.pause()
+                num_topks_correct = metrics.topks_correct(
+                    preds, val_labels, (1, 5)
+                )
+                num_correct = [
+                    n + x.item() for n, x in zip(num_correct, num_topks_correct)
+                ]
+                top1_preds.append(preds.argmax(1).cpu())
+                num_clips += val_labels.size(0)
+                if num_clips >= cfg.BENCHMARK.NUM_SAMPLES:
+                    break
+        top1_preds = torch.cat(top1_preds) if top1_preds else torch.zeros(0)
+        if fp32_preds is None:
+            fp32_preds = top1_preds
+        num_clips = max(num_clips, 1)
+        logger.info(
+            "{}: {:.2f} ms per training step of {} clips, {:.2f} testing "
+            "clips/s, top-1 accuracy {:.2f}, top-5 accuracy {:.2f} on {} "
+            "clips, {:.2f}% top-1 predictions agree with float32.".format(
+                "Mixed precision in {}".format(misc.get_autocast_dtype(cfg))
+                if amp
+                else "Float32",
+                step_time * 1000,
+                batch_size,
+                num_clips / max(timer.seconds(), 1e-9),
+                num_correct[0] / num_clips * 100.0,
+                num_correct[1] / num_clips * 100.0,
+                num_clips,
+                (top1_preds == fp32_preds).float().mean().item() * 100.0,
+            )
+        )
+
+
+def benchmark_grad_accumulation(cfg):
+    """
+    Benchmark the optimizer steps of gradient accumulation over
+    GLOBAL_BATCH_SIZE / (NUM_SHARDS * TRAIN.BATCH_SIZE) iterations. The
+    gradients are either all-reduced in the backward pass of every iteration
+    and divided by the number of iterations before the step, or only
+    all-reduced in the last backward pass with DDP's no_sync and the loss
+    divided by the number of iterations. The step time, and the number and
+    size of the all-reduces of DDP per step are logged.
+    Args:
+        cfg (CfgNode): configs. Details can be found in
+            lib/config/defaults.py
+    """
+    setup_environment()
+    np.random.seed(cfg.RNG_SEED)
+    torch.manual_seed(cfg.RNG_SEED)
+    logging.setup_logging(cfg.OUTPUT_DIR)
+    logger.info("Benchmark gradient accumulation with config:")
+    logger.info(pprint.pformat(cfg))
+
+    model = build_model(cfg)
+    model.train()
+    optimizer = optim.construct_optimizer(model, cfg)
+    device = next(model.parameters()).device
+    batch_size = int(cfg.TRAIN.BATCH_SIZE / max(1, cfg.NUM_GPUS))
+    inputs = torch.rand(
+        batch_size,
+        3,
+        cfg.DATA.NUM_CANDIDATE_FRAMES or cfg.DATA.NUM_FRAMES,
+        cfg.DATA.TRAIN_CROP_SIZE,
+        cfg.DATA.TRAIN_CROP_SIZE,
+        device=device,
+    )
+    if cfg.DATA.NORMALIZE_ON_DEVICE:
+        inputs = inputs * 255.0
+    labels = torch.randint(
+        cfg.MODEL.NUM_CLASSES, (batch_size,), device=device
+    )
+    loss_fun = torch.nn.CrossEntropyLoss()
+    num_iters = max(
+        cfg.GLOBAL_BATCH_SIZE // (cfg.NUM_SHARDS * cfg.TRAIN.BATCH_SIZE), 1
+    )
+
+    # Count the all-reduces of the gradient buckets of DDP.
+    comm = {"calls": 0, "bytes": 0}
+    if cfg.NUM_GPUS > 1:
+
+        def count_hook(process_group, bucket):
+            comm["calls"] += 1
+            # GradBucket.buffer requires PyTorch 1.10.
+            if hasattr(bucket, "buffer"):
+                tensors = [bucket.buffer()]
+            else:
+                tensors = bucket.get_tensors()
+            comm["bytes"] += sum(t.numel() * t.element_size() for t in tensors)
+            return default_hooks.allreduce_hook(process_group, bucket)
+
+        model.register_comm_hook(None, count_hook)
+
+    def step(no_sync):
+        optimizer.zero_grad()
+        for cur_iter in range(num_iters):
+            if no_sync and cfg.NUM_GPUS > 1 and cur_iter + 1 < num_iters:
+                sync_context = model.no_sync()
+            else:
+                sync_context = contextlib.nullcontext()
+            with sync_context:
+                preds, vmps_loss = model(inputs)
+                loss = loss_fun(preds, labels) + vmps_loss
+                (loss / num_iters if no_sync else loss).backward()
+        if not no_sync:
+            for p in model.parameters():
+                if p.requires_grad:
+                    p.grad /= num_iters
+        optimizer.step()
+
+    for no_sync in [False, True]:
+        # Warm up.
+        step(no_sync)
+        comm["calls"], comm["bytes"] = 0, 0
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        timer = Timer()
+        for _ in range(cfg.BENCHMARK.LOG_PERIOD):
+            step(no_sync)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        logger.info(
+            "{}: {:.2f} ms per optimizer step of {} iterations, {:.1f} "
+            "all-reduces of {:.1f} MB per step.".format(
+                "All-reduce on the last iteration, loss divided"
+                if no_sync
+                else "All-reduce on every iteration, gradients divided",
+                timer.seconds() / cfg.BENCHMARK.LOG_PERIOD * 1000,
+                num_iters,
+                comm["calls"] / cfg.BENCHMARK.LOG_PERIOD,
+                comm["bytes"] / cfg.BENCHMARK.LOG_PERIOD / 1024 ** 2,
+            )
+        )
+
+
+def benchmark_stats_sync(cfg):
+    """
+    Benchmark the training iterations with their loss and errors copied to
+    the host on every iteration, or kept on the device by a StatsBuffer and
+    copied every LOG_PERIOD iterations. The time per iteration is logged, and
+    on CUDA the time per iteration the GPU is idle, the wall time which is not
+    spent in kernels or copies according to the profiler.
+    Args:
+        cfg (CfgNode): configs. Details can be found in
+            lib/config/defaults.py
+    """
+    setup_environment()
+    np.random.seed(cfg.RNG_SEED)
+    torch.manual_seed(cfg.RNG_SEED)
+    logging.setup_logging(cfg.OUTPUT_DIR)
+    logger.info("Benchmark the stats synchronization with config:")
+    logger.info(pprint.pformat(cfg))
+
+    model = build_model(cfg)
+    model.train()
+    optimizer = optim.construct_optimizer(model, cfg)
+    device = next(model.parameters()).device
+    batch_size = int(cfg.TRAIN.BATCH_SIZE / max(1, cfg.NUM_GPUS))
+    inputs = torch.rand(
+        batch_size,
+        3,
+        cfg.DATA.NUM_CANDIDATE_FRAMES or cfg.DATA.NUM_FRAMES,
+        cfg.DATA.TRAIN_CROP_SIZE,
+        cfg.DATA.TRAIN_CROP_SIZE,
+        device=device,
+    )
+    if cfg.DATA.NORMALIZE_ON_DEVICE:
+        inputs = inputs * 255.0
+    labels = torch.randint(
+        cfg.MODEL.NUM_CLASSES, (batch_size,), device=device
+    )
+    loss_fun = torch.nn.CrossEntropyLoss()
+    num_iters = cfg.BENCHMARK.LOG_PERIOD
+
+    def step():
+        optimizer.zero_grad()
+        preds, vmps_loss = model(inputs)
+        loss = loss_fun(preds, labels) + vmps_loss
+        loss.backward()
+        optimizer.step()
+        num_topks_correct = metrics.topks_correct(preds, labels, (1, 5))
+        top1_err, top5_err = [
+            (1.0 - x / preds.size(0)) * 100.0 for x in num_topks_correct
+        ]
+        return [loss.detach(), top1_err, top5_err]
+
+    for buffered in [False, True]:
+        stats_buffer = StatsBuffer(cfg.NUM_GPUS)
+        # Warm up.
+        step()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        if device.type == "cuda":
+            profile = torch.profiler.profile(
+                activities=[
+                    torch.profiler.ProfilerActivity.CPU,
+                    torch.profiler.ProfilerActivity.CUDA,
+                ]
+            )
+        else:
+            profile = contextlib.nullcontext()
+        with profile as prof:
+            timer = Timer()
+            for cur_iter in range(num_iters):
+                stats = step()
+                if buffered:
+                    stats_buffer.append(stats)
+                    if (cur_iter + 1) % cfg.LOG_PERIOD == 0:
+                        for (loss, _, _), _ in stats_buffer.flush():
+                            misc.check_nan_losses(loss)
+                else:
+                    misc.check_nan_losses(stats[0])
+                    if cfg.NUM_GPUS > 1:
+                        stats = du.all_reduce(stats)
+                    stats = [x.item() for x in stats]
+            for (loss, _, _), _ in stats_buffer.flush():
+                misc.check_nan_losses(loss)
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            seconds = timer.seconds()
+        if device.type == "cuda":
+            # self_device_time_total replaces self_cuda_time_total in
+            # PyTorch 2.4.
+            busy = sum(
+                e.self_device_time_total
+                if hasattr(e, "self_device_time_total")
+                else e.self_cuda_time_total
+                for e in prof.key_averages()
+            ) / 1e6
+            idle = (seconds - busy) / num_iters * 1000
+        else:
+            idle = float("nan")
+        logger.info(
+            "Stats copied to the host {}: {:.2f} ms per iteration, the GPU is "
+            "idle {:.2f} ms per iteration.".format(
+                "every {} iterations".format(cfg.LOG_PERIOD)
+                if buffered
+                else "on every iteration",
+                seconds / num_iters * 1000,
+                idle,
+            )
+        )
+
+
+def benchmark_prefetch(cfg):
+    """
+    Benchmark the training iterations with the batches transferred to the
+    device when they are dequeued, or staged by the DevicePrefetcher while
+    the previous batch is computed. The time per iteration spent waiting for
+    the batch, which TrainMeter counts as data time, and the time per
+    iteration are logged.
+    Args:
+        cfg (CfgNode): configs. Details can be found in
+            lib/config/defaults.py
+    """
+    setup_environment()
+    np.random.seed(cfg.RNG_SEED)
+    torch.manual_seed(cfg.RNG_SEED)
+    logging.setup_logging(cfg.OUTPUT_DIR)
+    logger.info("Benchmark the device prefetching with config:")
+    logger.info(pprint.pformat(cfg))
+
+    model = build_model(cfg)
+    model.train()
+    optimizer = optim.construct_optimizer(model, cfg)
+    train_loader = loader.construct_loader(cfg, "train")
+    loss_fun = torch.nn.CrossEntropyLoss()
+    num_iters = min(cfg.BENCHMARK.LOG_PERIOD, len(train_loader))
+
+    for prefetch in [False, True]:
+        cfg.DATA_LOADER.ENABLE_DEVICE_PREFETCH = prefetch
+        train_iter = iter(loader.DevicePrefetcher(train_loader, cfg))
+        # Warm up, the workers start loading the first batches.
+        next(train_iter)
+        data_seconds = 0.0
+        timer = Timer()
+        for _ in range(num_iters - 1):
+            data_timer = Timer()
+            inputs, labels, _, meta = next(train_iter)
+            data_seconds += data_timer.seconds()
+            optimizer.zero_grad()
+            preds, vmps_loss = model(inputs)
+            loss = loss_fun(preds, labels) + vmps_loss
+            loss.backward()
+            optimizer.step()
+        if cfg.NUM_GPUS:
+            torch.cuda.synchronize()
+        seconds = timer.seconds()
+        train_iter.close()
+        logger.info(
+            "Batches {}: {:.2f} ms per iteration waiting for the data, "
+            "{:.2f} ms per iteration.".format(
+                "prefetched" if prefetch else "transferred when dequeued",
+                data_seconds / max(num_iters - 1, 1) * 1000,
+                seconds / max(num_iters - 1, 1) * 1000,
+            )
+        )
+
+
+def benchmark_test_aggregation(cfg):
+    """
+    Benchmark the aggregation of the multi-view test predictions across the
+    processes, with BENCHMARK.NUM_SAMPLES videos and random predictions in
+    place of the model. The predictions, labels and clip indices of every
+    iteration are all gathered and every process ensembles all of them, or
+    every process ensembles its own clips and the ensembles are reduced to
+    the root process once. The wall time of the test loop and the bytes sent
+    between the processes, at least one copy of the data of every process to
+    every process which receives it, are logged.
+    Args:
+        cfg (CfgNode): configs. Details can be found in
+            lib/config/defaults.py
+    """
+    setup_environment()
+    logging.setup_logging(cfg.OUTPUT_DIR)
+    logger.info("Benchmark the test aggregation with config:")
+    logger.info(pprint.pformat(cfg))
+
+    world_size = du.get_world_size()
+    rank = du.get_rank()
+    device = torch.device("cuda" if cfg.NUM_GPUS else "cpu")
+    num_videos = cfg.BENCHMARK.NUM_SAMPLES
+    num_clips = cfg.TEST.NUM_ENSEMBLE_VIEWS * cfg.TEST.NUM_SPATIAL_CROPS
+    num_cls = cfg.MODEL.NUM_CLASSES
+    batch_size = int(cfg.TEST.BATCH_SIZE / max(1, cfg.NUM_GPUS))
+    # The clips of the process, as with a DistributedSampler.
+    clip_ids = torch.arange(rank, num_videos * num_clips, world_size)
+    generator = torch.Generator().manual_seed(cfg.RNG_SEED)
+    all_preds = torch.rand(num_videos * num_clips, num_cls, generator=generator)
+    all_labels = torch.randint(num_cls, (num_videos,), generator=generator)
+    num_iters = (len(clip_ids) + batch_size - 1) // batch_size
+
+    video_stats = None
+    for local in [False, True]:
+        test_meter = TestMeter(
+            num_videos,
+            num_clips,
+            num_cls,
+            num_iters,
+            cfg.DATA.MULTI_LABEL,
+            cfg.DATA.ENSEMBLE_METHOD,
+        )
+        num_bytes = 0
+        du.synchronize()
+        timer = Timer()
+        for cur_iter in range(num_iters):
+            start = cur_iter * batch_size
+            video_idx = clip_ids[start : start + batch_size]
+            preds = all_preds[video_idx].to(device)
+            labels = all_labels[video_idx // num_clips].to(device)
+            video_idx = video_idx.to(device)
+            if not local and world_size > 1:
+                num_bytes += (
+                    world_size
+                    * (world_size - 1)
+                    * sum(
+                        x.numel() * x.element_size()
+                        for x in [preds, labels, video_idx]
+                    )
+                )
+                preds, labels, video_idx = du.all_gather(
+                    [preds, labels, video_idx]
+                )
+            test_meter.update_stats(
+                preds.cpu(), labels.cpu(), video_idx.cpu()
+            )
+        if local and world_size > 1:
+            # The predictions, labels and clip counts are reduced in float.
+            num_bytes += (
+                (world_size - 1)
+                * (
+                    test_meter.video_preds.numel()
+                    + test_meter.video_labels.numel()
+                    + test_meter.clip_count.numel()
+                )
+                * 4
+            )
+            test_meter.reduce_stats()
+        if not local or du.is_root_proc():
+            test_meter.finalize_metrics()
+        du.synchronize()
+        seconds = timer.seconds()
+        if du.is_root_proc():
+            stats = [
+                test_meter.video_preds.clone(),
+                test_meter.video_labels.clone(),
+                test_meter.clip_count.clone(),
+            ]
+            if video_stats is None:
+                video_stats = stats
+            agree = all(
+                torch.allclose(x.double(), y.double())
+                for x, y in zip(video_stats, stats)
+            )
+            logger.info(
+                "{} processes, {}: {:.3f} seconds, {:.2f} MB sent between the "
+                "processes, ensembles {} the all gather.".format(
+                    world_size,
+                    "one reduction of the local ensembles"
+                    if local
+                    else "all gather on every iteration",
+                    seconds,
+                    num_bytes / 1024 ** 2,
+                    "equal to" if agree else "different from",
+                )
+            )
@@ -110,7 +110,7 @@ def is_checkpoint_epoch(cfg, cur_epoch, multigrid_schedule=None):
     return (cur_epoch + 1) % cfg.TRAIN.CHECKPOINT_PERIOD == 0
 
 
-def save_checkpoint(path_to_job, model, optimizer, epoch, cfg):
+def save_checkpoint(path_to_job, model, optimizer, epoch, cfg, scaler=None):
     """
     Save a checkpoint.
     Args:
@@ -118,6 +118,8 @@ def save_checkpoint(path_to_job, model, optimizer, epoch, cfg):
         optimizer (optim): optimizer to save the historical state.
         epoch (int): current number of epoch of the model.
         cfg (CfgNode): configs to save.
+        scaler (GradScaler): gradient scaler of mixed precision training to
+            save the loss scale, if enabled.
     """
     # Save checkpoints only from the master process.
     if not du.is_master_proc(cfg.NUM_GPUS * cfg.NUM_SHARDS):
@@ -135,6 +137,8 @@ def save_checkpoint(path_to_job, model, optimizer, epoch, cfg):
         "optimizer_state": optimizer.state_dict(),
         "cfg": cfg.dump(),
     }
+    if scaler is not None and scaler.is_enabled():
+        checkpoint["scaler_state"] = scaler.state_dict()
     # Write the checkpoint.
     path_to_checkpoint = get_path_to_checkpoint(path_to_job, epoch + 1)
     with PathManager.open(path_to_checkpoint, "wb") as f:
@@ -202,6 +206,7 @@ def load_checkpoint(
     convert_from_caffe2=False,
     epoch_reset=False,
     clear_name_pattern=(),
+    scaler=None,
 ):
     """
     Load the checkpoint from the given file. If inflation is True, inflate the
@@ -218,6 +223,8 @@ def load_checkpoint(
         epoch_reset (bool): if True, reset #train iterations from the checkpoint.
         clear_name_pattern (string): if given, this (sub)string will be cleared
             from a layer name if it can be matched.
+        scaler (GradScaler): gradient scaler of mixed precision training to
+            load the loss scale, if saved in the checkpoint.
     Returns:
         (int): the number of training epoch of the checkpoint.
     """
@@ -401,6 +408,8 @@ def load_checkpoint(
             epoch = checkpoint["epoch"]
             if optimizer:
                 optimizer.load_state_dict(checkpoint["optimizer_state"])
+            if scaler is not None and "scaler_state" in checkpoint:
+                scaler.load_state_dict(checkpoint["scaler_state"])
         else:
             epoch = -1
     return epoch
@@ -546,7 +555,7 @@ def load_test_checkpoint(cfg, model):
         )
 
 
-def load_train_checkpoint(cfg, model, optimizer):
+def load_train_checkpoint(cfg, model, optimizer, scaler=None):
     """
     Loading checkpoint logic for training.
     """
@@ -554,7 +563,7 @@ def load_train_checkpoint(cfg, model, optimizer):
         last_checkpoint = get_last_checkpoint(cfg.OUTPUT_DIR, cfg.MODEL_INDEX)
         logger.info("Load from last checkpoint, {}.".format(last_checkpoint))
         checkpoint_epoch = load_checkpoint(
-            last_checkpoint, model, cfg.NUM_GPUS > 1, optimizer
+            last_checkpoint, model, cfg.NUM_GPUS > 1, optimizer, scaler=scaler
         )
         start_epoch = checkpoint_epoch + 1
     elif cfg.TRAIN.CHECKPOINT_FILE_PATH != "":
@@ -568,6 +577,7 @@ def load_train_checkpoint(cfg, model, optimizer):
             convert_from_caffe2=cfg.TRAIN.CHECKPOINT_TYPE == "caffe2",
             epoch_reset=cfg.TRAIN.CHECKPOINT_EPOCH_RESET,
             clear_name_pattern=cfg.TRAIN.CHECKPOINT_CLEAR_NAME_PATTERN,
+            scaler=scaler,
         )
         start_epoch = checkpoint_epoch + 1
     else:
@@ -33,6 +33,28 @@ def all_gather(tensors):
     return output_tensor
 
 
+def reduce(tensors, dst=0, op=dist.ReduceOp.SUM):
+    """
+    Reduce the provided tensors from all processes across machines to the
+    destination process.
+    Args:
+        tensors (list): tensors to reduce across all processes in all machines.
+        dst (int): rank of the destination process.
+        op (ReduceOp): the reduction operation.
+    Returns:
+        tensors (list): the reduced tensors on the destination process, on the
+            device of the provided tensors. Undefined on the other processes.
+    """
+    reduced = []
+    for tensor in tensors:
+        device = tensor.device
+        if dist.get_backend() == "nccl":
+            tensor = tensor.cuda()
+        dist.reduce(tensor, dst=dst, op=op, async_op=False)
+        reduced.append(tensor.to(device))
+    return reduced
+
+
 def all_reduce(tensors, average=True):
     """
     All reduce the provided tensors from all processes across machines.
@@ -7,9 +7,11 @@ import numpy as np
 import os
 from collections import defaultdict, deque
 import torch
+import torch.distributed as dist
 from fvcore.common.timer import Timer
 from sklearn.metrics import average_precision_score
 
+import timesformer.utils.distributed as du
 import timesformer.utils.logging as logging
 import timesformer.utils.metrics as metrics
 import timesformer.utils.misc as misc
@@ -52,6 +54,8 @@ class TestMeter(object):
         self.iter_timer = Timer()
         self.data_timer = Timer()
         self.net_timer = Timer()
+        # Total time of the forward passes.
+        self.net_seconds = 0.0
         self.num_clips = num_clips
         self.overall_iters = overall_iters
         self.multi_label = multi_label
@@ -118,6 +122,48 @@ class TestMeter(object):
                 )
             self.clip_count[vid_id] += 1
 
+    def reduce_stats(self, dst=0):
+        """
+        Combine the ensembled predictions, labels and clip counts of the
+        videos, updated by every process with its own clips, on the
+        destination process. With the "sum" ensemble they are reduced at
+        once, with the "max" ensemble the predictions are reduced separately.
+        The stats of the other processes are undefined afterwards.
+        Args:
+            dst (int): rank of the destination process.
+        """
+        if self.ensemble_method not in ["sum", "max"]:
+            raise NotImplementedError(
+                "Ensemble Method {} is not supported".format(
+                    self.ensemble_method
+                )
+            )
+        num_videos, num_cls = self.video_preds.shape
+        init = -1e10 if self.multi_label else 0.0
+        clip_count = self.clip_count.view(num_videos, 1).float()
+        # The labels are weighted by the clip counts, zero on the processes
+        # which did not see the video.
+        stats = [
+            self.video_labels.view(num_videos, -1).float() * clip_count,
+            clip_count,
+        ]
+        if self.ensemble_method == "sum":
+            # Every process started from the initial predictions.
+            stats.insert(0, self.video_preds - init)
+            stats = du.reduce([torch.cat(stats, dim=1)], dst=dst)[0]
+            video_preds, stats = stats[:, :num_cls], stats[:, num_cls:]
+            video_preds += init
+        else:
+            video_preds = du.reduce(
+                [self.video_preds.clone()], dst=dst, op=dist.ReduceOp.MAX
+            )[0]
+            stats = du.reduce([torch.cat(stats, dim=1)], dst=dst)[0]
+        labels, clip_count = stats[:, :-1], stats[:, -1:]
+        labels = labels / clip_count.clamp(min=1)
+        self.video_preds.copy_(video_preds)
+        self.video_labels.copy_(labels.view_as(self.video_labels).round())
+        self.clip_count.copy_(clip_count.view(num_videos).round())
+
     def log_iter_stats(self, cur_iter):
         """
         Log the stats.
@@ -147,6 +193,7 @@ class TestMeter(object):
         """
         self.iter_timer.pause()
         self.net_timer.pause()
+        self.net_seconds += self.net_timer.seconds()
 
     def data_toc(self):
         self.data_timer.pause()
@@ -245,6 +292,58 @@ class ScalarMeter(object):
         return self.total / self.count
 
 
+class StatsBuffer(object):
+    """
+    Keep the stats of the iterations on the device, and average them across
+    the processes and copy them to the host at once, in one all reduce and one
+    synchronization.
+    """
+
+    def __init__(self, num_gpus):
+        """
+        Args:
+            num_gpus (int): number of GPUs, the stats are averaged across the
+                processes if larger than 1.
+        """
+        self._num_gpus = num_gpus
+        self._stats = []
+        self._infos = []
+
+    def __len__(self):
+        return len(self._stats)
+
+    def append(self, stats, **info):
+        """
+        Add the stats of an iteration.
+        Args:
+            stats (list): scalar tensors of the iteration, on the device.
+            info: values of the iteration known on the host, e.g. the
+                learning rate, returned with the stats.
+        """
+        self._stats.append(
+            torch.stack([torch.as_tensor(x).detach().float() for x in stats])
+        )
+        self._infos.append(info)
+
+    def flush(self):
+        """
+        Average the stats across the processes and copy them to the host.
+        Returns:
+            (list): for every added iteration, the list of its stats (float)
+                and the dict of its info.
+        """
+        if not self._stats:
+            return []
+        stats = torch.stack(self._stats)
+        if self._num_gpus > 1:
+            [stats] = du.all_reduce([stats])
+        # Copy the stats from GPU to CPU (sync point).
+        stats = stats.tolist()
+        infos = self._infos
+        self._stats, self._infos = [], []
+        return list(zip(stats, infos))
+
+
 class TrainMeter(object):
     """
     Measure training stats.
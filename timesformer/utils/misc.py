@@ -1,5 +1,6 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
 
+import contextlib
 import json
 import logging
 import math
@@ -32,6 +33,53 @@ def check_nan_losses(loss):
         raise RuntimeError("ERROR: Got NaN losses {}".format(datetime.now()))
 
 
+def get_autocast_dtype(cfg):
+    """
+    Return the data type of automatic mixed precision, AMP.DTYPE, by default
+    float16.
+    Args:
+        cfg (CfgNode): configs. Details can be found in
+            slowfast/config/defaults.py
+    Returns:
+        dtype (torch.dtype): data type of autocast.
+    """
+    return getattr(torch, cfg.AMP.DTYPE or "float16")
+
+
+def autocast(cfg):
+    """
+    Return the autocast context of the forward passes, enabled by AMP.ENABLE.
+    Mixed precision is only applied on GPUs, CPU runs stay in float32.
+    Args:
+        cfg (CfgNode): configs. Details can be found in
+            slowfast/config/defaults.py
+    """
+    if not cfg.AMP.ENABLE or not cfg.NUM_GPUS:
+        return contextlib.nullcontext()
+    dtype = get_autocast_dtype(cfg)
+    if dtype == torch.float16:
+        return torch.cuda.amp.autocast()
+    # The data type of autocast requires PyTorch 1.10.
+    return torch.cuda.amp.autocast(dtype=dtype)
+
+
+def build_grad_scaler(cfg):
+    """
+    Build the gradient scaler of the training loss. It is only enabled with
+    automatic mixed precision in float16, bfloat16 has the range of float32.
+    Args:
+        cfg (CfgNode): configs. Details can be found in
+            slowfast/config/defaults.py
+    Returns:
+        scaler (GradScaler): gradient scaler.
+    """
+    return torch.cuda.amp.GradScaler(
+        enabled=cfg.AMP.ENABLE
+        and cfg.NUM_GPUS > 0
+        and get_autocast_dtype(cfg) == torch.float16
+    )
+
+
 def params_count(model, ignore_bn=False):
     """
     Compute the number of parameters.
@@ -74,6 +122,47 @@ def cpu_mem_usage():
     return usage, total
 
 
+def loader_worker_mem_usage():
+    """
+    Compute the memory usage of the data loader workers, i.e. the child
+    processes of the current process (GB). USS counts the pages private to a
+    worker, which includes the pages copied on write from the parent.
+    Returns:
+        rss (list): resident set size of every worker (GB).
+        uss (list): unique set size of every worker (GB).
+    """
+    rss, uss = [], []
+    for child in psutil.Process().children(recursive=True):
+        try:
+            mem = child.memory_full_info()
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            continue
+        rss.append(mem.rss / 1024 ** 3)
+        uss.append(mem.uss / 1024 ** 3)
+    return rss, uss
+
+
+def loader_worker_cpu_usage():
+    """
+    Compute the CPU usage of the data loader workers, i.e. the child processes
+    of the current process. Involuntary context switches happen when a thread
+    is preempted, they grow with the oversubscription of the CPUs.
+    Returns:
+        threads (dict): number of threads of every worker, by pid.
+        switches (dict): number of involuntary context switches of every
+            worker since it started, by pid.
+    """
+    threads, switches = {}, {}
+    for child in psutil.Process().children(recursive=True):
+        try:
+            with child.oneshot():
+                threads[child.pid] = child.num_threads()
+                switches[child.pid] = child.num_ctx_switches().involuntary
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            continue
+    return threads, switches
+
+
 def _get_model_analysis_input(cfg, use_train_input):
     """
     Return a dummy input for model analysis with batch size 1. The input is
@@ -88,17 +177,19 @@ def _get_model_analysis_input(cfg, use_train_input):
         inputs: the input for model analysis.
     """
     rgb_dimension = 3
+    # The model selects DATA.NUM_FRAMES of the candidate frames itself.
+    num_frames = cfg.DATA.NUM_CANDIDATE_FRAMES or cfg.DATA.NUM_FRAMES
     if use_train_input:
         input_tensors = torch.rand(
             rgb_dimension,
-            cfg.DATA.NUM_FRAMES,
+            num_frames,
             cfg.DATA.TRAIN_CROP_SIZE,
             cfg.DATA.TRAIN_CROP_SIZE,
         )
     else:
         input_tensors = torch.rand(
             rgb_dimension,
-            cfg.DATA.NUM_FRAMES,
+            num_frames,
             cfg.DATA.TEST_CROP_SIZE,
             cfg.DATA.TEST_CROP_SIZE,
         )
@@ -110,7 +201,9 @@ def _get_model_analysis_input(cfg, use_train_input):
                model_inputs[i] = model_inputs[i].cuda(non_blocking=True)
 
     else:
-       model_inputs = input_tensors.cuda(non_blocking=True).unsqueeze(0)
+       model_inputs = input_tensors.unsqueeze(0)
+       if cfg.NUM_GPUS:
+           model_inputs = model_inputs.cuda(non_blocking=True)
 
     # If detection is enabled, count flops for one proposal.
     if cfg.DETECTION.ENABLE:
@@ -123,6 +216,23 @@ def _get_model_analysis_input(cfg, use_train_input):
     return inputs
 
 
+class _Predictions(torch.nn.Module):
+    """
+    Return the predictions only of a model which returns them with its VMPs
+    loss, which jit tracing can not follow when it is not a tensor.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, *inputs):
+        outputs = self.model(*inputs)
+        if isinstance(outputs, tuple):
+            outputs = outputs[0]
+        return outputs
+
+
 def get_model_stats(model, cfg, mode, use_train_input):
     """
     Compute statistics for the current model given the config.
@@ -152,7 +262,7 @@ def get_model_stats(model, cfg, mode, use_train_input):
     model_mode = model.training
     model.eval()
     inputs = _get_model_analysis_input(cfg, use_train_input)
-    count_dict, *_ = model_stats_fun(model, inputs)
+    count_dict, *_ = model_stats_fun(_Predictions(model), inputs)
     count = sum(count_dict.values())
     model.train(model_mode)
     return count
@@ -0,0 +1,174 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
+
+"""Watchdog of non-finite training losses and gradients."""
+
+import copy
+import os
+import torch
+from fvcore.common.file_io import PathManager
+
+import timesformer.utils.distributed as du
+import timesformer.utils.logging as logging
+
+logger = logging.get_logger(__name__)
+
+
+class NonFiniteWatchdog(object):
+    """
+    Flag the training iterations with a non-finite loss, and optionally a
+    non-finite gradient norm, on the device. The flags are meant to be copied
+    to the host with the other training stats at the log periods. To replay
+    the iterations of a period after one of them was flagged, the states of
+    the model, its gradients, the optimizer and the gradient scaler are copied
+    to the host at the start of the period, and so are the batches of its
+    iterations, augmentations included.
+    """
+
+    def __init__(self, model, optimizer, scaler, cfg):
+        """
+        Args:
+            model (model): the video model to train.
+            optimizer (optim): the optimizer of the model's parameters.
+            scaler (GradScaler): gradient scaler of mixed precision training.
+            cfg (CfgNode): configs. Details can be found in
+                slowfast/config/defaults.py
+        """
+        self._model = model
+        self._optimizer = optimizer
+        self._scaler = scaler
+        self._cfg = cfg
+        # With loss scaling, non-finite gradients only skip the step.
+        self._check_grad_norm = (
+            cfg.WATCHDOG.GRAD_NORM and not scaler.is_enabled()
+        )
+        # Host buffers of the snapshots, pinned for asynchronous copies.
+        self._buffers = {}
+        self._snapshot = None
+        self.start_iter = 0
+        self.batches = []
+
+    def flag(self, loss):
+        """
+        Flag a non-finite loss or gradient norm of an iteration on the
+        device, without synchronization.
+        Args:
+            loss (tensor): loss of the iteration.
+        Returns:
+            (tensor): 1 if non-finite, else 0.
+        """
+        nonfinite = ~torch.isfinite(loss.detach())
+        if self._check_grad_norm:
+            grads = [
+                p.grad.detach()
+                for p in self._model.parameters()
+                if p.grad is not None
+            ]
+            if grads:
+                norm = torch.norm(torch.stack([g.norm() for g in grads]))
+                nonfinite |= ~torch.isfinite(norm)
+        return nonfinite.float()
+
+    def record(self, inputs, labels, index, meta):
+        """
+        Copy the batch of an iteration to the host, asynchronously from CUDA.
+        It must be recorded before the training step, which may modify the
+        inputs in place.
+        Args:
+            inputs (tensor or list): the clips of the iteration.
+            labels (tensor): the labels of the clips.
+            index (tensor): indices of the samples in the dataset.
+            meta (dict): the meta data of the clips.
+        """
+        self.batches.append(
+            self._copy(
+                (inputs, labels, index, meta), ("batch", len(self.batches))
+            )
+        )
+
+    def snapshot(self, cur_iter):
+        """
+        Copy the states at the start of a log period. The copies from CUDA are
+        asynchronous, they are complete when the stats of the period are
+        copied to the host.
+        Args:
+            cur_iter (int): first iteration of the period.
+        """
+        self.start_iter = cur_iter
+        self.batches = []
+        state = {
+            "model_state": self._model.state_dict(),
+            "grads": {
+                name: p.grad
+                for name, p in self._model.named_parameters()
+                if p.grad is not None
+            },
+            "optimizer_state": self._optimizer.state_dict(),
+            "scaler_state": self._scaler.state_dict(),
+        }
+        self._snapshot = self._copy(state, ())
+
+    def _copy(self, state, key):
+        if isinstance(state, dict):
+            return {k: self._copy(v, key + (k,)) for k, v in state.items()}
+        if isinstance(state, (list, tuple)):
+            return type(state)(
+                self._copy(v, key + (i,)) for i, v in enumerate(state)
+            )
+        if not torch.is_tensor(state):
+            return copy.deepcopy(state)
+        buffer = self._buffers.get(key)
+        if (
+            buffer is None
+            or buffer.shape != state.shape
+            or buffer.dtype != state.dtype
+        ):
+            buffer = torch.empty(
+                state.shape, dtype=state.dtype, pin_memory=state.is_cuda
+            )
+            self._buffers[key] = buffer
+        return buffer.copy_(state.detach(), non_blocking=True)
+
+    def save(self, cur_epoch, cur_iter):
+        """
+        Save the states at the start of the period of a flagged iteration,
+        with the batches of the iterations of the period.
+        Args:
+            cur_epoch (int): current epoch of training.
+            cur_iter (int): the flagged iteration.
+        Returns:
+            path (str): path of the saved file.
+        """
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        path_dir = os.path.join(self._cfg.OUTPUT_DIR, "nonfinite")
+        PathManager.mkdirs(path_dir)
+        path = os.path.join(
+            path_dir,
+            "epoch_{:05d}_iter_{:05d}_rank_{}.pyth".format(
+                cur_epoch, cur_iter, du.get_rank()
+            ),
+        )
+        state = {
+            "epoch": cur_epoch,
+            "start_iter": self.start_iter,
+            "iter": cur_iter,
+            "batches": self.batches,
+            "cfg": self._cfg.dump(),
+        }
+        state.update(self._snapshot)
+        with PathManager.open(path, "wb") as f:
+            torch.save(state, f)
+        return path
+
+    def restore(self):
+        """
+        Restore the states at the start of the period.
+        """
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        self._model.load_state_dict(self._snapshot["model_state"])
+        grads = self._snapshot["grads"]
+        for name, p in self._model.named_parameters():
+            p.grad = grads[name].to(p.device, copy=True) if name in grads else None
+        self._optimizer.load_state_dict(self._snapshot["optimizer_state"])
+        self._scaler.load_state_dict(self._snapshot["scaler_state"])
@@ -1,10 +1,28 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
 """
-A script to benchmark data loading.
+A script to benchmark data loading, video decoding, spatial sampling, the
+video motion prompt, motion guided token pruning, the attention backends, the
+layout stable block, activation checkpointing, mixed precision, gradient
+accumulation, the synchronization of the training stats, the device
+prefetching and the aggregation of the test predictions.
 """
 
 import timesformer.utils.logging as logging
-from timesformer.utils.benchmark import benchmark_data_loading
+from timesformer.utils.benchmark import (
+    benchmark_amp,
+    benchmark_attention,
+    benchmark_block,
+    benchmark_checkpointing,
+    benchmark_data_loading,
+    benchmark_decoding,
+    benchmark_grad_accumulation,
+    benchmark_prefetch,
+    benchmark_spatial_sampling,
+    benchmark_stats_sync,
+    benchmark_test_aggregation,
+    benchmark_token_pruning,
+    benchmark_vmps,
+)
 from timesformer.utils.misc import launch_job
 from timesformer.utils.parser import load_config, parse_args
 
@@ -15,9 +33,48 @@ def main():
     args = parse_args()
     cfg = load_config(args)
 
-    launch_job(
-        cfg=cfg, init_method=args.init_method, func=benchmark_data_loading
-    )
+    if cfg.BENCHMARK.TASK == "decoding":
+        benchmark_decoding(cfg)
+    elif cfg.BENCHMARK.TASK == "spatial_sampling":
+        benchmark_spatial_sampling(cfg)
+    elif cfg.BENCHMARK.TASK == "vmps":
+        benchmark_vmps(cfg)
+    elif cfg.BENCHMARK.TASK == "attention":
+        benchmark_attention(cfg)
+    elif cfg.BENCHMARK.TASK == "block":
+        benchmark_block(cfg)
+    elif cfg.BENCHMARK.TASK == "checkpointing":
+        benchmark_checkpointing(cfg)
+    elif cfg.BENCHMARK.TASK == "amp":
+        benchmark_amp(cfg)
+    elif cfg.BENCHMARK.TASK == "grad_accumulation":
+        launch_job(
+            cfg=cfg,
+            init_method=args.init_method,
+            func=benchmark_grad_accumulation,
+        )
+    elif cfg.BENCHMARK.TASK == "stats_sync":
+        launch_job(
+            cfg=cfg, init_method=args.init_method, func=benchmark_stats_sync
+        )
+    elif cfg.BENCHMARK.TASK == "prefetch":
+        launch_job(
+            cfg=cfg, init_method=args.init_method, func=benchmark_prefetch
+        )
+    elif cfg.BENCHMARK.TASK == "test_aggregation":
+        launch_job(
+            cfg=cfg,
+            init_method=args.init_method,
+            func=benchmark_test_aggregation,
+        )
+    elif cfg.BENCHMARK.TASK == "token_pruning":
+        launch_job(
+            cfg=cfg, init_method=args.init_method, func=benchmark_token_pruning
+        )
+    else:
+        launch_job(
+            cfg=cfg, init_method=args.init_method, func=benchmark_data_loading
+        )
 
 
 if __name__ == "__main__":
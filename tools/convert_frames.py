@@ -0,0 +1,157 @@
+"""
+Decode every video of an h5 dataset once and store the RGB frames in a frame
+store, read by the `Mpiiframes` dataset instead of decoding videos on the fly.
+
+Each video is stored as a `num frames` x `height` x `width` x `channel` uint8
+dataset chunked by frame, so that any frame can be read on its own, along with
+the stream information the `pyav` decoder uses to sample a clip. The frames are
+converted and resized as by the `pyav` decoder. Their pts are stored in a
+sibling dataset, see `load_h5.load_h5_frame_pts`, as an attribute could exceed
+the 64 KB limit of HDF5 attributes on long videos.
+"""
+
+import io
+from concurrent.futures import ProcessPoolExecutor
+
+import av
+import h5py
+import numpy as np
+import tqdm
+import logging
+
+import tools.load_h5 as load_h5
+from timesformer.datasets.decoder import frame_to_ndarray
+
+
+def decode_video(dataset_path, path, short_side=0):
+    """
+    Decode all frames of a video of the h5 dataset.
+    Args:
+        dataset_path (str): path to the h5 dataset.
+        path (str): path of the video inside the h5 file.
+        short_side (int): if larger than 0 and smaller than the shorter edge
+            of the video, resize the frames so that the shorter edge is
+            short_side, keeping the aspect ratio.
+    Returns:
+        path (str): path of the video inside the h5 file.
+        frames (ndarray): decoded frames sorted by pts.
+        pts (ndarray): Presentation TimeStamps of the frames.
+        info (dict): `fps`, `frames_length` and `duration` (-1 if unknown) of
+            the video stream.
+    """
+    video_data = load_h5.load_h5_file(dataset_path, path)
+    container = av.open(io.BytesIO(video_data), metadata_errors="ignore")
+    stream = container.streams.video[0]
+    info = {
+        "fps": float(stream.average_rate),
+        "frames_length": stream.frames,
+        "duration": -1 if stream.duration is None else stream.duration,
+    }
+    # Same as `pyav_decode_stream`, the frames are keyed by pts.
+    decoded = {}
+    for frame in container.decode(video=0):
+        decoded[frame.pts] = frame
+    container.close()
+
+    pts = np.array(sorted(decoded), dtype=np.int64)
+    # Same conversion as the frames decoded on the fly.
+    frames = [frame_to_ndarray(decoded[frame_pts], short_side) for frame_pts in pts]
+    frames = np.stack(frames) if len(frames) > 0 else None
+    return path, frames, pts, info
+
+
+def _list_videos(dataset_path, csv_names):
+    paths = []
+    seen = set()
+    for csv_name in csv_names:
+        csv = load_h5.load_h5_file(dataset_path, csv_name)
+        for path_label in csv.split("\n"):
+            if path_label == "": continue
+            path = " ".join(path_label.split(" ")[:-1])
+            if path not in seen:
+                seen.add(path)
+                paths.append(path)
+    return paths
+
+
+def convert_frames(dataset_path, save_path, csv_names, short_side=0, num_workers=8):
+    """
+    Write the frame store of the videos listed in the csv files. The csv files
+    are copied to the frame store. Videos already in the frame store are
+    skipped, so an interrupted conversion can be resumed by running it again.
+    Args:
+        dataset_path (str): path to the h5 dataset.
+        save_path (str): path to the frame store h5 file.
+        csv_names (list): names of the csv files listing the videos.
+        short_side (int): shorter edge size of the stored frames, 0 to keep
+            the source resolution.
+        num_workers (int): number of decoding processes.
+    """
+    paths = _list_videos(dataset_path, csv_names)
+    load_h5.close_h5_handles()
+
+    with h5py.File(save_path, 'a') as hf:
+        for csv_name in csv_names:
+            if csv_name in hf:
+                del hf[csv_name]
+            csv = load_h5.load_h5_file(dataset_path, csv_name).encode('utf-8')
+            hf.create_dataset(csv_name, data=np.frombuffer(csv, dtype=np.uint8))
+        load_h5.close_h5_handles()
+
+        # `short_side` is written last, a video interrupted before it is
+        # decoded again on the next run.
+        todo = [
+            path for path in paths
+            if path not in hf or hf[path].attrs.get("short_side") != short_side
+        ]
+        logging.info(f"Decoding {len(todo)} of {len(paths)} videos")
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            # Keep a bounded number of decoded videos in flight.
+            window = num_workers * 2
+            futures = [
+                executor.submit(decode_video, dataset_path, path, short_side)
+                for path in todo[:window]
+            ]
+            for i in tqdm.tqdm(range(len(todo))):
+                try:
+                    path, frames, pts, info = futures[i].result()
+                except Exception as e:
+                    path, frames = todo[i], None
+                    logging.info(f"Failed to decode {path} with error {e}")
+                futures[i] = None
+                if i + window < len(todo):
+                    futures.append(executor.submit(
+                        decode_video, dataset_path, todo[i + window], short_side
+                    ))
+                if frames is None:
+                    logging.info(f"No frame decoded from {path}")
+                    continue
+
+                for name in [path, path + load_h5.FRAME_PTS_SUFFIX]:
+                    if name in hf:
+                        del hf[name]
+                hf.create_dataset(path + load_h5.FRAME_PTS_SUFFIX, data=pts)
+                ds = hf.create_dataset(
+                    path, data=frames, chunks=(1,) + frames.shape[1:]
+                )
+                for key, value in info.items():
+                    ds.attrs[key] = value
+                ds.attrs["short_side"] = short_side
+
+
+if __name__ == '__main__':
+    # ----------------- Modify this section ----------------- #
+    # h5 dataset written by tools/convert_h5.py
+    dataset_path = "/path/to/datasets/<dataset_name>.h5"
+    # frame store path
+    save_path = "/path/to/datasets/<dataset_name>_frames.h5"
+    # csv files listing the videos to decode
+    csv_names = ["train.csv", "test.csv"]
+    # shorter edge size of the stored frames, 0 to keep the source resolution
+    short_side = 320
+    # number of decoding processes
+    num_workers = 8
+    # ----------------- Modify this section ----------------- #
+
+    logging.basicConfig(filename="convert_frames.log", level=logging.INFO)
+    convert_frames(dataset_path, save_path, csv_names, short_side, num_workers)
@@ -1,5 +1,7 @@
+import hashlib
 import json
 import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import h5py
 import numpy as np
@@ -7,61 +9,204 @@ import tqdm
 import logging
 
 
-def add_to_hdf5(group, path, update_groups=[]):
-    if len(update_groups) == 0: 
-        logging.info('No new group specified')
-        return
-    for item in tqdm.tqdm(os.listdir(path)):
+# Name of the dataset at the root of the h5 file that indexes every entry.
+MANIFEST_NAME = '__manifest__'
+MANIFEST_DTYPE = np.dtype([
+    ('path', h5py.string_dtype('utf-8')),
+    ('offset', np.int64),
+    ('length', np.int64),
+    ('label', np.int32),
+])
+# Attribute of the manifest holding the size of the file it was written for.
+MANIFEST_SIZE_ATTR = 'file_size'
+
+
+def read_file(file_path):
+    """
+    Read a file in the binary format it is stored with in the h5 file.
+    Returns None if the file type is not supported.
+    """
+    data = None
+    if file_path.endswith('.jpg') or file_path.endswith('.png') or file_path.endswith('.gif'):
+        with open(file_path, 'rb') as f:
+            data = f.read()
+    elif file_path.endswith('.json'):
+        with open(file_path, 'r') as f:
+            json_data = json.load(f)
+        json_str = json.dumps(json_data)
+        data = json_str.encode('utf-8')
+    elif file_path.endswith('.txt'):
+        with open(file_path, 'r') as f:
+            txt_data = f.read()
+        data = txt_data.encode('utf-8')
+    elif file_path.endswith('.csv'):
+        with open(file_path, 'r') as f:
+            csv_data = f.read()
+        data = csv_data.encode('utf-8')
+    elif file_path.endswith('.mp4') or file_path.endswith('.avi') or file_path.endswith('.mov'):
+        with open(file_path, 'rb') as f:
+            data = f.read()
+    return data
+
+
+def _read_and_hash(file_path):
+    data = read_file(file_path)
+    if data is None:
+        return None, None
+    return data, hashlib.sha1(data).hexdigest()
+
+
+def _walk(path, update_groups, prefix=''):
+    """
+    List the (h5 path, file path) of the files under path that belong to one
+    of the update groups.
+    """
+    for item in sorted(os.listdir(path)):
         file_path = os.path.join(path, item)
         # check if file path contains elements in new_group
         if not any([g in file_path.split("/") for g in update_groups]):
             logging.info(f"Skipping {file_path}")
-            print(f"Skipping {file_path}")
             continue
-        print('Adding', file_path)
-
+        h5_path = prefix + item
         if os.path.isdir(file_path):
-            # Create a new group for the directory
-            try:
-                sub_group = group.create_group(item)
-            except ValueError:
-                # delete the existing group and create a new one
-                del group[item]
-                sub_group = group.create_group(item)
-            
-            add_to_hdf5(sub_group, file_path, update_groups)
+            yield from _walk(file_path, update_groups, h5_path + '/')
         else:
-            data = None
-            # Read the file and store it in binary format
-            if file_path.endswith('.jpg') or file_path.endswith('.png') or file_path.endswith('.gif'):
-                with open(file_path, 'rb') as f:
-                    data = f.read()
-            elif file_path.endswith('.json'):
-                with open(file_path, 'r') as f:
-                    json_data = json.load(f)
-                json_str = json.dumps(json_data)
-                data = json_str.encode('utf-8')
-            elif file_path.endswith('.txt'):
-                with open(file_path, 'r') as f:
-                    txt_data = f.read()
-                data = txt_data.encode('utf-8')
-            elif file_path.endswith('.csv'):
-                with open(file_path, 'r') as f:
-                    csv_data = f.read()
-                data = csv_data.encode('utf-8')        
-            elif file_path.endswith('.mp4') or file_path.endswith('.avi') or file_path.endswith('.mov'):
-                with open(file_path, 'rb') as f:
-                    data = f.read()
-                
+            yield h5_path, file_path
+
+
+def _is_unchanged(group, h5_path, size, digest):
+    if h5_path not in group:
+        return False
+    attrs = group[h5_path].attrs
+    return attrs.get('size') == size and attrs.get('sha1') == digest
+
+
+def add_to_hdf5(group, path, update_groups=[], num_workers=8, use_processes=False):
+    """
+    Add the files under path to the h5 group. Files are read and hashed by a
+    pool of workers and written as contiguous uint8 datasets. Entries whose
+    size and content hash did not change since the last run are skipped, so
+    an interrupted conversion can be resumed by running it again.
+    Args:
+        group (h5py.Group): group to add the files to.
+        path (str): directory to read the files from.
+        update_groups (list): names of the files/folders to add.
+        num_workers (int): number of reading workers.
+        use_processes (bool): read with processes instead of threads.
+    Returns:
+        num_written (int): number of entries written.
+        num_skipped (int): number of unchanged entries skipped.
+    """
+    if len(update_groups) == 0:
+        logging.info('No new group specified')
+        return 0, 0
+    entries = list(_walk(path, update_groups))
+    pool = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    num_written, num_skipped = 0, 0
+    with pool(max_workers=num_workers) as executor:
+        # Keep a bounded number of files in flight so that the memory does
+        # not grow with the size of the corpus.
+        window = num_workers * 4
+        futures = [
+            executor.submit(_read_and_hash, file_path)
+            for _, file_path in entries[:window]
+        ]
+        for i in tqdm.tqdm(range(len(entries))):
+            h5_path, file_path = entries[i]
+            data, digest = futures[i].result()
+            futures[i] = None
+            if i + window < len(entries):
+                futures.append(
+                    executor.submit(_read_and_hash, entries[i + window][1])
+                )
+
             if data is None:
                 logging.info(f"No matched data type for {file_path}")
                 continue
+            if _is_unchanged(group, h5_path, len(data), digest):
+                num_skipped += 1
+                continue
+
+            if h5_path in group:
+                del group[h5_path]
+            ds = group.create_dataset(
+                h5_path, data=np.frombuffer(data, dtype=np.uint8)
+            )
+            # The hash is written last, a dataset interrupted before it is
+            # rewritten on the next run.
+            ds.attrs['size'] = len(data)
+            ds.attrs['sha1'] = digest
+            num_written += 1
+    logging.info(f"Written {num_written} entries, skipped {num_skipped} unchanged entries")
+    return num_written, num_skipped
+
 
+def _read_labels(hf):
+    """
+    Collect the labels of the videos listed in the csv files of the h5 file.
+    Each csv line is `path label`.
+    """
+    labels = {}
+    for key in hf:
+        if not key.endswith('.csv') or not isinstance(hf[key], h5py.Dataset):
+            continue
+        csv = np.array(hf[key]).tobytes().decode('utf-8')
+        for path_label in csv.split("\n"):
+            if path_label == "": continue
+            path = " ".join(path_label.split(" ")[:-1])
+            label = path_label.split(" ")[-1]
             try:
-                group.create_dataset(item, data=np.array(data, dtype='S'))
+                labels[path] = int(label)
             except ValueError:
-                del group[item]
-                group.create_dataset(item, data=np.array(data, dtype='S'))
+                continue
+    return labels
+
+
+def write_manifest(hf):
+    """
+    Write the manifest dataset to the root of the h5 file. It maps the path of
+    every dataset to its byte offset and length in the file and to its label
+    (-1 if not listed in a csv), so that readers can locate entries without
+    walking the HDF5 hierarchy. Offsets are -1 for non contiguous datasets.
+    The size of the file is recorded by `stamp_manifest` once it is closed.
+    Args:
+        hf (h5py.File): h5 file opened for writing.
+    """
+    labels = _read_labels(hf)
+    rows = []
+
+    def _visit(name, obj):
+        if not isinstance(obj, h5py.Dataset) or name == MANIFEST_NAME:
+            return
+        offset = obj.id.get_offset()
+        rows.append((
+            name,
+            -1 if offset is None else offset,
+            obj.id.get_storage_size(),
+            labels.get(name, -1),
+        ))
+
+    hf.visititems(_visit)
+    if MANIFEST_NAME in hf:
+        del hf[MANIFEST_NAME]
+    hf.create_dataset(MANIFEST_NAME, data=np.array(rows, dtype=MANIFEST_DTYPE))
+    # Placeholder of the file size, overwritten in place by `stamp_manifest`.
+    hf[MANIFEST_NAME].attrs[MANIFEST_SIZE_ATTR] = np.int64(-1)
+    return len(rows)
+
+
+def stamp_manifest(save_path):
+    """
+    Record the size of the closed h5 file in the manifest. Readers only use the
+    manifest if the file still has this size, so that a file modified after
+    the manifest was written falls back to looking up its datasets. The
+    attribute is overwritten in place, which keeps the size of the file.
+    Args:
+        save_path (str): path to the h5 file.
+    """
+    size = os.path.getsize(save_path)
+    with h5py.File(save_path, 'r+') as hf:
+        hf[MANIFEST_NAME].attrs[MANIFEST_SIZE_ATTR] = np.int64(size)
 
 
 if __name__ == '__main__':
@@ -72,6 +217,8 @@ if __name__ == '__main__':
     dataset_path = os.path.join(base_path, '<dataset_folder>')
     # hdf5 file path
     save_path = os.path.join(base_path, '<dataset_name>.h5')
+    # number of workers reading the files
+    num_workers = 8
 
     """
         [DEFAULT]: update_groups = []
@@ -80,23 +227,27 @@ if __name__ == '__main__':
         List file/folder to be appended:
         update_groups = ["dir1", "file1"]
         or
-        ALERT: every file will be rewritten!
-        update_groups = [""] 
+        Every file will be checked, only changed files are rewritten:
+        update_groups = [""]
     """
     update_groups = ["train", "test", "train.csv", "test.csv"]
     # ----------------- Modify this section ----------------- #
 
+    logging.basicConfig(filename="convert_h5.log", level=logging.INFO)
+
     if not os.path.exists(save_path):
         hf = h5py.File(save_path, 'w')
     else:
         hf = h5py.File(save_path, 'a')
-    
-    add_to_hdf5(hf, dataset_path, update_groups)
+
+    add_to_hdf5(hf, dataset_path, update_groups, num_workers)
+    num_entries = write_manifest(hf)
+    logging.info(f"Manifest with {num_entries} entries written")
 
     # logging groups in the file
-    logging.basicConfig(filename="convert_h5.log", level=logging.INFO)
     logging.info("Groups in the file:")
     for group in hf:
         logging.info(group)
 
-    hf.close()
\ No newline at end of file
+    hf.close()
+    stamp_manifest(save_path)
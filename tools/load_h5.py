@@ -1,29 +1,294 @@
 import h5py
 import numpy as np
 import io
+import os
+import mmap
+import multiprocessing
 from PIL import Image
 import json
 
 
-def load_h5_file(dataset_path, path):
-    with h5py.File(dataset_path, 'r') as hf:
-        if path.endswith('.jpg') or path.endswith('.png') or path.endswith('.gif'):
-            # saved the image as raw binary, need to convert to image
-            rtn = Image.open(io.BytesIO(np.array(hf[path])))
-        elif path.endswith('.json'):
-            # saved as a dataset string, need to convert to json dict
-            rtn = json.loads(np.array(hf[path]).tobytes().decode('utf-8'))
-        elif path.endswith('.txt'):
-            rtn = np.array(hf[path]).tobytes().decode('utf-8')
-        elif path.endswith('.csv'):
-            rtn = np.array(hf[path]).tobytes().decode('utf-8')
-        elif path.endswith('.mp4'):
-            rtn = np.array(hf[path])
-        elif path.endswith('.avi'):
-            rtn = np.array(hf[path])
+# Dataset indexing the offset and length of every entry, written by
+# tools/convert_h5.py.
+MANIFEST_NAME = '__manifest__'
+# Attribute of the manifest holding the size of the file it was written for.
+MANIFEST_SIZE_ATTR = 'file_size'
+# Suffix of the dataset holding the pts of the frames of a video in a frame
+# store written by tools/convert_frames.py.
+FRAME_PTS_SUFFIX = '.pts'
+
+# Open h5 handles of the current process, keyed by dataset path. A handle is
+# opened lazily on first access and reused by every following read, so each
+# DataLoader worker only pays for the metadata/B-tree reads once.
+_H5_HANDLES = {}
+# Read-only memory maps of the h5 files and the resolved (offset, length) of
+# the contiguous datasets read through them, keyed like `_H5_HANDLES`.
+_H5_MMAPS = {}
+_H5_OFFSETS = {}
+# Manifests of the h5 files, mapping entry path to (offset, length).
+_H5_MANIFESTS = {}
+# Pid that owns `_H5_HANDLES`. HDF5 handles must not be shared across a fork,
+# so a process that finds a different owner pid drops the inherited handles.
+_H5_HANDLES_PID = None
+# Counters shared with forked DataLoader workers.
+_H5_STATS = {
+    "opens": multiprocessing.Value("q", 0),
+    "reads": multiprocessing.Value("q", 0),
+    # Video reads served from the memory map / by copying the dataset.
+    "mmap_reads": multiprocessing.Value("q", 0),
+    "copy_reads": multiprocessing.Value("q", 0),
+}
+
+
+def _count(name):
+    counter = _H5_STATS[name]
+    with counter.get_lock():
+        counter.value += 1
+
+
+def get_h5_stats():
+    """
+    Return the number of h5 file opens and reads performed by this process and
+    the DataLoader workers forked from it.
+    Returns:
+        stats (dict): `opens` and `reads` counters.
+    """
+    return {name: counter.value for name, counter in _H5_STATS.items()}
+
+
+def reset_h5_stats():
+    """
+    Reset the h5 open/read counters to zero.
+    """
+    for counter in _H5_STATS.values():
+        with counter.get_lock():
+            counter.value = 0
+
+
+def reset_h5_handles():
+    """
+    Forget the h5 handles inherited from the parent process without closing
+    them, so the current process lazily reopens its own handles. Called from
+    the DataLoader worker init function after fork.
+    """
+    global _H5_HANDLES, _H5_MMAPS, _H5_OFFSETS, _H5_MANIFESTS, _H5_HANDLES_PID
+    _H5_HANDLES = {}
+    _H5_MMAPS = {}
+    _H5_OFFSETS = {}
+    _H5_MANIFESTS = {}
+    _H5_HANDLES_PID = os.getpid()
+
+
+def close_h5_handles():
+    """
+    Close every h5 handle opened by the current process. The dataset calls it
+    after construction so that no handle is open when the workers are forked.
+    """
+    global _H5_HANDLES_PID
+    if _H5_HANDLES_PID == os.getpid():
+        for hf in _H5_HANDLES.values():
+            hf.close()
+        for mm in _H5_MMAPS.values():
+            try:
+                mm.close()
+            except BufferError:
+                # A container still holds a view, the map is released with it.
+                pass
+    reset_h5_handles()
+
+
+def get_h5_handle(dataset_path):
+    """
+    Return the cached read-only handle of the given h5 file, opening it if the
+    current process has not opened it yet.
+    Args:
+        dataset_path (str): path to the h5 file.
+    Returns:
+        hf (h5py.File): open h5 file.
+    """
+    if _H5_HANDLES_PID != os.getpid():
+        reset_h5_handles()
+    hf = _H5_HANDLES.get(dataset_path)
+    if hf is None or not hf.id.valid:
+        hf = h5py.File(dataset_path, 'r')
+        _H5_HANDLES[dataset_path] = hf
+        _count("opens")
+    return hf
+
+
+def _get_h5_mmap(dataset_path):
+    mm = _H5_MMAPS.get(dataset_path)
+    if mm is None:
+        with open(dataset_path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        _H5_MMAPS[dataset_path] = mm
+    return mm
+
+
+def get_h5_manifest(dataset_path):
+    """
+    Return the manifest of the h5 file as a dict mapping the path of every
+    entry to its (offset, length) in the file, or None if the file has no
+    manifest. The offset is -1 for entries that are not stored contiguously.
+    A manifest is only used if the file has the size recorded in it by
+    tools/convert_h5.py, otherwise the file changed after it was written.
+    Args:
+        dataset_path (str): path to the h5 file.
+    """
+    if dataset_path not in _H5_MANIFESTS:
+        hf = get_h5_handle(dataset_path)
+        manifest = None
+        if MANIFEST_NAME in hf and hf[MANIFEST_NAME].attrs.get(
+            MANIFEST_SIZE_ATTR
+        ) == os.path.getsize(dataset_path):
+            rows = hf[MANIFEST_NAME][()]
+            manifest = {
+                (path.decode('utf-8') if isinstance(path, bytes) else path):
+                    (int(offset), int(length))
+                for path, offset, length in zip(
+                    rows['path'], rows['offset'], rows['length']
+                )
+            }
+        _H5_MANIFESTS[dataset_path] = manifest
+    return _H5_MANIFESTS[dataset_path]
+
+
+def _get_h5_offset(hf, dataset_path, path):
+    """
+    Return the (offset, length) of the raw bytes of a dataset in the h5 file,
+    or None if the dataset is not stored contiguously without filters. The
+    location is read from the manifest if the file has a valid one.
+    """
+    manifest = get_h5_manifest(dataset_path)
+    if manifest is not None and path in manifest:
+        offset, length = manifest[path]
+        return None if offset < 0 else (offset, length)
+    key = (dataset_path, path)
+    if key not in _H5_OFFSETS:
+        ds = hf[path]
+        offset = ds.id.get_offset()
+        if (
+            offset is None
+            or ds.chunks is not None
+            or ds.compression is not None
+            or not (ds.dtype.kind == 'S' or ds.dtype == np.uint8)
+        ):
+            _H5_OFFSETS[key] = None
         else:
-            raise ValueError('Unknown file type: {}'.format(path))
-        return rtn
+            _H5_OFFSETS[key] = (offset, ds.id.get_storage_size())
+    return _H5_OFFSETS[key]
+
+
+def load_h5_video(dataset_path, path, use_mmap=True):
+    """
+    Load the encoded bytes of a video. Contiguous, uncompressed datasets are
+    served as a read-only view of the memory-mapped h5 file instead of a copy
+    of the whole dataset; chunked or compressed datasets fall back to
+    `load_h5_file`.
+    Args:
+        dataset_path (str): path to the h5 file.
+        path (str): path of the video inside the h5 file.
+        use_mmap (bool): if False, always copy the dataset.
+    Returns:
+        data (memoryview or ndarray): the encoded video bytes.
+        read_path (str): `mmap` or `copy`, the path this read took.
+    """
+    if use_mmap:
+        hf = get_h5_handle(dataset_path)
+        location = _get_h5_offset(hf, dataset_path, path)
+        if location is not None:
+            _count("reads")
+            _count("mmap_reads")
+            offset, length = location
+            data = memoryview(_get_h5_mmap(dataset_path))[
+                offset : offset + length
+            ]
+            return data, "mmap"
+    data = load_h5_file(dataset_path, path)
+    _count("copy_reads")
+    return data, "copy"
+
+
+# Attributes written by tools/scan_h5.py on every video dataset.
+VIDEO_META_KEYS = ('fps', 'frames_length', 'duration', 'keyframe_pts')
+
+
+def load_h5_video_meta(dataset_path, path):
+    """
+    Load the stream information recorded by tools/scan_h5.py for a video.
+    Args:
+        dataset_path (str): path to the h5 file.
+        path (str): path of the video inside the h5 file.
+    Returns:
+        meta (dict): `fps`, `frames_length`, `duration` and `keyframe_pts` of
+            the video stream. Empty if the video was not scanned.
+    """
+    attrs = get_h5_handle(dataset_path)[path].attrs
+    if not all(key in attrs for key in VIDEO_META_KEYS):
+        return {}
+    return {
+        'fps': float(attrs['fps']),
+        'frames_length': int(attrs['frames_length']),
+        'duration': int(attrs['duration']),
+        'keyframe_pts': [int(pts) for pts in attrs['keyframe_pts']],
+    }
+
+
+def load_h5_frames(dataset_path, path, indices):
+    """
+    Load the given frames of a video from a frame store written by
+    tools/convert_frames.py. Only the chunks of the requested frames are read.
+    Args:
+        dataset_path (str): path to the frame store h5 file.
+        path (str): path of the video inside the h5 file.
+        indices (ndarray): indices of the frames to load, may be unsorted and
+            contain duplicates.
+    Returns:
+        frames (ndarray): `num indices` x `height` x `width` x `channel` uint8
+            frames.
+    """
+    hf = get_h5_handle(dataset_path)
+    _count("reads")
+    # h5py only supports increasing indices.
+    unique, inverse = np.unique(indices, return_inverse=True)
+    return hf[path][unique][inverse]
+
+
+def load_h5_frame_pts(dataset_path, path):
+    """
+    Load the Presentation TimeStamps of the frames of a video from a frame
+    store written by tools/convert_frames.py.
+    Args:
+        dataset_path (str): path to the frame store h5 file.
+        path (str): path of the video inside the h5 file.
+    Returns:
+        pts (ndarray): sorted pts of the stored frames.
+    """
+    hf = get_h5_handle(dataset_path)
+    _count("reads")
+    return hf[path + FRAME_PTS_SUFFIX][()]
+
+
+def load_h5_file(dataset_path, path):
+    hf = get_h5_handle(dataset_path)
+    _count("reads")
+    if path.endswith('.jpg') or path.endswith('.png') or path.endswith('.gif'):
+        # saved the image as raw binary, need to convert to image
+        rtn = Image.open(io.BytesIO(np.array(hf[path])))
+    elif path.endswith('.json'):
+        # saved as a dataset string, need to convert to json dict
+        rtn = json.loads(np.array(hf[path]).tobytes().decode('utf-8'))
+    elif path.endswith('.txt'):
+        rtn = np.array(hf[path]).tobytes().decode('utf-8')
+    elif path.endswith('.csv'):
+        rtn = np.array(hf[path]).tobytes().decode('utf-8')
+    elif path.endswith('.mp4'):
+        rtn = np.array(hf[path])
+    elif path.endswith('.avi'):
+        rtn = np.array(hf[path])
+    else:
+        raise ValueError('Unknown file type: {}'.format(path))
+    return rtn
 
 
 if __name__ == "__main__":
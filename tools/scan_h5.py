@@ -0,0 +1,116 @@
+"""
+Scan the videos of an h5 dataset and record their stream information as
+attributes of the video datasets: `fps`, `frames_length`, `duration` (in pts)
+and `keyframe_pts`. The `pyav` decoder uses them to seek straight to the
+keyframe a clip has to be decoded from, and to never decode a video entirely
+because its duration is missing from the video head.
+"""
+
+import io
+from concurrent.futures import ProcessPoolExecutor
+
+import av
+import h5py
+import numpy as np
+import tqdm
+import logging
+
+import tools.load_h5 as load_h5
+
+
+def scan_video(dataset_path, path):
+    """
+    Read the packets of a video, without decoding them, to collect its stream
+    information.
+    Args:
+        dataset_path (str): path to the h5 dataset.
+        path (str): path of the video inside the h5 file.
+    Returns:
+        path (str): path of the video inside the h5 file.
+        meta (dict): `fps`, `frames_length`, `duration` and `keyframe_pts` of
+            the video stream.
+    """
+    video_data = load_h5.load_h5_file(dataset_path, path)
+    container = av.open(io.BytesIO(video_data), metadata_errors="ignore")
+    stream = container.streams.video[0]
+    keyframe_pts = []
+    num_packets = 0
+    end_pts = 0
+    for packet in container.demux(stream):
+        if packet.pts is None:
+            continue
+        num_packets += 1
+        end_pts = max(end_pts, packet.pts + (packet.duration or 0))
+        if packet.is_keyframe:
+            keyframe_pts.append(packet.pts)
+    container.close()
+
+    # Prefer the information of the video head, as the decoder does.
+    frames_length = stream.frames if stream.frames > 0 else num_packets
+    duration = stream.duration if stream.duration is not None else end_pts
+    if stream.average_rate is not None:
+        fps = float(stream.average_rate)
+    else:
+        fps = frames_length / (duration * float(stream.time_base))
+    meta = {
+        "fps": fps,
+        "frames_length": frames_length,
+        "duration": duration,
+        "keyframe_pts": np.array(sorted(keyframe_pts), dtype=np.int64),
+    }
+    return path, meta
+
+
+def _list_videos(hf):
+    paths = []
+
+    def _visit(name, obj):
+        if isinstance(obj, h5py.Dataset) and (name.endswith('.mp4') or name.endswith('.avi')):
+            paths.append(name)
+
+    hf.visititems(_visit)
+    return paths
+
+
+def scan_h5(dataset_path, num_workers=8, rescan=False):
+    """
+    Scan every video of the h5 dataset and write its stream information as
+    attributes of the video dataset.
+    Args:
+        dataset_path (str): path to the h5 dataset.
+        num_workers (int): number of scanning processes.
+        rescan (bool): if False, skip the videos that were already scanned.
+    """
+    with h5py.File(dataset_path, 'r') as hf:
+        todo = [
+            path for path in _list_videos(hf)
+            if rescan or 'keyframe_pts' not in hf[path].attrs
+        ]
+    logging.info(f"Scanning {len(todo)} videos")
+
+    # The workers read the file, the attributes are written once they are done.
+    results = []
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(scan_video, dataset_path, path) for path in todo]
+        for path, future in tqdm.tqdm(zip(todo, futures), total=len(todo)):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                logging.info(f"Failed to scan {path} with error {e}")
+
+    with h5py.File(dataset_path, 'a') as hf:
+        for path, meta in results:
+            for key, value in meta.items():
+                hf[path].attrs[key] = value
+
+
+if __name__ == '__main__':
+    # ----------------- Modify this section ----------------- #
+    # h5 dataset written by tools/convert_h5.py
+    dataset_path = "/path/to/datasets/<dataset_name>.h5"
+    # number of scanning processes
+    num_workers = 8
+    # ----------------- Modify this section ----------------- #
+
+    logging.basicConfig(filename="scan_h5.log", level=logging.INFO)
+    scan_h5(dataset_path, num_workers)
@@ -7,6 +7,7 @@ import os
 import pickle
 import torch
 from fvcore.common.file_io import PathManager
+from fvcore.common.timer import Timer
 import cv2
 from einops import rearrange, reduce, repeat
 import scipy.io
@@ -49,29 +50,16 @@ def perform_test(test_loader, model, test_meter, cfg, writer=None):
     model.eval()
     test_meter.iter_tic()
 
-    for cur_iter, (inputs, labels, video_idx, meta) in enumerate(test_loader):
-        if cfg.NUM_GPUS:
-            # Transfer the data to the current GPU device.
-            if isinstance(inputs, (list,)):
-                for i in range(len(inputs)):
-                    inputs[i] = inputs[i].cuda(non_blocking=True)
-            else:
-                inputs = inputs.cuda(non_blocking=True)
-
-            # Transfer the data to the current GPU device.
-            labels = labels.cuda()
-            video_idx = video_idx.cuda()
-            for key, val in meta.items():
-                if isinstance(val, (list,)):
-                    for i in range(len(val)):
-                        val[i] = val[i].cuda(non_blocking=True)
-                else:
-                    meta[key] = val.cuda(non_blocking=True)
+    # Transfer the data to the current GPU device.
+    test_iter = loader.DevicePrefetcher(test_loader, cfg)
+    for cur_iter, (inputs, labels, video_idx, meta) in enumerate(test_iter):
         test_meter.data_toc()
 
         if cfg.DETECTION.ENABLE:
             # Compute the predictions.
-            preds, _ = model(inputs, meta["boxes"])
+            with misc.autocast(cfg):
+                preds, _ = model(inputs, meta["boxes"])
+            preds = preds.float()
             ori_boxes = meta["ori_boxes"]
             metadata = meta["metadata"]
 
@@ -94,13 +82,12 @@ def perform_test(test_loader, model, test_meter, cfg, writer=None):
             test_meter.log_iter_stats(None, cur_iter)
         else:
             # Perform the forward pass.
-            preds, _ = model(inputs)
+            with misc.autocast(cfg):
+                preds, _ = model(inputs)
+            preds = preds.float()
 
-            # Gather all the predictions across all the devices to perform ensemble.
-            if cfg.NUM_GPUS > 1:
-                preds, labels, video_idx = du.all_gather(
-                    [preds, labels, video_idx]
-                )
+            # Every process ensembles the predictions of its own clips, the
+            # ensembles are combined after the last iteration.
             if cfg.NUM_GPUS:
                 preds = preds.cpu()
                 labels = labels.cpu()
@@ -117,6 +104,11 @@ def perform_test(test_loader, model, test_meter, cfg, writer=None):
 
     # Log epoch stats and print the final testing results.
     if not cfg.DETECTION.ENABLE:
+        if cfg.NUM_GPUS > 1:
+            # Only the root process finalizes the combined ensembles.
+            test_meter.reduce_stats()
+            if not du.is_root_proc():
+                return test_meter
         all_preds = test_meter.video_preds.clone().detach()
         all_labels = test_meter.video_labels
         if cfg.NUM_GPUS:
@@ -192,20 +184,15 @@ def test(cfg):
     test_loader = loader.construct_loader(cfg, test_name)
     logger.info("Testing model for {} iterations".format(len(test_loader)))
 
-    assert (
-        len(test_loader.dataset)
-        % (cfg.TEST.NUM_ENSEMBLE_VIEWS * cfg.TEST.NUM_SPATIAL_CROPS)
-        == 0
+    # In decode once mode, a dataset item holds all the spatial crops of a
+    # temporal window.
+    num_items_per_video = cfg.TEST.NUM_ENSEMBLE_VIEWS * (
+        1 if cfg.TEST.DECODE_ONCE else cfg.TEST.NUM_SPATIAL_CROPS
     )
-    # Create meters for multi-view testing.
-    test_meter = TestMeter(
-        len(test_loader.dataset)
-        // (cfg.TEST.NUM_ENSEMBLE_VIEWS * cfg.TEST.NUM_SPATIAL_CROPS),
-        cfg.TEST.NUM_ENSEMBLE_VIEWS * cfg.TEST.NUM_SPATIAL_CROPS,
-        cfg.MODEL.NUM_CLASSES,
-        len(test_loader),
-        cfg.DATA.MULTI_LABEL,
-        cfg.DATA.ENSEMBLE_METHOD,
+    assert len(test_loader.dataset) % num_items_per_video == 0
+    num_videos = len(test_loader.dataset) // num_items_per_video
+    num_clips = (
+        num_videos * cfg.TEST.NUM_ENSEMBLE_VIEWS * cfg.TEST.NUM_SPATIAL_CROPS
     )
 
     # Set up writer for logging to Tensorboard format.
@@ -216,10 +203,56 @@ def test(cfg):
     else:
         writer = None
 
-    # # Perform multi-view test on the entire dataset.
-    test_meter = perform_test(test_loader, model, test_meter, cfg, writer)
+    # With motion energy frame selection, test once per number of selected
+    # frames of TEST.NUM_SELECTED_FRAMES.
+    if cfg.TEST.NUM_SELECTED_FRAMES:
+        assert cfg.DATA.NUM_CANDIDATE_FRAMES > 0, \
+            "TEST.NUM_SELECTED_FRAMES requires DATA.NUM_CANDIDATE_FRAMES"
+    results = []
+    for num_selected_frames in cfg.TEST.NUM_SELECTED_FRAMES or [None]:
+        if num_selected_frames is not None:
+            (model.module if cfg.NUM_GPUS > 1 else model).num_selected_frames = (
+                num_selected_frames
+            )
+        # Create meters for multi-view testing.
+        test_meter = TestMeter(
+            num_videos,
+            cfg.TEST.NUM_ENSEMBLE_VIEWS * cfg.TEST.NUM_SPATIAL_CROPS,
+            cfg.MODEL.NUM_CLASSES,
+            len(test_loader),
+            cfg.DATA.MULTI_LABEL,
+            cfg.DATA.ENSEMBLE_METHOD,
+        )
+
+        # # Perform multi-view test on the entire dataset.
+        timer = Timer()
+        test_meter = perform_test(test_loader, model, test_meter, cfg, writer)
+        results.append(
+            (
+                num_selected_frames,
+                num_clips / timer.seconds(),
+                num_clips / max(test_meter.net_seconds, 1e-9),
+                test_meter.stats,
+            )
+        )
     if writer is not None:
         writer.close()
 
+    for num_selected_frames, clips_per_sec, net_clips_per_sec, stats in results:
+        logger.info(
+            "{}{:.2f} clips/s, {:.2f} clips/s in the model, {}".format(
+                ""
+                if num_selected_frames is None
+                else "{} selected frames: ".format(num_selected_frames),
+                clips_per_sec,
+                net_clips_per_sec,
+                ", ".join(
+                    "{} {}".format(key, value)
+                    for key, value in stats.items()
+                    if key != "split"
+                ),
+            )
+        )
+
     if cfg.WANDB.ENABLE:
         wandb.finish()
\ No newline at end of file
@@ -2,9 +2,11 @@
 
 """Train a video classification model."""
 
+import contextlib
 import numpy as np
 import pprint
 import torch
+from datetime import datetime
 from fvcore.nn.precise_bn import get_bn_modules, update_bn_stats
 
 import timesformer.models.losses as losses
@@ -17,8 +19,10 @@ import timesformer.utils.misc as misc
 import timesformer.visualization.tensorboard_vis as tb
 from timesformer.datasets import loader
 from timesformer.models import build_model
-from timesformer.utils.meters import TrainMeter, ValMeter
+from timesformer.models.vmps import VideoMotionPrompt
+from timesformer.utils.meters import StatsBuffer, TrainMeter, ValMeter
 from timesformer.utils.multigrid import MultigridSchedule
+from timesformer.utils.watchdog import NonFiniteWatchdog
 
 from timm.data import Mixup
 from timm.loss import LabelSmoothingCrossEntropy, SoftTargetCrossEntropy
@@ -29,8 +33,119 @@ import wandb
 import time
 
 
+def get_accumulation_group(cur_iter, num_iters, data_size):
+    """
+    Get the group of iterations whose gradients are accumulated for an
+    optimizer step: num_iters iterations, or the remaining ones at the end of
+    the epoch.
+    Args:
+        cur_iter (int): current iteration.
+        num_iters (int): number of iterations of a group.
+        data_size (int): number of iterations of the epoch.
+    Returns:
+        group_start (int): first iteration of the group.
+        group_size (int): number of iterations of the group.
+        is_step (bool): whether the current iteration is the last one of the
+            group, which performs the optimizer step.
+    """
+    group_start = cur_iter - cur_iter % num_iters
+    group_size = min(num_iters, data_size - group_start)
+    is_step = cur_iter + 1 == group_start + group_size
+    return group_start, group_size, is_step
+
+
+def train_step(
+    inputs, labels, meta, model, optimizer, scaler, group_size, is_step, cfg
+):
+    """
+    Perform the forward and backward passes of a training iteration, and the
+    optimizer step on the last iteration of a gradient accumulation group.
+    Args:
+        inputs (tensor or list): the clips of the iteration.
+        labels (tensor): the labels of the clips.
+        meta (dict): the meta data of the clips.
+        model (model): the video model to train.
+        optimizer (optim): the optimizer to perform optimization on the model's
+            parameters.
+        scaler (GradScaler): gradient scaler of mixed precision training.
+        group_size (int): number of iterations whose gradients are
+            accumulated for the optimizer step.
+        is_step (bool): if True, all-reduce the gradients and perform the
+            optimizer step.
+        cfg (CfgNode): configs. Details can be found in
+            slowfast/config/defaults.py
+    Returns:
+        preds (tensor): the predictions of the model.
+        labels (tensor): the labels, the hard labels with Mixup.
+        loss (tensor): the loss of the iteration.
+    """
+    # Explicitly declare reduction to mean.
+    if not cfg.MIXUP.ENABLED:
+        loss_fun = losses.get_loss_func(cfg.MODEL.LOSS_FUNC)(reduction="mean")
+    else:
+        mixup_fn = Mixup(
+            mixup_alpha=cfg.MIXUP.ALPHA, cutmix_alpha=cfg.MIXUP.CUTMIX_ALPHA, cutmix_minmax=cfg.MIXUP.CUTMIX_MINMAX, prob=cfg.MIXUP.PROB, switch_prob=cfg.MIXUP.SWITCH_PROB, mode=cfg.MIXUP.MODE,
+            label_smoothing=0.1, num_classes=cfg.MODEL.NUM_CLASSES)
+        hard_labels = labels
+        if cfg.DATA.NORMALIZE_ON_DEVICE:
+            # Mix the uint8 clips in [0, 255], the model normalizes them.
+            inputs = inputs.float()
+        inputs, labels = mixup_fn(inputs, labels)
+        loss_fun = SoftTargetCrossEntropy()
+
+    # Only all-reduce the gradients of DDP in the backward pass of the
+    # optimizer step, the forward pass must be in the context as well.
+    if (
+        isinstance(model, torch.nn.parallel.DistributedDataParallel)
+        and not is_step
+    ):
+        sync_context = model.no_sync()
+    else:
+        sync_context = contextlib.nullcontext()
+
+    with sync_context:
+        start = time.time()
+        with misc.autocast(cfg):
+            if cfg.DETECTION.ENABLE:
+                preds, vmps_loss = model(inputs, meta["boxes"])
+            else:
+                preds, vmps_loss = model(inputs)
+
+            if cfg.WANDB.ENABLE:
+                wandb.log({"Time per forwar": time.time() - start})
+
+            # Compute the loss.
+            loss = loss_fun(preds, labels) + vmps_loss
+
+        if cfg.MIXUP.ENABLED:
+            labels = hard_labels
+
+        # Perform the backward pass, the loss is averaged over the
+        # accumulated iterations.
+        start = time.time()
+        scaler.scale(loss / group_size).backward()
+        if cfg.WANDB.ENABLE:
+            wandb.log({"Time per backward": time.time() - start})
+
+    if is_step:
+        # Update the parameters, the step is skipped if the scaled
+        # gradients are not finite.
+        scaler.step(optimizer)
+        scaler.update()
+
+    return preds, labels, loss
+
+
 def train_epoch(
-    train_loader, model, optimizer, train_meter, cur_epoch, cfg, writer=None
+    train_loader,
+    model,
+    optimizer,
+    scaler,
+    train_meter,
+    cur_epoch,
+    cfg,
+    writer=None,
+    watchdog=None,
 ):
     """
     Perform the video training for one epoch.
@@ -39,12 +154,16 @@ def train_epoch(
         model (model): the video model to train.
         optimizer (optim): the optimizer to perform optimization on the model's
             parameters.
+        scaler (GradScaler): gradient scaler of mixed precision training, a
+            no-op if disabled.
         train_meter (TrainMeter): training meters to log the training performance.
         cur_epoch (int): current epoch of training.
         cfg (CfgNode): configs. Details can be found in
             slowfast/config/defaults.py
         writer (TensorboardWriter, optional): TensorboardWriter object
             to writer Tensorboard log.
+        watchdog (NonFiniteWatchdog, optional): watchdog of non-finite
+            losses and gradients.
     """
     # Enable train mode.
     model.train()
@@ -52,150 +171,96 @@ def train_epoch(
     data_size = len(train_loader)
 
     cur_global_batch_size = cfg.NUM_SHARDS * cfg.TRAIN.BATCH_SIZE
-    num_iters = cfg.GLOBAL_BATCH_SIZE // cur_global_batch_size
-
-    for cur_iter, (inputs, labels, _, meta) in enumerate(train_loader):
-        # Transfer the data to the current GPU device.
-        if cfg.NUM_GPUS:
-            if isinstance(inputs, (list,)):
-                for i in range(len(inputs)):
-                    inputs[i] = inputs[i].cuda(non_blocking=True)
-            else:
-                inputs = inputs.cuda(non_blocking=True)
-            labels = labels.cuda()
-            for key, val in meta.items():
-                if isinstance(val, (list,)):
-                    for i in range(len(val)):
-                        val[i] = val[i].cuda(non_blocking=True)
-                else:
-                    meta[key] = val.cuda(non_blocking=True)
-
+    num_iters = max(cfg.GLOBAL_BATCH_SIZE // cur_global_batch_size, 1)
+    stats_buffer = StatsBuffer(cfg.NUM_GPUS)
+    if watchdog is not None:
+        watchdog.snapshot(0)
+
+    # Transfer the data to the current GPU device.
+    train_iter = loader.DevicePrefetcher(train_loader, cfg)
+    for cur_iter, (inputs, labels, index, meta) in enumerate(train_iter):
         # Update the learning rate.
         lr = optim.get_epoch_lr(cur_epoch + float(cur_iter) / data_size, cfg)
         optim.set_lr(optimizer, lr)
 
         train_meter.data_toc()
 
-        # Explicitly declare reduction to mean.
-        if not cfg.MIXUP.ENABLED:
-           loss_fun = losses.get_loss_func(cfg.MODEL.LOSS_FUNC)(reduction="mean")
-        else:
-           mixup_fn = Mixup(
-               mixup_alpha=cfg.MIXUP.ALPHA, cutmix_alpha=cfg.MIXUP.CUTMIX_ALPHA, cutmix_minmax=cfg.MIXUP.CUTMIX_MINMAX, prob=cfg.MIXUP.PROB, switch_prob=cfg.MIXUP.SWITCH_PROB, mode=cfg.MIXUP.MODE,
-               label_smoothing=0.1, num_classes=cfg.MODEL.NUM_CLASSES)
-           hard_labels = labels
-           inputs, labels = mixup_fn(inputs, labels)
-           loss_fun = SoftTargetCrossEntropy()
-
-        start = time.time()
-        if cfg.DETECTION.ENABLE:
-            preds, vmps_loss = model(inputs, meta["boxes"])
-        else:
-            preds, vmps_loss = model(inputs)
-
-        if cfg.WANDB.ENABLE:
-            wandb.log({"Time per forwar": time.time() - start})
-
-        # Compute the loss.
-        loss = loss_fun(preds, labels) + vmps_loss
-
-        if cfg.MIXUP.ENABLED:
-            labels = hard_labels
-
-        # check Nan Loss.
-        misc.check_nan_losses(loss)
-
-
-        if cur_global_batch_size >= cfg.GLOBAL_BATCH_SIZE:
-            # Perform the backward pass.
+        # The gradients of num_iters iterations, or of the remaining ones at
+        # the end of the epoch, are accumulated for an optimizer step.
+        group_start, group_size, is_step = get_accumulation_group(
+            cur_iter, num_iters, data_size
+        )
+        if cur_iter == group_start:
             optimizer.zero_grad()
-            start = time.time()
-            loss.backward()
-            if cfg.WANDB.ENABLE:
-                wandb.log({"Time per backward": time.time() - start})
-            # Update the parameters.
-            optimizer.step()
-        else:
-            if cur_iter == 0:
-                optimizer.zero_grad()
-            start = time.time()
-            loss.backward()
-            if cfg.WANDB.ENABLE:
-                wandb.log({"Time per backward": time.time() - start})
-            if (cur_iter + 1) % num_iters == 0:
-                for p in model.parameters():
-                    if p.requires_grad:
-                        p.grad /= num_iters
-                optimizer.step()
-                optimizer.zero_grad()
-
-        if cfg.DETECTION.ENABLE:
-            if cfg.NUM_GPUS > 1:
-                loss = du.all_reduce([loss])[0]
-            loss = loss.item()
+        if watchdog is not None:
+            watchdog.record(inputs, labels, index, meta)
+        preds, labels, loss = train_step(
+            inputs, labels, meta, model, optimizer, scaler, group_size, is_step, cfg
+        )
 
-            # Update and log stats.
-            train_meter.update_stats(None, None, None, loss, lr)
-            # write to tensorboard format if available.
-            if writer is not None:
-                writer.add_scalars(
-                    {"Train/loss": loss, "Train/lr": lr},
-                    global_step=data_size * cur_epoch + cur_iter,
-                )
-            if cfg.WANDB.ENABLE:
-                wandb.log({"Train/loss": loss, "Train/lr": lr})
+        # Keep the stats on the device, they are averaged across the devices
+        # and copied to the host every LOG_PERIOD iterations.
+        stats = [loss]
+        info = {"lr": lr, "cur_iter": cur_iter}
+        if not cfg.DETECTION.ENABLE:
+            # If running  on CPU (cfg.NUM_GPUS == 1), use 1 to represent 1 CPU.
+            info["mb_size"] = inputs[0].size(0) * max(cfg.NUM_GPUS, 1)
+        if not cfg.DETECTION.ENABLE and not cfg.DATA.MULTI_LABEL:
+            # Compute the errors.
+            num_topks_correct = metrics.topks_correct(preds, labels, (1, 5))
+            stats += [
+                (1.0 - x / preds.size(0)) * 100.0 for x in num_topks_correct
+            ]
+        if watchdog is not None:
+            stats.append(watchdog.flag(loss))
+        stats_buffer.append(stats, **info)
+
+        if (cur_iter + 1) % cfg.LOG_PERIOD == 0 or cur_iter + 1 == data_size:
+            for stats, info in stats_buffer.flush():
+                if watchdog is not None:
+                    if stats.pop() > 0:
+                        replay_nonfinite_iteration(
+                            train_loader,
+                            model,
+                            optimizer,
+                            scaler,
+                            watchdog,
+                            cur_epoch,
+                            info["cur_iter"],
+                            cfg,
+                        )
+                loss, lr = stats[0], info["lr"]
+                # check Nan Loss.
+                misc.check_nan_losses(loss)
 
-        else:
-            top1_err, top5_err = None, None
-            if cfg.DATA.MULTI_LABEL:
-                # Gather all the predictions across all the devices.
-                if cfg.NUM_GPUS > 1:
-                    [loss] = du.all_reduce([loss])
-                loss = loss.item()
-            else:
-                # Compute the errors.
-                num_topks_correct = metrics.topks_correct(preds, labels, (1, 5))
-                top1_err, top5_err = [
-                    (1.0 - x / preds.size(0)) * 100.0 for x in num_topks_correct
-                ]
-                # Gather all the predictions across all the devices.
-                if cfg.NUM_GPUS > 1:
-                    loss, top1_err, top5_err = du.all_reduce(
-                        [loss, top1_err, top5_err]
+                # Update and log stats.
+                if cfg.DETECTION.ENABLE:
+                    train_meter.update_stats(None, None, None, loss, lr)
+                    log_stats = {"Train/loss": loss, "Train/lr": lr}
+                else:
+                    top1_err, top5_err = None, None
+                    if not cfg.DATA.MULTI_LABEL:
+                        top1_err, top5_err = stats[1:]
+                    train_meter.update_stats(
+                        top1_err, top5_err, loss, lr, info["mb_size"]
                     )
-
-                # Copy the stats from GPU to CPU (sync point).
-                loss, top1_err, top5_err = (
-                    loss.item(),
-                    top1_err.item(),
-                    top5_err.item(),
-                )
-
-            # Update and log stats.
-            train_meter.update_stats(
-                top1_err,
-                top5_err,
-                loss,
-                lr,
-                inputs[0].size(0)
-                * max(
-                    cfg.NUM_GPUS, 1
-                ),  # If running  on CPU (cfg.NUM_GPUS == 1), use 1 to represent 1 CPU.
-            )
-            # write to tensorboard format if available.
-            if writer is not None:
-                writer.add_scalars(
-                    {
+                    log_stats = {
                         "Train/loss": loss,
                         "Train/lr": lr,
                         "Train/Top1_err": top1_err,
                         "Train/Top5_err": top5_err,
-                    },
-                    global_step=data_size * cur_epoch + cur_iter,
-                )
+                    }
+                # write to tensorboard format if available.
+                if writer is not None:
+                    writer.add_scalars(
+                        log_stats,
+                        global_step=data_size * cur_epoch + info["cur_iter"],
+                    )
+                if cfg.WANDB.ENABLE:
+                    wandb.log(log_stats)
 
-            if cfg.WANDB.ENABLE:
-                wandb.log({"Train/loss": loss, "Train/lr": lr, "Train/Top1_err": top1_err, "Train/Top5_err": top5_err})
+            if watchdog is not None and cur_iter + 1 < data_size:
+                watchdog.snapshot(cur_iter + 1)
 
         train_meter.iter_toc()  # measure allreduce for this meter
         train_meter.log_iter_stats(cur_epoch, cur_iter)
@@ -204,6 +269,105 @@ def train_epoch(
     # Log epoch stats.
     train_meter.log_epoch_stats(cur_epoch)
     train_meter.reset()
+    # Log the values of the motion prompts buffered since the last log period.
+    for module in model.modules():
+        if isinstance(module, VideoMotionPrompt):
+            module.flush_log()
+
+
+def replay_nonfinite_iteration(
+    train_loader, model, optimizer, scaler, watchdog, cur_epoch, cur_iter, cfg
+):
+    """
+    Save the states at the start of the log period of an iteration flagged by
+    the watchdog, and replay the iterations of the period from them. The
+    flagged iteration runs under autograd anomaly detection, which reports
+    the backward op producing non-finite values, and the first module with a
+    non-finite output in the forward pass is logged. The batches recorded by
+    the watchdog are replayed, with their random augmentations. The flags are
+    averaged across the processes, so every process replays its own
+    iterations, on the model without DDP so no collective is involved.
+    Args:
+        train_loader (loader): video training loader.
+        model (model): the video model to train.
+        optimizer (optim): the optimizer to perform optimization on the model's
+            parameters.
+        scaler (GradScaler): gradient scaler of mixed precision training.
+        watchdog (NonFiniteWatchdog): watchdog which flagged the iteration.
+        cur_epoch (int): current epoch of training.
+        cur_iter (int): the flagged iteration.
+        cfg (CfgNode): configs. Details can be found in
+            slowfast/config/defaults.py
+    """
+    path = watchdog.save(cur_epoch, cur_iter)
+    logger.info(
+        "Non-finite loss or gradients at iteration {} of epoch {}, saved the "
+        "states of iteration {} to {}.".format(
+            cur_iter + 1, cur_epoch + 1, watchdog.start_iter + 1, path
+        )
+    )
+    watchdog.restore()
+
+    data_size = len(train_loader)
+    cur_global_batch_size = cfg.NUM_SHARDS * cfg.TRAIN.BATCH_SIZE
+    num_iters = max(cfg.GLOBAL_BATCH_SIZE // cur_global_batch_size, 1)
+    nonfinite_modules = []
+
+    def check_output(module, inputs, output):
+        if (
+            torch.is_tensor(output)
+            and output.is_floating_point()
+            and not torch.isfinite(output).all()
+        ):
+            nonfinite_modules.append(module)
+
+    if cfg.NUM_GPUS > 1:
+        model = model.module
+    names = {module: name for name, module in model.named_modules()}
+    num_replays = cur_iter - watchdog.start_iter + 1
+    for i, batch in enumerate(watchdog.batches[:num_replays]):
+        replay_iter = watchdog.start_iter + i
+        if cfg.NUM_GPUS:
+            batch = loader.to_device(batch)
+        inputs, labels, _, meta = batch
+        lr = optim.get_epoch_lr(cur_epoch + float(replay_iter) / data_size, cfg)
+        optim.set_lr(optimizer, lr)
+        group_start, group_size, is_step = get_accumulation_group(
+            replay_iter, num_iters, data_size
+        )
+        if replay_iter == group_start:
+            optimizer.zero_grad()
+
+        step_args = (model, optimizer, scaler, group_size, is_step, cfg)
+        if replay_iter < cur_iter:
+            train_step(inputs, labels, meta, *step_args)
+            continue
+        handles = [
+            module.register_forward_hook(check_output)
+            for module in model.modules()
+        ]
+        try:
+            with torch.autograd.detect_anomaly():
+                train_step(inputs, labels, meta, *step_args)
+            logger.info("The replayed iteration has finite gradients.")
+        except RuntimeError as e:
+            logger.info("Anomaly detection of the replayed iteration: {}".format(e))
+        finally:
+            for handle in handles:
+                handle.remove()
+        if nonfinite_modules:
+            logger.info(
+                "First non-finite output of the forward pass: {} ({}).".format(
+                    names[nonfinite_modules[0]] or "model",
+                    type(nonfinite_modules[0]).__name__,
+                )
+            )
+        else:
+            logger.info("The replayed forward pass has finite outputs.")
+
+    raise RuntimeError(
+        "ERROR: Got non-finite losses or gradients {}".format(datetime.now())
+    )
 
 
 @torch.no_grad()
@@ -224,27 +388,18 @@ def eval_epoch(val_loader, model, val_meter, cur_epoch, cfg, writer=None):
     # Evaluation mode enabled. The running stats would not be updated.
     model.eval()
     val_meter.iter_tic()
+    stats_buffer = StatsBuffer(cfg.NUM_GPUS)
 
-    for cur_iter, (inputs, labels, _, meta) in enumerate(val_loader):
-        if cfg.NUM_GPUS:
-            # Transferthe data to the current GPU device.
-            if isinstance(inputs, (list,)):
-                for i in range(len(inputs)):
-                    inputs[i] = inputs[i].cuda(non_blocking=True)
-            else:
-                inputs = inputs.cuda(non_blocking=True)
-            labels = labels.cuda()
-            for key, val in meta.items():
-                if isinstance(val, (list,)):
-                    for i in range(len(val)):
-                        val[i] = val[i].cuda(non_blocking=True)
-                else:
-                    meta[key] = val.cuda(non_blocking=True)
+    # Transfer the data to the current GPU device.
+    val_iter = loader.DevicePrefetcher(val_loader, cfg)
+    for cur_iter, (inputs, labels, _, meta) in enumerate(val_iter):
         val_meter.data_toc()
 
         if cfg.DETECTION.ENABLE:
             # Compute the predictions.
-            preds = model(inputs, meta["boxes"])
+            with misc.autocast(cfg):
+                preds, _ = model(inputs, meta["boxes"])
+            preds = preds.float()
             ori_boxes = meta["ori_boxes"]
             metadata = meta["metadata"]
 
@@ -263,7 +418,9 @@ def eval_epoch(val_loader, model, val_meter, cur_epoch, cfg, writer=None):
             val_meter.update_stats(preds, ori_boxes, metadata)
 
         else:
-            preds = model(inputs)
+            with misc.autocast(cfg):
+                preds, _ = model(inputs)
+            preds = preds.float()
 
             if cfg.DATA.MULTI_LABEL:
                 if cfg.NUM_GPUS > 1:
@@ -272,32 +429,38 @@ def eval_epoch(val_loader, model, val_meter, cur_epoch, cfg, writer=None):
                 # Compute the errors.
                 num_topks_correct = metrics.topks_correct(preds, labels, (1, 5))
 
-                # Combine the errors across the GPUs.
                 top1_err, top5_err = [
                     (1.0 - x / preds.size(0)) * 100.0 for x in num_topks_correct
                 ]
-                if cfg.NUM_GPUS > 1:
-                    top1_err, top5_err = du.all_reduce([top1_err, top5_err])
-
-                # Copy the errors from GPU to CPU (sync point).
-                top1_err, top5_err = top1_err.item(), top5_err.item()
-
-                val_meter.iter_toc()
-                # Update and log stats.
-                val_meter.update_stats(
-                    top1_err,
-                    top5_err,
-                    inputs[0].size(0)
-                    * max(
-                        cfg.NUM_GPUS, 1
-                    ),  # If running  on CPU (cfg.NUM_GPUS == 1), use 1 to represent 1 CPU.
+                # Keep the errors on the device, they are combined across the
+                # GPUs and copied to the host every LOG_PERIOD iterations.
+                stats_buffer.append(
+                    [top1_err, top5_err],
+                    cur_iter=cur_iter,
+                    # If running  on CPU (cfg.NUM_GPUS == 1), use 1 to represent 1 CPU.
+                    mb_size=inputs[0].size(0) * max(cfg.NUM_GPUS, 1),
                 )
-                # write to tensorboard format if available.
-                if writer is not None:
-                    writer.add_scalars(
-                        {"Val/Top1_err": top1_err, "Val/Top5_err": top5_err},
-                        global_step=len(val_loader) * cur_epoch + cur_iter,
-                    )
+                val_meter.iter_toc()
+
+                if (
+                    (cur_iter + 1) % cfg.LOG_PERIOD == 0
+                    or cur_iter + 1 == len(val_loader)
+                ):
+                    for (top1_err, top5_err), info in stats_buffer.flush():
+                        # Update and log stats.
+                        val_meter.update_stats(
+                            top1_err, top5_err, info["mb_size"]
+                        )
+                        # write to tensorboard format if available.
+                        if writer is not None:
+                            writer.add_scalars(
+                                {
+                                    "Val/Top1_err": top1_err,
+                                    "Val/Top5_err": top5_err,
+                                },
+                                global_step=len(val_loader) * cur_epoch
+                                + info["cur_iter"],
+                            )
 
             val_meter.update_predictions(preds, labels)
 
@@ -453,10 +616,12 @@ def train(cfg):
 
     # Construct the optimizer.
     optimizer = optim.construct_optimizer(model, cfg)
+    # Create a GradScaler for mixed precision training.
+    scaler = misc.build_grad_scaler(cfg)
 
     # Load a checkpoint to resume training if applicable.
     if not cfg.TRAIN.FINETUNE:
-        start_epoch = cu.load_train_checkpoint(cfg, model, optimizer)
+        start_epoch = cu.load_train_checkpoint(cfg, model, optimizer, scaler)
     else:
         start_epoch = 0
         cu.load_checkpoint(cfg.TRAIN.CHECKPOINT_FILE_PATH, model)
@@ -474,6 +639,13 @@ def train(cfg):
     train_meter = TrainMeter(len(train_loader), cfg)
     # val_meter = ValMeter(len(val_loader), cfg)
 
+    # Watch the losses and gradients for non-finite values.
+    watchdog = (
+        NonFiniteWatchdog(model, optimizer, scaler, cfg)
+        if cfg.WATCHDOG.ENABLE
+        else None
+    )
+
     # set up writer for logging to Tensorboard format.
     if cfg.TENSORBOARD.ENABLE and du.is_master_proc(
         cfg.NUM_GPUS * cfg.NUM_SHARDS
@@ -507,15 +679,29 @@ def train(cfg):
                     last_checkpoint = cfg.TRAIN.CHECKPOINT_FILE_PATH
                 logger.info("Load from {}".format(last_checkpoint))
                 cu.load_checkpoint(
-                    last_checkpoint, model, cfg.NUM_GPUS > 1, optimizer
+                    last_checkpoint,
+                    model,
+                    cfg.NUM_GPUS > 1,
+                    optimizer,
+                    scaler=scaler,
                 )
+                if watchdog is not None:
+                    watchdog = NonFiniteWatchdog(model, optimizer, scaler, cfg)
 
         # Shuffle the dataset.
         loader.shuffle_dataset(train_loader, cur_epoch)
 
         # Train for one epoch.
         train_epoch(
-            train_loader, model, optimizer, train_meter, cur_epoch, cfg, writer
+            train_loader,
+            model,
+            optimizer,
+            scaler,
+            train_meter,
+            cur_epoch,
+            cfg,
+            writer,
+            watchdog,
         )
 
         is_checkp_epoch = cu.is_checkpoint_epoch(
@@ -543,7 +729,9 @@ def train(cfg):
 
         # Save a checkpoint.
         if is_checkp_epoch:
-            cu.save_checkpoint(cfg.OUTPUT_DIR, model, optimizer, cur_epoch, cfg)
+            cu.save_checkpoint(
+                cfg.OUTPUT_DIR, model, optimizer, cur_epoch, cfg, scaler
+            )
         # Evaluate the model on validation set.
         # if is_eval_epoch:
         #     eval_epoch(val_loader, model, val_meter, cur_epoch, cfg, writer)